@@ -42,12 +42,15 @@ def login_required(func):
             logout_url = GOOGLE_APPS_LOGOUT_URL % user.domain_name
             if user.is_deleted:
                 return HttpResponseRedirect(logout_url)
+            if users.is_known_user(user):
+                return func(request, *args, **kwargs)
             ga_user = models.GAUser.all().filter(
                 'user_name', user.nickname()).get()
             if not ga_user:
                 ga_user = models.GAUser.get_by_key_name(
                     user.nickname(), cached=False)
             if ga_user:
+                users.remember_user(user)
                 return func(request, *args, **kwargs)
             else:
                 index = GDataIndex.get_by_key_name(
@@ -1,6 +1,5 @@
 import logging
 import re
-from google.appengine.api import memcache
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 from gdata.apps import service
@@ -8,6 +7,7 @@ from gdata.service import CaptchaRequired, BadAuthentication
 from crauth.users import SetupRequiredError, _SERVICE_MEMCACHE_TOKEN_KEY
 from crauth.models import AppsDomain
 from crlib import forms as crforms
+from crlib import memcache_batch
 from crlib import regexps
 
 
@@ -109,7 +109,7 @@ class DomainSetupForm(CaptchaForm):
                 apps_domain.admin_password = old_credentials['password']
                 apps_domain.put()
 
-        memcache.delete(_SERVICE_MEMCACHE_TOKEN_KEY % (
+        memcache_batch.delete(_SERVICE_MEMCACHE_TOKEN_KEY % (
             domain, self.service.service))
         apps_domain.admin_email = email
         apps_domain.admin_password = password
@@ -1,5 +1,6 @@
 import datetime
 import logging
+import time
 from appengine_django.models import BaseModel
 from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse
@@ -9,6 +10,7 @@ from google.appengine.api import memcache
 from crauth.licensing import LICENSE_STATES, STATE_ACTIVE
 from crauth.permissions import class_prepared_callback
 from crlib.signals import class_prepared, gauser_renamed
+from crlib import memcache_batch
 
 
 class_prepared.connect(class_prepared_callback)
@@ -65,6 +67,14 @@ class AppsDomain(BaseModel):
         kwargs.setdefault('expiration_date', default_expiration_date())
         super(AppsDomain, self).__init__(*args, **kwargs)
 
+    def put(self):
+        from crauth import users
+        key = super(AppsDomain, self).put()
+        users.context.domain_saved(self)
+        return key
+
+    save = put
+
     def is_active(self):
         return self.is_enabled and (
             self.is_independent or self.license_state == STATE_ACTIVE)
@@ -104,6 +114,36 @@ class AppsDomain(BaseModel):
         return is_active
 
 
+PERMISSIONS_VERSION_KEY = 'permissions_version:%s'
+
+
+def permissions_version(domain):
+    """Returns version of the roles and user permissions of the domain.
+    Permission sets cached by :func:`crauth.users.User.permissions` are
+    valid for a single version.
+
+    """
+    key = PERMISSIONS_VERSION_KEY % domain
+    version = memcache_batch.get(key)
+    if version is None:
+        # Start from the current time, so that versions of the permission
+        # sets cached before the version got evicted don't come back.
+        initial = int(time.time() * 1000)
+        memcache.add(key, initial)
+        version = memcache.get(key) or initial
+        memcache_batch.remember(key, version)
+    return version
+
+
+def permissions_changed(domain):
+    """Must be called when roles or user permissions of the domain change.
+    put() and delete() of :class:`Role` and :class:`UserPermissions` do it,
+    db.put() and db.delete() don't.
+
+    """
+    memcache_batch.delete(PERMISSIONS_VERSION_KEY % domain)
+
+
 class Role(BaseModel):
     #: Name of the Role.
     name = db.StringProperty(required=True)
@@ -115,6 +155,22 @@ class Role(BaseModel):
         """Returs a Query object with ``ancestor(domain)`` filter applied."""
         return cls.all(**kwargs).ancestor(domain)
 
+    def _permissions_changed(self):
+        parent = self.parent_key()
+        if parent:
+            permissions_changed(parent.name())
+
+    def put(self):
+        key = super(Role, self).put()
+        self._permissions_changed()
+        return key
+
+    save = put
+
+    def delete(self):
+        super(Role, self).delete()
+        self._permissions_changed()
+
 
 class UserPermissions(BaseModel):
     #: Email address of user.
@@ -124,6 +180,17 @@ class UserPermissions(BaseModel):
     #: List of permissions given user is assigned.
     permissions = db.StringListProperty()
 
+    def put(self):
+        key = super(UserPermissions, self).put()
+        permissions_changed(self.user_email.partition('@')[2])
+        return key
+
+    save = put
+
+    def delete(self):
+        super(UserPermissions, self).delete()
+        permissions_changed(self.user_email.partition('@')[2])
+
 def gauser_renamed_callback(sender, **kwargs):
     old_email = '%s@%s' % (kwargs['old_name'], sender)
     new_email = '%s@%s' % (kwargs['new_name'], sender)
@@ -28,6 +28,7 @@ class PermissionsTestCase(unittest.TestCase):
         )
         db.delete(models.UserPermissions.all().fetch(100))
         db.delete(models.Role.all().fetch(100))
+        models.permissions_changed(FAKE_DOMAIN)
 
     def set_testing_user(self):
         users._set_testing_user(FAKE_EMAIL, FAKE_DOMAIN)
@@ -156,3 +157,53 @@ class PermissionsTestCase(unittest.TestCase):
         with self.fake_is_admin(False):
             self.assertTrue(user.has_perm('some_perm'))
 
+
+    def testRoleChangeInvalidatesPermissions(self):
+        user = self.set_testing_user()
+        role = models.Role(
+            parent=user.domain(),
+            name='Test Role',
+            permissions=['some_perm'],
+        )
+        role.put()
+        models.UserPermissions(
+            key_name=user._email,
+            user_email=user._email,
+            roles=[role.key()],
+        ).put()
+        with self.fake_is_admin(False):
+            self.assertTrue(user.has_perm('some_perm'))
+            role.permissions = ['other_perm']
+            role.put()
+            self.assertFalse(user.has_perm('some_perm'))
+            self.assertTrue(user.has_perm('other_perm'))
+
+    def testHasPermDoesntWrite(self):
+        user = self.set_testing_user()
+        with self.fake_is_admin(False):
+            self.assertFalse(user.has_perm('some_perm'))
+        self.assertEqual(
+            models.UserPermissions.get_by_key_name(user._email), None)
+
+
+class DomainContextTestCase(unittest.TestCase):
+    def setUp(self):
+        users.context.reset()
+        users._set_current_user(FAKE_EMAIL, FAKE_DOMAIN)
+        models.AppsDomain.get_or_insert(key_name=FAKE_DOMAIN,
+                                        domain=FAKE_DOMAIN)
+
+    def testUserIsMemoized(self):
+        self.assertTrue(users.get_current_user() is users.get_current_user())
+
+    def testDomainIsMemoized(self):
+        apps_domain = users.get_current_domain()
+        self.assertTrue(apps_domain is users.get_current_domain())
+        self.assertTrue(apps_domain is users.get_current_user().domain())
+
+    def testSavedDomainReplacesMemoized(self):
+        users.get_current_domain()
+        apps_domain = models.AppsDomain.get_by_key_name(FAKE_DOMAIN)
+        apps_domain.status = 'OK'
+        apps_domain.put()
+        self.assertEqual(users.get_current_domain().status, 'OK')
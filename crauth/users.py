@@ -13,12 +13,21 @@ from gdata.service import GDataService, CaptchaRequired, BadAuthentication
 from gdata.client import GDClient, CaptchaChallenge
 from gdata.gauth import ClientLoginToken, TwoLeggedOAuthHmacToken
 from gdata.apps.service import AppsForYourDomainException
-from crauth.models import AppsDomain, UserPermissions, Role
+from crauth.models import AppsDomain, UserPermissions, Role, \
+        PERMISSIONS_VERSION_KEY, permissions_version
 from crauth.permissions import ADMIN_PERMS
+from crlib import memcache_batch
+from crlib.signals import gauser_renamed
 
 
 _SERVICE_MEMCACHE_TOKEN_KEY = 'service_client_login_token:%s:%s'
 _CLIENT_MEMCACHE_TOKEN_KEY = 'client_client_login_token:%s:%s'
+_IS_ADMIN_MEMCACHE_KEY = 'is_current_user_admin:%s'
+_PERMISSIONS_MEMCACHE_KEY = 'user_permissions:%s'
+_PERMISSIONS_CACHE_TIME = 24 * 60 * 60
+# Set for users which login_required found in the domain
+_KNOWN_USER_MEMCACHE_KEY = 'known_user:%s'
+_KNOWN_USER_CACHE_TIME = 10 * 60
 _ENVIRON_EMAIL = 'CLIENT_LOGIN_EMAIL'
 _ENVIRON_DOMAIN = 'CLIENT_LOGIN_DOMAIN'
 
@@ -27,6 +36,65 @@ class LoginRequiredError(Exception): pass
 class SetupRequiredError(Exception): pass
 
 
+class _DomainContext(object):
+    """Objects of the current unit of work (request or task): User objects,
+    AppsDomain entities and authenticated GData services. They're kept until
+    reset() is called by crlib.middleware.RequestCacheMiddleware.
+
+    Identity of the current user is still read from os.environ, so objects
+    of other users (e.g. of the domains processed by a task) are kept
+    separately.
+
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._users = {}
+        # domain name -> AppsDomain or None
+        self._domains = {}
+        # (domain name, email, service key) -> service
+        self._services = {}
+
+    def user(self, email, domain):
+        user = self._users.get((email, domain))
+        if user is None:
+            user = self._users[(email, domain)] = User(email, domain)
+        return user
+
+    def apps_domain(self, domain, create=False):
+        apps_domain = self._domains.get(domain)
+        if apps_domain is None:
+            if create:
+                apps_domain = AppsDomain.get_or_insert(
+                    key_name=domain, domain=domain)
+            else:
+                apps_domain = AppsDomain.get_by_key_name(domain)
+            self._domains[domain] = apps_domain
+        return apps_domain
+
+    def domain_saved(self, apps_domain):
+        """Called by AppsDomain.put(), credentials may have changed."""
+        self._domains[apps_domain.domain] = apps_domain
+        for key in self._services.keys():
+            if key[0] == apps_domain.domain:
+                del self._services[key]
+
+    def service(self, user, key, create):
+        """Returns the service of the user identified by key, create() is
+        called to create and authenticate it the first time.
+
+        """
+        full_key = (user.domain_name, user.email(), key)
+        service = self._services.get(full_key)
+        if service is None:
+            service = self._services[full_key] = create()
+        return service
+
+
+context = _DomainContext()
+
+
 class User(object):
     def __init__(self, email, domain):
         self._email = email.lstrip('*')
@@ -45,15 +113,12 @@ class User(object):
         User is part of.
 
         """
-        return AppsDomain.get_or_insert(
-            key_name=self.domain_name,
-            domain=self.domain_name,
-        )
+        return context.apps_domain(self.domain_name, create=True)
 
     def _client_login_service(self, service, captcha_token, captcha):
         memcache_key = _SERVICE_MEMCACHE_TOKEN_KEY % (
             self.domain_name, service.service)
-        token = memcache.get(memcache_key)
+        token = memcache_batch.get(memcache_key)
         if not token:
             from gdata.service import BadAuthentication
             apps_domain = self.domain()
@@ -83,14 +148,14 @@ class User(object):
                 if old_status != apps_domain.status:
                     apps_domain.put()
             token = service.GetClientLoginToken()
-            memcache.set(memcache_key, token, 24 * 60 * 60)
+            memcache_batch.set(memcache_key, token, 24 * 60 * 60)
         else:
             service.SetClientLoginToken(token)
 
     def _client_login_client(self, client, captcha_token, captcha):
         memcache_key = _CLIENT_MEMCACHE_TOKEN_KEY % (
             self.domain_name, client.auth_service)
-        token = memcache.get(memcache_key)
+        token = memcache_batch.get(memcache_key)
         if not token:
             from gdata.client import BadAuthentication
             apps_domain = self.domain()
@@ -115,7 +180,7 @@ class User(object):
                 if old_status != apps_domain.status:
                     apps_domain.put()
             token = client.auth_token.token_string
-            memcache.set(memcache_key, token, 24 * 60 * 60)
+            memcache_batch.set(memcache_key, token, 24 * 60 * 60)
         else:
             client.auth_token = ClientLoginToken(token)
 
@@ -149,7 +214,7 @@ class User(object):
         """
         from gdata.apps.service import AppsService
         from gdata.auth import OAuthSignatureMethod
-        is_admin = memcache.get(self.email(), namespace='is_current_user_admin')
+        is_admin = memcache_batch.get(_IS_ADMIN_MEMCACHE_KEY % self.email())
         if is_admin is not None:
             return is_admin
         service = AppsService(domain=self.domain_name)
@@ -169,8 +234,8 @@ class User(object):
             except (SetupRequiredError, CaptchaChallenge):
                 return False
         is_admin = apps_user is not None and apps_user.login.admin == 'true'
-        memcache.set(self.email(), is_admin, 60 * 60,
-                     namespace='is_current_user_admin')
+        memcache_batch.set(
+            _IS_ADMIN_MEMCACHE_KEY % self.email(), is_admin, 60 * 60)
         return is_admin
 
     def has_perm(self, permission):
@@ -193,24 +258,37 @@ class User(object):
         :func:`is_admin` returns ``False``.
 
         """
-        perm_list = set(perm_list)
-        is_admin = self.is_admin()
-        if is_admin:
+        if self.is_admin():
             return True
 
-        if perm_list.intersection(set(ADMIN_PERMS)):
-            return is_admin
-
-        permissions = UserPermissions.get_or_insert(
-            key_name=self._email,
-            user_email=self._email)
-        if not permissions:
+        perm_list = set(perm_list)
+        if perm_list.intersection(ADMIN_PERMS):
             return False
-        roles = [role for role in Role.get(permissions.roles) if role]
-        all_perms = set(permissions.permissions)
-        for role in roles:
-            all_perms.update(role.permissions)
-        return all_perms.issuperset(perm_list)
+        return self.permissions().issuperset(perm_list)
+
+    def permissions(self):
+        """Returns set of the permissions given to the User directly and by
+        roles.
+
+        The set is cached in memcache until roles or permissions of the
+        domain change, see :func:`crauth.models.permissions_changed`.
+
+        """
+        key = _PERMISSIONS_MEMCACHE_KEY % self._email
+        version = permissions_version(self.domain_name)
+        cached = memcache_batch.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        all_perms = set()
+        permissions = UserPermissions.get_by_key_name(self._email)
+        if permissions:
+            all_perms.update(permissions.permissions)
+            for role in Role.get(permissions.roles):
+                if role:
+                    all_perms.update(role.permissions)
+        memcache_batch.set(key, (version, all_perms), _PERMISSIONS_CACHE_TIME)
+        return all_perms
 
 
 class UsersMiddleware(object):
@@ -253,8 +331,10 @@ class UsersMiddleware(object):
                     reverse('domain_setup', args=(user.domain().domain,)) +
                     '?fix')
         elif isinstance(exception, AppsForYourDomainException):
+            from google.appengine.api import memcache
             request.session.pop(settings.SESSION_LOGIN_INFO_KEY, None)
             memcache.flush_all()
+            memcache_batch.reset()
 
 
 def create_login_url(dest_url=settings.LOGIN_REDIRECT_URL):
@@ -269,16 +349,22 @@ def create_logout_url(dest_url):
 
 def get_current_user():
     if os.environ.get(_ENVIRON_EMAIL) and os.environ.get(_ENVIRON_DOMAIN):
-        return User(
+        return context.user(
             os.environ[_ENVIRON_EMAIL],
             os.environ[_ENVIRON_DOMAIN])
     else:
         return None
 
 
+def get_current_domain_name():
+    """Same as get_current_user().domain_name, without creating the User."""
+    if os.environ.get(_ENVIRON_EMAIL):
+        return os.environ.get(_ENVIRON_DOMAIN)
+
+
 def get_current_domain():
     if os.environ.get(_ENVIRON_EMAIL) and os.environ.get(_ENVIRON_DOMAIN):
-        return AppsDomain.get_by_key_name(os.environ[_ENVIRON_DOMAIN])
+        return context.apps_domain(os.environ[_ENVIRON_DOMAIN])
 
 
 def is_current_user_admin():
@@ -288,6 +374,49 @@ def is_current_user_admin():
     return user.is_admin()
 
 
+def _memcache_keys():
+    """Keys read by most of the requests, see memcache_batch."""
+    user = get_current_user()
+    if user is None:
+        return []
+    return [
+        _IS_ADMIN_MEMCACHE_KEY % user.email(),
+        _PERMISSIONS_MEMCACHE_KEY % user.email(),
+        _KNOWN_USER_MEMCACHE_KEY % user.email(),
+        PERMISSIONS_VERSION_KEY % user.domain_name,
+        # AppsService, GroupsService and ContactsClient
+        _SERVICE_MEMCACHE_TOKEN_KEY % (user.domain_name, 'apps'),
+        _CLIENT_MEMCACHE_TOKEN_KEY % (user.domain_name, 'cp'),
+    ]
+
+memcache_batch.register_prefetch(_memcache_keys)
+
+
+def is_known_user(user):
+    """Returns True if :func:`remember_user` was called for the user
+    recently, and the user hasn't been renamed or deleted since.
+
+    """
+    return bool(memcache_batch.get(_KNOWN_USER_MEMCACHE_KEY % user.email()))
+
+
+def remember_user(user):
+    # Written at once, not with memcache_batch at the end of the request,
+    # so that forget_user() called meanwhile isn't undone.
+    memcache.set(_KNOWN_USER_MEMCACHE_KEY % user.email(), True,
+                 _KNOWN_USER_CACHE_TIME)
+
+
+def forget_user(email):
+    memcache_batch.delete(_KNOWN_USER_MEMCACHE_KEY % email)
+
+
+def _gauser_renamed_callback(sender, **kwargs):
+    forget_user('%s@%s' % (kwargs['old_name'], sender))
+
+gauser_renamed.connect(_gauser_renamed_callback)
+
+
 def _set_current_user(email, domain):
     os.environ[_ENVIRON_EMAIL] = email
     os.environ[_ENVIRON_DOMAIN] = domain
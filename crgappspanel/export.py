@@ -0,0 +1,225 @@
+"""Export of users, groups, shared contacts and calendar resources.
+
+Objects are read from the cache models with datastore cursors (calendar
+resources, which aren't cached, from the GData feed), chunk_size of the
+exporter at a time. Each chunk is written by its own task as an ExportChunk,
+so that exports of big domains aren't limited by the request deadline. The
+download joins the chunks in order.
+
+"""
+import csv
+import datetime
+import StringIO
+from google.appengine.ext import db
+from google.appengine.api.labs import taskqueue
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
+from crauth import users
+from crauth.models import AppsDomain
+from crgappspanel.models import GAUser, GAGroup, SharedContact, \
+        CalendarResource, ExportJob, ExportChunk
+
+
+__all__ = ['EXPORTERS', 'start_job', 'export_chunk', 'iter_output']
+
+
+CHUNK_SIZE = 200
+# Members and owners of each group are read from the feeds (two paged
+# urlfetches per group), so tasks exporting groups do much less.
+GROUPS_CHUNK_SIZE = 10
+
+
+def _join(values):
+    return u' '.join([unicode(x) for x in values if x])
+
+
+class _Exporter(object):
+    """Exporters define read(domain, cursor), which returns (list of row
+    dicts, cursor of the next chunk or None) tuple, and row(instance), which
+    returns the row dict of an object. Keys of the row dicts are fields.
+
+    """
+    perm = None
+    fields = ()
+    chunk_size = CHUNK_SIZE
+
+
+class _CacheExporter(_Exporter):
+    model = None
+
+    def read(self, domain, cursor):
+        query = self.model._meta.cache_model.all().filter('_domain', domain)
+        if cursor:
+            query.with_cursor(cursor)
+        cached = query.fetch(self.chunk_size)
+        rows = [self.row(self.model._from_cached(x)) for x in cached]
+        if len(cached) < self.chunk_size:
+            return rows, None
+        return rows, query.cursor()
+
+
+class _UsersExporter(_CacheExporter):
+    model = GAUser
+    perm = 'read_gauser'
+    fields = ('user_name', 'given_name', 'family_name', 'suspended', 'admin',
+              'quota', 'change_password')
+
+    def row(self, user):
+        return dict((field, getattr(user, field)) for field in self.fields)
+
+
+class _GroupsExporter(_CacheExporter):
+    model = GAGroup
+    perm = 'read_gagroup'
+    chunk_size = GROUPS_CHUNK_SIZE
+    fields = ('id', 'name', 'description', 'email_permission', 'members',
+              'owners')
+
+    def row(self, group):
+        return {
+            'id': group.id,
+            'name': group.name,
+            'description': group.description,
+            'email_permission': group.email_permission,
+            'members': _join([member.id for member in group.members]),
+            'owners': _join([owner.email for owner in group.owners]),
+        }
+
+
+class _SharedContactsExporter(_CacheExporter):
+    model = SharedContact
+    perm = 'read_sharedcontact'
+    fields = ('given_name', 'family_name', 'emails', 'phone_numbers',
+              'postal_addresses', 'organization', 'title', 'notes')
+
+    def row(self, contact):
+        name = contact.name
+        organization = contact.organization
+        return {
+            'given_name': name and name.given_name,
+            'family_name': name and name.family_name,
+            'emails': _join([x.address for x in contact.emails]),
+            'phone_numbers': _join([x.number for x in contact.phone_numbers]),
+            'postal_addresses': u'\n'.join(
+                [x.address for x in contact.postal_addresses if x.address]),
+            'organization': organization and organization.name,
+            'title': organization and organization.title,
+            'notes': contact.notes,
+        }
+
+
+class _CalendarResourcesExporter(_Exporter):
+    perm = 'read_calendarresource'
+    fields = ('id', 'common_name', 'type', 'description')
+
+    def read(self, domain, cursor):
+        gen, _, cursor, _ = CalendarResource.all().retrieve_page(cursor)
+        return [self.row(x) for x in gen], cursor and str(cursor) or None
+
+    def row(self, resource):
+        return dict((field, getattr(resource, field))
+                    for field in self.fields)
+
+
+EXPORTERS = {
+    'users': _UsersExporter(),
+    'groups': _GroupsExporter(),
+    'shared-contacts': _SharedContactsExporter(),
+    'calendar-resources': _CalendarResourcesExporter(),
+}
+
+
+def _to_csv(exporter, rows, header):
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(exporter.fields)
+    for row in rows:
+        values = []
+        for field in exporter.fields:
+            value = row.get(field)
+            if value is None:
+                value = u''
+            values.append(unicode(value).encode('utf8'))
+        writer.writerow(values)
+    return out.getvalue()
+
+
+def _to_json(rows, first, after_rows, last):
+    # Chunks make a single JSON array when joined.
+    data = ',\n'.join([simplejson.dumps(row) for row in rows])
+    if data and after_rows:
+        data = ',\n' + data
+    if first:
+        data = '[\n' + data
+    if last:
+        data += '\n]'
+    return data
+
+
+def start_job(kind, format):
+    user = users.get_current_user()
+    old_jobs = ExportJob.all().filter('created_by', user.email()).filter(
+        'kind', kind).fetch(100)
+    for job in old_jobs:
+        db.delete(ExportChunk.all(keys_only=True).filter('job', job).fetch(
+            1000))
+    db.delete(old_jobs)
+
+    job = ExportJob(
+        domain=user.domain_name,
+        created_by=user.email(),
+        kind=kind,
+        format=format,
+    )
+    job.put()
+    taskqueue.add(url=reverse('export-worker'), params={
+        'job': str(job.key()),
+    })
+    return job
+
+
+def export_chunk(job_key):
+    """Writes the next chunk of the job. Returns False when the job is
+    finished.
+
+    """
+    job = ExportJob.get(job_key)
+    if not job or job.is_finished():
+        return False
+    apps_domain = AppsDomain.get_by_key_name(job.domain)
+    users._set_current_user(apps_domain.admin_email, job.domain)
+
+    exporter = EXPORTERS[job.kind]
+    rows, cursor = exporter.read(job.domain, job.cursor)
+    first = not job.chunks
+    if job.format == 'json':
+        data = _to_json(rows, first, job.rows > 0, not cursor)
+    else:
+        data = _to_csv(exporter, rows, first)
+
+    # The chunk is keyed by its number, so it's overwritten if the task is
+    # retried.
+    ExportChunk(
+        key_name='%d:%d' % (job.key().id(), job.chunks),
+        job=job,
+        number=job.chunks,
+        data=data,
+    ).put()
+    job.chunks += 1
+    job.rows += len(rows)
+    job.cursor = cursor
+    if not cursor:
+        job.finished_on = datetime.datetime.now()
+    job.put()
+    return cursor is not None
+
+
+def iter_output(job):
+    """Yields the data of the finished job chunk by chunk."""
+    for start in xrange(0, job.chunks, 20):
+        keys = ['%d:%d' % (job.key().id(), i)
+                for i in xrange(start, min(start + 20, job.chunks))]
+        for chunk in ExportChunk.get_by_key_name(keys):
+            if chunk:
+                yield chunk.data
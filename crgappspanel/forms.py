@@ -10,8 +10,8 @@ from crgappspanel.consts import EMAIL_RELS, PHONE_RELS
 from crgappspanel.helpers import fields, widgets
 from crlib import regexps
 
-__all__ = ('UserForm', 'UserEmailSettingsForm', 'UserEmailFiltersForm',
-           'SharedContactForm', 'CalendarResourceForm')
+__all__ = ('UserForm', 'UserImportForm', 'UserEmailSettingsForm',
+           'UserEmailFiltersForm', 'SharedContactForm', 'CalendarResourceForm')
 
 
 ENABLE = 'e'
@@ -230,6 +230,10 @@ class UserForm(Form):
         return [pass_a, pass_b]
 
 
+class UserImportForm(forms.Form):
+    file = forms.FileField(label=_('CSV file'))
+
+
 roles_c = _('%(link_start)sAdd role%(link_end)s')
 roles_e = _('Choose role:<br/>%(widget)s %(link_start)sCancel%(link_end)s')
 
@@ -1,3 +1,6 @@
+from crlib import search
+
+
 __all__ = ('NullFilter', 'AnyAttributeFilter', 'AllAttributeFilter')
 
 class NullFilter(object):
@@ -12,50 +15,48 @@ class NullFilter(object):
         return 'filter:true'
 
 
+def _walk(obj, path):
+    """Yields values of the attribute path (list of names) of obj, lists
+    being flattened.
+
+    """
+    if not path:
+        if isinstance(obj, (list, tuple)):
+            for x in obj:
+                yield x
+        else:
+            yield unicode(obj)
+        return
+    value = getattr(obj, path[0], None)
+    if value is None:
+        return
+    if not isinstance(value, (list, tuple)):
+        value = (value,)
+    for x in value:
+        for y in _walk(x, path[1:]):
+            yield y
+
+
 class AttributeFilter(object):
+    """query maps attribute paths (e.g. 'name.full_name') to the searched
+    texts. The paths are split and the texts lowercased once, match() only
+    walks the attributes of the checked objects.
+
+    """
     def __init__(self, query):
         self.query = query
+        self._compiled = [(key.split('.'), value.lower())
+                          for key, value in query.iteritems()]
     
     def generate(self, obj):
-        for key, value in self.query.iteritems():
-            values = AttributeFilter.get_values(obj, key)
-            yield any(value.lower() in v.lower() for v in values)
+        for path, value in self._compiled:
+            yield any(value in v.lower() for v in _walk(obj, path))
     
     @staticmethod
     def get_values(obj, attr):
-        # attribute is None
         if attr is None:
-            if isinstance(obj, (list, tuple)):
-                return list(obj)
-            else:
-                return [unicode(obj)]
-        
-        # object is None
-        if obj is None:
-            return []
-        
-        # checking if attribute is composite attribute
-        idx = attr.find('.')
-        if idx != -1:
-            rest = attr[idx+1:]
-            attr = attr[:idx]
-        else:
-            rest = None
-        
-        try:
-            obj = getattr(obj, attr)
-            if obj is None:
-                return []
-            
-            res = []
-            if isinstance(obj, (list, tuple)):
-                for x in obj:
-                    res.extend(AttributeFilter.get_values(x, rest))
-            else:
-                res.extend(AttributeFilter.get_values(obj, rest))
-            return res
-        except:
-            return []
+            return list(_walk(obj, []))
+        return list(_walk(obj, attr.split('.')))
     
     def __repr__(self):
         entries = ('%s:%s' % (key, value) for key, value in self.query.iteritems())
@@ -99,18 +100,69 @@ class SharedContactFilter(AnyAttributeFilter):
 
 
 class SharedContactAdvancedFilter(AllAttributeFilter):
-    def __init__(self, attrs, query_company, query_role):
-        super(AllAttributeFilter, self).__init__(attrs)
-        self.query_company = query_company
-        self.query_role = query_role
-    
-    def match(self, obj):
-        if not AllAttributeFilter.match(self, obj):
-            return False
-        
-        for ep_name, ep_search in (('company', self.query_company), ('role', self.query_role)):
-            if ep_search:
-                value = obj.extended_properties.get(ep_name, '')
-                if not ep_search.lower() in value.lower():
+    """Advanced search of shared contacts. fields maps names of the search
+    form fields to the searched text.
+
+    match() checks SharedContact objects, while terms() and match_row() let
+    crlib.search.SearchQuery run the search on SharedContactCache rows: words
+    of the indexed fields are looked up in search_index by the datastore, and
+    only the rows found are checked by match_row(). Each word of a field has
+    to match the beginning of a word of the contact's field.
+
+    """
+    ATTRS = {
+        'name': 'name.full_name',
+        'company': 'organization.name',
+        'role': 'organization.title',
+        'notes': 'notes',
+        'email': 'emails.address',
+        'phone': 'phone_numbers.number',
+    }
+    CACHE_FIELDS = {
+        'name': 'name',
+        'company': 'organization',
+        'role': 'role',
+        'notes': 'notes',
+        'email': 'emails',
+        'phone': 'phone_numbers',
+    }
+    # notes are too long to be in search_index
+    INDEXED = ('name', 'company', 'role', 'email', 'phone')
+
+    def __init__(self, fields):
+        self.fields = dict((field, value)
+                           for field, value in fields.iteritems()
+                           if value and field in self.ATTRS)
+        super(AllAttributeFilter, self).__init__(dict(
+            (self.ATTRS[field], value)
+            for field, value in self.fields.iteritems()))
+        self._field_terms = [
+            (self.CACHE_FIELDS[field], search.query_terms(value))
+            for field, value in self.fields.iteritems()]
+
+    def terms(self):
+        result = []
+        for field in self.INDEXED:
+            for term in search.query_terms(self.fields.get(field, '')):
+                if term not in result:
+                    result.append(term)
+        return result
+
+    def match_row(self, row):
+        for prop, terms in self._field_terms:
+            tokens = search.field_tokens(row, prop)
+            for term in terms:
+                for token in tokens:
+                    if token.startswith(term):
+                        break
+                else:
                     return False
         return True
+
+    def key(self):
+        return u'&'.join([u'%s=%s' % item for item in sorted(
+            self.fields.iteritems())])
+
+    def __unicode__(self):
+        return u', '.join([u'%s: %s' % item for item in sorted(
+            self.fields.iteritems())])
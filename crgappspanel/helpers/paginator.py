@@ -1,7 +1,7 @@
 import hashlib
 import logging
 import urllib
-from google.appengine.api import memcache
+from crlib import memcache_batch
 
 
 HASH_LEN = 12
@@ -32,7 +32,8 @@ class Paginator(object):
 
         self.start = self.params.get('start')
         if self.start:
-            current_cursor = memcache.get('users:' + self.start)
+            memcache_batch.want(['users_prev:' + self.start])
+            current_cursor = memcache_batch.get('users:' + self.start)
             if current_cursor:
                 self.query.with_cursor(current_cursor)
             self.page = int(self.params.get('page', 0))
@@ -60,9 +61,9 @@ class Paginator(object):
     def next_link(self):
         if self.has_more():
             hashed = hashlib.sha1(self.cursor).hexdigest()[:HASH_LEN]
-            memcache.set('users:' + hashed, self.cursor)
+            memcache_batch.set('users:' + hashed, self.cursor)
             if self.start:
-                memcache.set('users_prev:' + hashed, self.start)
+                memcache_batch.set('users_prev:' + hashed, self.start)
 
             params = dict(self.params.iteritems())
             params['start'] = hashed
@@ -75,7 +76,7 @@ class Paginator(object):
             params = dict(self.params.iteritems())
             params.pop('start', None)
 
-            prev_start = memcache.get('users_prev:' + self.start)
+            prev_start = memcache_batch.get('users_prev:' + self.start)
             if prev_start:
                 params['start'] = prev_start
             params['page'] = self.page - 1
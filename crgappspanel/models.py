@@ -51,6 +51,56 @@ def gauser_renamed_callback(sender, **kwargs):
 gauser_renamed.connect(gauser_renamed_callback)
 
 
+class UserImportJob(BaseModel):
+    """Import of users from a CSV file, see crgappspanel.user_import."""
+    domain = db.StringProperty()
+    created_by = db.StringProperty()
+    created_on = db.DateTimeProperty(auto_now_add=True)
+    finished_on = db.DateTimeProperty()
+    # pickled list of valid rows
+    rows = db.BlobProperty()
+    total = db.IntegerProperty(default=0)
+    # first rows of the recorded batches, see user_import.process_batch
+    recorded = db.ListProperty(int)
+    processed = db.IntegerProperty(default=0)
+    created = db.IntegerProperty(default=0)
+    failed = db.IntegerProperty(default=0)
+    invalid = db.IntegerProperty(default=0)
+    errors = db.StringListProperty(indexed=False)
+
+    def is_finished(self):
+        return self.finished_on is not None
+
+    def progress(self):
+        if not self.total:
+            return 100
+        return 100 * self.processed / self.total
+
+
+class ExportJob(BaseModel):
+    """Export of the objects of a domain, see crgappspanel.export."""
+    domain = db.StringProperty()
+    created_by = db.StringProperty()
+    created_on = db.DateTimeProperty(auto_now_add=True)
+    finished_on = db.DateTimeProperty()
+    kind = db.StringProperty()
+    format = db.StringProperty(choices=('csv', 'json'))
+    # datastore or GData cursor of the next chunk
+    cursor = db.TextProperty()
+    chunks = db.IntegerProperty(default=0)
+    rows = db.IntegerProperty(default=0)
+
+    def is_finished(self):
+        return self.finished_on is not None
+
+
+class ExportChunk(BaseModel):
+    # key_name is job_id:number
+    job = db.ReferenceProperty(ExportJob, collection_name='chunk_set')
+    number = db.IntegerProperty()
+    data = db.BlobProperty()
+
+
 # GData pseudo-models
 
 class GAUser(gd.Model):
@@ -94,6 +144,11 @@ class GAUser(gd.Model):
     def get_full_name(self):
         return '%s %s' % (self.given_name, self.family_name)
 
+    def delete(self):
+        super(GAUser, self).delete()
+        users.forget_user('%s@%s' % (
+            self.user_name, users.get_current_user().domain_name))
+
 
 class GAGroupMember(gd.Model):
     Mapper = mappers.MemberEntryMapper()
@@ -175,12 +230,11 @@ class GAGroup(gd.Model):
 
     @classmethod
     def add_user_to_groups(cls, user, group_ids):
-        groups = GAGroup.all().fetch(1000)
         member = GAGroupMember.from_user(user)
-        for group in groups:
-            if group.id in group_ids and not member in group.members:
-                group.members.append(member)
-                group.save()
+        try:
+            cls._mapper.add_member_to_groups(member.id, group_ids)
+        finally:
+            cls._cache.invalidate()
     
     def get_pure_id(self):
         return self.id.partition('@')[0]
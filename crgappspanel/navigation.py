@@ -1,9 +1,15 @@
 from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse
-from crlib.navigation import Section, _get_section
+from crlib.navigation import Section, _get_section, cached_navigation
 from crauth import users
 
 
+def _user_key(request):
+    user = users.get_current_user()
+    return user and (user.domain_name, user.is_admin())
+
+
+@cached_navigation(_user_key)
 def base(request):
     nav = (
         Section('dashboard', _('Dashboard'), reverse('dashboard')),
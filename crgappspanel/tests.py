@@ -509,3 +509,62 @@ class CalendarResourceAPITestCase(BaseGDataTestCase):
         self.assertNotEqual(resource, None)
         self.assertEqual(resource.description, None)
 
+
+class UserImportTestCase(unittest.TestCase):
+    def testParseCsv(self):
+        from crgappspanel import user_import
+        rows, messages = user_import.parse_csv(
+            'user_name,given_name,family_name,password,nicknames\n'
+            'jdoe,John,Doe,secret12,johnny jd\n'
+            'jdoe2,,Doe,secret12,\n'
+            'johnny,Johnny,Doe,secret12,\n')
+        self.assertEqual([row['user_name'] for row in rows], ['jdoe'])
+        self.assertEqual(rows[0]['nicknames'], ['johnny', 'jd'])
+        self.assertEqual(len(messages), 2)
+
+    def testMissingColumns(self):
+        from crgappspanel import user_import
+        rows, messages = user_import.parse_csv('user_name,password\n')
+        self.assertEqual(rows, [])
+        self.assertEqual(len(messages), 1)
+
+    def testBatchIsRecordedOnce(self):
+        from crgappspanel import user_import
+        job = UserImportJob(domain=TEST_DOMAIN, rows='rows', total=25)
+        job.put()
+        for i in xrange(2):
+            user_import._record_batch(job.key(), 0, 20, 1, [u'error'])
+        job = UserImportJob.get(job.key())
+        self.assertEqual((job.processed, job.created), (20, 19))
+        self.assertFalse(job.is_finished())
+        user_import._record_batch(job.key(), 20, 5, 0, [])
+        job = UserImportJob.get(job.key())
+        self.assertTrue(job.is_finished())
+        self.assertEqual(job.rows, None)
+
+
+class SharedContactAdvancedFilterTestCase(unittest.TestCase):
+    class Row(object):
+        name = u'smith john'
+        organization = u'acme corp'
+        role = u'chief engineer'
+        notes = [u'met', u'in', u'london']
+        emails = [u'john@acme.com']
+        phone_numbers = [u'']
+
+    def testTerms(self):
+        from crgappspanel.helpers.filters import SharedContactAdvancedFilter
+        row_filter = SharedContactAdvancedFilter({
+            'company': 'Acme', 'role': 'eng', 'notes': 'london', 'phone': ''})
+        self.assertEqual(row_filter.terms(), [u'acme', u'eng'])
+
+    def testMatchRow(self):
+        from crgappspanel.helpers.filters import SharedContactAdvancedFilter
+        row = self.Row()
+        for fields in ({'company': 'acme'}, {'role': 'Chief Eng'},
+                       {'name': 'john', 'notes': 'lon'}):
+            self.assertTrue(SharedContactAdvancedFilter(fields).match_row(row))
+        for fields in ({'company': 'corp acme inc'}, {'role': 'gineer'},
+                       {'name': 'john', 'email': 'mark'}):
+            self.assertFalse(
+                SharedContactAdvancedFilter(fields).match_row(row))
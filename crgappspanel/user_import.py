@@ -0,0 +1,322 @@
+"""Bulk import of users from CSV files.
+
+The first row of the file names the columns. user_name, given_name,
+family_name and password are required, nicknames and groups are optional
+space separated lists. Rows are validated with UserForm when the file is
+uploaded and the valid ones are stored in a UserImportJob. They are created
+by WORKERS chains of tasks, each taking BATCH_SIZE rows at a time and sending
+their GData requests concurrently.
+
+Each task is named after the first row of its batch, so a task which dies
+(e.g. on DeadlineExceededError) is retried with the same rows, and a batch
+is recorded in the job only once.
+
+"""
+import csv
+import datetime
+import hashlib
+import logging
+import pickle
+from google.appengine.ext import db
+from google.appengine.api.labs import taskqueue
+from django.core.urlresolvers import reverse
+from django.utils.translation import ugettext as _, ugettext_noop
+from crauth import users
+from crauth.models import AppsDomain
+from crgappspanel.forms import UserForm
+from crgappspanel.models import GAUser, GANickname, GAGroup, UserImportJob
+from crlib import errors, regexps
+from crlib.cache import NICKNAME_KEY_NAME
+from crlib.models import NicknameCache
+from crlib.parallel_urlfetch import ParallelRequests
+
+
+__all__ = ['parse_csv', 'start_job', 'process_batch']
+
+
+REQUIRED_COLUMNS = ('user_name', 'given_name', 'family_name', 'password')
+MAX_ROWS = 5000
+BATCH_SIZE = 20
+WORKERS = 4
+# at most this many error messages are kept in the job
+MAX_ERRORS = 500
+
+
+def _form_errors(form):
+    messages = []
+    for field, field_errors in form.errors.items():
+        messages.append(u'%s: %s' % (
+            field, u' '.join([unicode(x) for x in field_errors])))
+    return u'; '.join(messages)
+
+
+def _validate(row, seen):
+    """Returns (cleaned row, None) or (None, error message)."""
+    password = row.get('password', '')
+    form = UserForm({
+        'user_name': row.get('user_name', ''),
+        'password_0': password,
+        'password_1': password,
+        'full_name_0': row.get('given_name', ''),
+        'full_name_1': row.get('family_name', ''),
+        'nicknames': '',
+    })
+    if not form.is_valid():
+        return None, _form_errors(form)
+    data = form.cleaned_data
+    if not data['password'] or not data['password'][0]:
+        return None, _('Password is required.')
+
+    nicknames = row.get('nicknames', '').split()
+    for nickname in nicknames:
+        if not regexps.RE_USERNAME.match(nickname):
+            return None, u'%s: %s' % (
+                nickname, unicode(regexps.ERROR_NICKNAME))
+    names = [data['user_name']] + nicknames
+    for name in names:
+        if name.lower() in seen:
+            return None, _('%s is used more than once.') % name
+    for name in names:
+        seen[name.lower()] = True
+
+    return {
+        'user_name': data['user_name'],
+        'given_name': data['full_name'][0],
+        'family_name': data['full_name'][1],
+        'password': hashlib.sha1(
+            data['password'][0].encode('utf8')).hexdigest(),
+        'nicknames': nicknames,
+        'groups': row.get('groups', '').split(),
+    }, None
+
+
+def parse_csv(data):
+    """Returns (rows, errors) tuple, rows being the valid rows."""
+    reader = csv.reader(data.splitlines())
+    try:
+        header = [x.strip().lower() for x in reader.next()]
+    except (StopIteration, csv.Error):
+        return [], [_('The file is empty.')]
+    missing = [x for x in REQUIRED_COLUMNS if x not in header]
+    if missing:
+        return [], [_('Missing columns: %s.') % ', '.join(missing)]
+
+    rows, messages, seen = [], [], {}
+    try:
+        for values in reader:
+            if not [x for x in values if x.strip()]:
+                continue
+            if len(rows) >= MAX_ROWS:
+                messages.append(_('Only %d users can be imported at once.') %
+                                MAX_ROWS)
+                break
+            row = dict(zip(header, [x.decode('utf8').strip()
+                                    for x in values]))
+            cleaned, error = _validate(row, seen)
+            if error:
+                messages.append(_('Line %(line)d: %(error)s') % {
+                    'line': reader.line_num, 'error': error})
+            else:
+                rows.append(cleaned)
+    except (csv.Error, UnicodeDecodeError), e:
+        messages.append(_('Line %(line)d: %(error)s') % {
+            'line': reader.line_num, 'error': e})
+    return rows, messages
+
+
+def start_job(rows, messages):
+    user = users.get_current_user()
+    job = UserImportJob(
+        domain=user.domain_name,
+        created_by=user.email(),
+        rows=pickle.dumps(rows, pickle.HIGHEST_PROTOCOL),
+        total=len(rows),
+        invalid=len(messages),
+        errors=[unicode(x) for x in messages[:MAX_ERRORS]],
+    )
+    if not rows:
+        job.finished_on = datetime.datetime.now()
+    job.put()
+    for start in xrange(0, min(WORKERS * BATCH_SIZE, len(rows)), BATCH_SIZE):
+        _add_task(job.key(), start)
+    return job
+
+
+def _add_task(job_key, start):
+    try:
+        taskqueue.add(
+            name='users-import-%d-%d' % (job_key.id(), start),
+            url=reverse('users-import-worker'),
+            params={'job': str(job_key), 'start': start})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # added by an earlier run of the task which is being retried
+        pass
+
+
+_ERROR_MESSAGES = (
+    (errors.EntityExistsError, ugettext_noop(
+        'Either user or nick with this name already exists.')),
+    (errors.EntityDeletedRecentlyError, ugettext_noop(
+        'User with such name was recently deleted and this name cannot be '
+        'currently used.')),
+    (errors.DomainUserLimitExceededError, ugettext_noop(
+        'Your domain user limit has been reached, you cannot create more '
+        'users.')),
+    (errors.NetworkError, ugettext_noop(
+        'An error occured during the request. Please try again.')),
+)
+
+
+def _error_message(name, error):
+    for error_class, message in _ERROR_MESSAGES:
+        if isinstance(error, error_class):
+            return u'%s: %s' % (name, _(message))
+    return u'%s: %s' % (name, unicode(error) or error.__class__.__name__)
+
+
+def _create_users(rows, retried):
+    """Returns (created users, error messages) tuple. Users which exist
+    already are counted as created if retried is True, as they were most
+    probably created by the previous run of the task.
+
+    """
+    requests = ParallelRequests(GAUser._mapper.service)
+    for row in rows:
+        requests.add(row['user_name'], 'CreateUser', row['user_name'],
+                     row['family_name'], row['given_name'], row['password'],
+                     password_hash_function='SHA-1')
+    failed = dict((name, error) for name, error in requests.run()
+                  if not (retried and
+                          isinstance(error, errors.EntityExistsError)))
+
+    created = []
+    for row in rows:
+        if row['user_name'] in failed:
+            continue
+        user = GAUser(
+            user_name=row['user_name'],
+            given_name=row['given_name'],
+            family_name=row['family_name'])
+        user._atom = user._get_updated_atom()
+        created.append(user)
+    messages = [_error_message(name, error)
+                for name, error in failed.iteritems()]
+    if created:
+        # The users exist, the precache adds them if this fails.
+        try:
+            GAUser._create_caches(created)
+        except Exception, e:
+            logging.exception('Caching of imported users failed.')
+            messages.append(_error_message(_('Cache'), e))
+        GAUser._cache.invalidate()
+    return created, messages
+
+
+def _create_nicknames(rows, domain, retried):
+    requests = ParallelRequests(GANickname._mapper.service)
+    for row in rows:
+        for nickname in row['nicknames']:
+            requests.add(nickname, 'CreateNickname', row['user_name'],
+                         nickname)
+    if not len(requests):
+        return []
+    failed = dict((name, error) for name, error in requests.run()
+                  if not (retried and
+                          isinstance(error, errors.EntityExistsError)))
+
+    cached = []
+    for row in rows:
+        for name in row['nicknames']:
+            if name in failed:
+                continue
+            nickname = GANickname(nickname=name, user=row['user_name'],
+                                  user_name=row['user_name'])
+            nickname._atom = nickname._get_updated_atom()
+            cached.append(NicknameCache.from_model(
+                nickname,
+                key_name=NICKNAME_KEY_NAME % (domain, name),
+                _atom=nickname._atom,
+                _gdata_key_name=name,
+                _domain=domain,
+            ))
+    db.put(cached)
+    GANickname._cache.invalidate()
+    return [_error_message(name, error) for name, error in failed.iteritems()]
+
+
+def _add_to_groups(rows, domain, retried):
+    requests = ParallelRequests(GAGroup._mapper.service)
+    for row in rows:
+        member_id = '%s@%s' % (row['user_name'], domain)
+        for group_id in row['groups']:
+            requests.add('%s (%s)' % (row['user_name'], group_id),
+                         'AddMemberToGroup', member_id, group_id)
+    if not len(requests):
+        return []
+    failed = [(name, error) for name, error in requests.run()
+              if not isinstance(error, errors.EntityExistsError)]
+    GAGroup._cache.invalidate()
+    return [_error_message(name, error) for name, error in failed]
+
+
+def _record_batch(job_key, start, processed, failed, messages):
+    job = UserImportJob.get(job_key)
+    if start in job.recorded:
+        return
+    job.recorded.append(start)
+    job.processed += processed
+    job.created += processed - failed
+    job.failed += failed
+    room = max(MAX_ERRORS - len(job.errors), 0)
+    job.errors.extend(messages[:room])
+    if job.processed >= job.total and not job.finished_on:
+        job.finished_on = datetime.datetime.now()
+        # password hashes aren't kept longer than needed
+        job.rows = None
+    job.put()
+
+
+def process_batch(job_key, start, retried=False):
+    """Creates the batch of users of the job starting at the given row,
+    unless it's recorded already, and adds the task of the next batch of
+    the chain. retried tells if the task is being retried.
+
+    """
+    job = UserImportJob.get(job_key)
+    if not job or job.is_finished():
+        return
+    if start not in job.recorded:
+        rows = pickle.loads(job.rows)[start:start + BATCH_SIZE]
+        apps_domain = AppsDomain.get_by_key_name(job.domain)
+        users._set_current_user(apps_domain.admin_email, job.domain)
+        created, messages = _process_rows(rows, job.domain, retried)
+        db.run_in_transaction(_record_batch, job_key, start, len(rows),
+                              len(rows) - len(created), messages)
+    next_start = start + WORKERS * BATCH_SIZE
+    if next_start < job.total:
+        _add_task(job.key(), next_start)
+
+
+def _process_rows(rows, domain, retried):
+    """Returns (created users, error messages) tuple. Users which were
+    created are counted as such even if their nicknames or groups failed.
+
+    """
+    try:
+        created, messages = _create_users(rows, retried)
+    except Exception, e:
+        logging.exception('Import of users failed.')
+        created = []
+        messages = [_error_message(row['user_name'], e) for row in rows]
+    names = dict.fromkeys([user.user_name for user in created])
+    rows_created = [row for row in rows if row['user_name'] in names]
+    for step, column in ((_create_nicknames, 'nicknames'),
+                         (_add_to_groups, 'groups')):
+        try:
+            messages += step(rows_created, domain, retried)
+        except Exception, e:
+            logging.exception('Import of %s failed.' % column)
+            messages += [
+                _error_message(u'%s (%s)' % (row['user_name'], column), e)
+                for row in rows_created if row[column]]
+    return created, messages
@@ -0,0 +1,68 @@
+from google.appengine.api.labs import taskqueue
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, Http404
+from django.shortcuts import redirect
+from crauth import users
+from crauth.decorators import login_required
+from crgappspanel import export as exports
+from crgappspanel.models import ExportJob
+from crlib.navigation import render_with_nav
+
+
+_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'json': 'application/json; charset=utf-8',
+}
+
+
+def _get_job(id):
+    job = ExportJob.get_by_id(int(id))
+    if not job or job.created_by != users.get_current_user().email():
+        raise Http404
+    return job
+
+
+@login_required
+def export(request, kind=None):
+    exporter = exports.EXPORTERS.get(kind)
+    if not exporter:
+        raise Http404
+    if not users.get_current_user().has_perm(exporter.perm):
+        return render_with_nav(request, 'not_authorized.html')
+    if request.method == 'POST':
+        format = request.POST.get('format')
+        if format not in _CONTENT_TYPES:
+            format = 'csv'
+        job = exports.start_job(kind, format)
+        return redirect('export-status', id=job.key().id())
+    return render_with_nav(request, 'export.html', {
+        'kind': kind,
+    })
+
+
+@login_required
+def export_status(request, id=None):
+    return render_with_nav(request, 'export.html', {
+        'job': _get_job(id),
+    })
+
+
+@login_required
+def export_download(request, id=None):
+    job = _get_job(id)
+    if not job.is_finished():
+        raise Http404
+    response = HttpResponse(exports.iter_output(job),
+                            mimetype=_CONTENT_TYPES[job.format])
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+        job.kind, job.format)
+    return response
+
+
+def export_worker(request):
+    job_key = request.POST['job']
+    if exports.export_chunk(job_key):
+        taskqueue.add(url=reverse('export-worker'), params={
+            'job': job_key,
+        })
+    return HttpResponse('ok')
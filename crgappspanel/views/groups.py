@@ -25,6 +25,18 @@ _table_id = Column(None, 'id', getter=lambda x: x.id.partition('@')[0])
 _table_widths = ['%d%%' % x for x in (5, 40, 40, 15)]
 
 
+def _save_members(request, group):
+    """Saves the group, reporting members which couldn't be updated."""
+    try:
+        group.save()
+        return True
+    except errors.MembershipUpdateError, e:
+        request.notifications.error(
+            _('The following members could not be updated: %s') %
+            ', '.join(e.emails()))
+        return False
+
+
 @has_perm('read_gagroup')
 def groups(request):
     user = users.get_current_user()
@@ -134,8 +146,7 @@ def group_members(request, name=None):
                 group.members.append(GAGroupMember(id=member).save())
                 modified = True
             
-            if modified:
-                group.save()
+            if modified and _save_members(request, group):
                 return redirect_saved('group-members',
                     request, name=group.get_pure_id())
             else:
@@ -213,7 +224,8 @@ def group_remove_owner(request, name=None, owner=None):
     
     group.owners = [own for own in group.owners if own.email != owner]
     group.members = [mbm for mbm in group.members if mbm.id != owner]
-    group.save()
+    if not _save_members(request, group):
+        return redirect('group-members', name=group.get_pure_id())
     
     return redirect_saved('group-members', request, name=group.get_pure_id())
 
@@ -229,6 +241,7 @@ def group_remove_member(request, name=None, member=None):
         return redirect('groups')
     
     group.members = [mem for mem in group.members if mem.id != member]
-    group.save()
+    if not _save_members(request, group):
+        return redirect('group-members', name=group.get_pure_id())
     
     return redirect_saved('group-members', request, name=group.get_pure_id())
@@ -2,7 +2,7 @@ from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
 from django.utils.translation import ugettext_lazy as _
 from crauth.decorators import has_perm
-from crauth.models import Role, UserPermissions
+from crauth.models import Role, UserPermissions, permissions_changed
 from crauth import users
 from crgappspanel.forms import RoleForm
 from crgappspanel.helpers.misc import ValueWithRemoveLink
@@ -127,5 +127,6 @@ def role_remove(request, names=None):
 
     db.delete(to_delete)
     db.put(to_save)
+    permissions_changed(users.get_current_user().domain_name)
     
     return redirect_saved('roles', request)
@@ -13,6 +13,7 @@ from crgappspanel.models import Preferences, SharedContact, Organization
 from crgappspanel.views.utils import get_sortby_asc, list_attrs, \
         get_page, qs_wo_page, redirect_saved, QueryString, QuerySearch, render
 from crlib.navigation import render_with_nav
+from crlib.search import SearchQuery
 from crlib import errors
 
 
@@ -60,15 +61,16 @@ def shared_contacts(request):
     user = users.get_current_user()
 
     query = request.GET.get('q', '')
-    if query:
-        query = query.lower().split()[0]
+    advanced = dict((field, request.GET.get(field, ''))
+                    for field in SharedContactAdvancedFilter.ATTRS)
+    advanced_filter = SharedContactAdvancedFilter(advanced)
+    if advanced_filter.fields:
         def query_gen():
-            q = SharedContact.all()
-            # This doesn't work as expected on development server, but is OK
-            # on GAE instance.
-            q.filter('search_index >=', query).filter(
-                'search_index <', query + u'\ufffd')
-            return q
+            return SearchQuery(SharedContact, row_filter=advanced_filter,
+                               order_by='name')
+    elif query:
+        def query_gen():
+            return SearchQuery(SharedContact, query)
     else:
         query_gen = None
 
@@ -90,7 +92,10 @@ def shared_contacts(request):
             delete_link_title=delete_link_title,
             details_link=details_link,
             can_change=user.has_perm('change_sharedcontact')),
-        'query': dict(general=query),
+        'query': dict(general=query, advanced=advanced),
+        'advanced_search': bool(advanced_filter.fields),
+        'filters': advanced_filter.fields and [unicode(advanced_filter)] or [],
+        'truncated': query_gen and paginator.query.truncated(),
         'saved': request.session.pop('saved', False),
         'delete_question': _('Are you sure you want to delete selected '
                              'shared contacts?'),
@@ -9,7 +9,7 @@ from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
 from django.utils.translation import ugettext_lazy as _
 from django.utils.safestring import mark_safe
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 
 import crauth
 from crauth.decorators import login_required, admin_required, has_perm
@@ -17,15 +17,17 @@ from crauth.models import Role, UserPermissions
 from crgappspanel import consts
 from crgappspanel.forms import UserForm, UserRolesForm, UserGroupsForm, \
     UserEmailSettingsForm, UserEmailFiltersForm, UserEmailAliasesForm, \
-    UserEmailVacationForm
+    UserEmailVacationForm, UserImportForm
 from crgappspanel.helpers.misc import ValueWithRemoveLink
 from crgappspanel.helpers.tables import Table, Column
 from crgappspanel.helpers.paginator import Paginator
 from crgappspanel.models import Preferences, GAUser, GANickname, GAGroup, \
-        GAGroupOwner, GAGroupMember
+        GAGroupOwner, GAGroupMember, UserImportJob
+from crgappspanel import user_import
 from crgappspanel.views.utils import get_sortby_asc, get_page, qs_wo_page, \
         secure_random_chars, redirect_saved, render
 from crlib.navigation import render_with_nav
+from crlib.search import SearchQuery
 from crlib import errors
 from crgappspanel.navigation import user_nav
 
@@ -125,14 +127,8 @@ def users(request):
 
     query = request.GET.get('q', '')
     if query:
-        query = query.lower().split()[0]
         def query_gen():
-            q = GAUser.all()
-            # This doesn't work as expected on development server, but is OK
-            # on GAE instance.
-            q.filter('search_index >=', query).filter(
-                'search_index <', query + u'\ufffd')
-            return q
+            return SearchQuery(GAUser, query)
     else:
         query_gen = None
     
@@ -211,6 +207,40 @@ def user_create(request):
     }, in_section='users/users', help_url='users/create')
 
 
+@has_perm('add_gauser')
+def users_import(request):
+    if request.method == 'POST':
+        form = UserImportForm(request.POST, request.FILES, auto_id=True)
+        if form.is_valid():
+            rows, messages = user_import.parse_csv(
+                form.cleaned_data['file'].read())
+            job = user_import.start_job(rows, messages)
+            return redirect('users-import-status', id=job.key().id())
+    else:
+        form = UserImportForm(auto_id=True)
+    return render_with_nav(request, 'users_import.html', {
+        'form': form,
+    }, in_section='users/users', help_url='users/import')
+
+
+@has_perm('add_gauser')
+def users_import_status(request, id=None):
+    job = UserImportJob.get_by_id(int(id))
+    domain = crauth.users.get_current_user().domain_name
+    if not job or job.domain != domain:
+        raise Http404
+    return render_with_nav(request, 'users_import.html', {
+        'job': job,
+    }, in_section='users/users', help_url='users/import')
+
+
+def users_import_worker(request):
+    retried = int(request.META.get('HTTP_X_APPENGINE_TASKRETRYCOUNT', 0)) > 0
+    user_import.process_batch(
+        request.POST['job'], int(request.POST['start']), retried)
+    return HttpResponse('ok')
+
+
 @has_perm('change_gauser')
 def user_details(request, name=None):
     if not name:
@@ -2,11 +2,13 @@ import datetime
 import hashlib
 import logging
 import pickle
+import time
 from google.appengine.ext import db
 from google.appengine.api import memcache
 from google.appengine.api.labs import taskqueue
 from django.core.urlresolvers import reverse
-from crlib.models import GDataIndex
+from crlib.models import GDataIndex, PrecacheShard
+from crlib import errors, scheduler, memcache_batch
 from crauth.models import AppsDomain
 from crauth import users
 from crauth.signals import domain_setup_signal
@@ -33,9 +35,23 @@ def register(cls):
     _MODELS_DICT[cls.__name__] = cls
 
 
+# First GDataIndex pages known to exist, by key name. The pages are never
+# deleted, so they're remembered for the life of the process, and in
+# memcache for the other instances.
+_known_indexes = {}
+KNOWN_INDEX_MEMCACHE_KEY = 'index_exists:%s'
+KNOWN_INDEX_CACHE_TIME = 24 * 60 * 60
+
+
 def ensure_has_cache(domain, model_class):
     if model_class in _MODELS_DICT:
         key_name = '%s:%s' % (domain, model_class)
+        if key_name in _known_indexes:
+            return
+        memcache_key = KNOWN_INDEX_MEMCACHE_KEY % key_name
+        if memcache_batch.get(memcache_key):
+            _known_indexes[key_name] = True
+            return
         index = GDataIndex.get_by_key_name(key_name)
         if not index:
             index = GDataIndex(
@@ -48,6 +64,8 @@ def ensure_has_cache(domain, model_class):
             taskqueue.add(url=reverse('precache_domain_item'), params={
                 'key_name': key_name,
             })
+        _known_indexes[key_name] = True
+        memcache_batch.set(memcache_key, True, KNOWN_INDEX_CACHE_TIME)
 
 
 def ensure_has_full_cache(sender, **kwargs):
@@ -68,70 +86,27 @@ def prepare_indexes(domain):
         )
 
 
-class _CacheUpdater(object):
-    def __init__(self, items_dict, cache_model, model_class, domain, index):
-        self.items_dict = items_dict
-        self.cache_model = cache_model
-        self.model_class = model_class
-        self.domain = domain
-        self.index = index
-
-    def add(self, hashes):
-        created = []
-        for hsh in hashes:
-            created.append(self.create(hsh))
-        db.put(created)
-
-    def create(self, hsh):
-        item = self.items_dict[hsh]
-        return self.cache_model.from_model(
-            item,
-            key_name=hsh,
-            _domain=self.domain,
-            _atom=item._atom,
-            _index=self.index,
-            _gdata_key_name=item.key(),
-        )
-
-    def get(self, hashes):
-        return self.cache_model.get_by_key_name(hashes)
-
-    def delete(self, hashes):
-        to_delete = [x for x in self.cache_model.get_by_key_name(hashes) if x]
-        db.delete(to_delete)
-
-
 DEFAULT_KEY_NAME = 'red.lab.cloudreach.co.uk:SharedContact'
 
-def update_cache(post_data):
-    key_name = post_data.get('key_name', DEFAULT_KEY_NAME)
-    page = int(post_data.get('page', 0))
-
-    if page:
-        key_name += ':%s' % page
-
-    if not memcache.add('lock:' + key_name, True, 60):
-        return
 
-    cursor = post_data.get('cursor')
-    prev_hashes = post_data.get('hashes', []) or []
-    if prev_hashes:
-        prev_hashes = prev_hashes.split(':')
+def _item_hash(item):
+    if isinstance(item._atom, dict):
+        value = _serialize_dict(item._atom)
+    else:
+        value = str(item._atom)
+    return hashlib.sha1(value).hexdigest()
 
-    domain, model = post_data.get(
-        'key_name', DEFAULT_KEY_NAME).split(':')
 
-    index = GDataIndex.get_or_insert(
-        key_name=key_name,
-        domain=domain,
-        model_class=model,
-    )
+def _prepare_domain(domain, model, index):
+    """Sets up the admin of the domain as current user. Returns the model
+    class to be cached, or None if the cache shouldn't be updated.
 
+    """
     apps_domain = AppsDomain.get_by_key_name(domain)
     users._set_current_user(apps_domain.admin_email, domain)
 
     if not apps_domain.is_active():
-        return
+        return None
 
     if not users.is_current_user_admin():
         if not memcache.get('invalid_credentials:%s' % domain):
@@ -142,153 +117,576 @@ def update_cache(post_data):
                 'Invalid credentials for %s domain' % domain,
                 'The credentials for %s domain are invalid.' % domain)
             memcache.set('invalid_credentials:%s' % domain, True, 6 * 60 * 60)
-        return
+        return None
 
     model_class = _MODELS_DICT.get(model)
     if not model_class or (hasattr(model_class._meta, 'no_auto_cache') and
                            model_class._meta.no_auto_cache):
+        return None
+    return model_class
+
+
+def precache(post_data):
+    """Entry point of the precache_domain_item task. Feeds which can be read
+    in parts are refreshed by plan_precache(), the others page by page by
+    update_cache().
+
+    """
+    key_name = post_data.get('key_name', DEFAULT_KEY_NAME)
+    model_class = _MODELS_DICT.get(key_name.split(':')[1])
+    if model_class and model_class._mapper.SHARDING and \
+       not post_data.get('page'):
+        plan_precache(key_name)
+    else:
+        update_cache(post_data)
+
+def update_cache(post_data):
+    key_name = base_key_name = post_data.get('key_name', DEFAULT_KEY_NAME)
+    page = int(post_data.get('page', 0))
+
+    if page:
+        key_name += ':%s' % page
+
+    if not memcache.add('lock:' + key_name, True, 60):
         return
 
-    items, feed, cursor = model_class.all().retrieve_page(cursor)
-    items = list(items)
+    cursor = post_data.get('cursor')
 
-    cache_model = model_class._meta.cache_model
-    if hasattr(cache_model, 'additional_cache'):
-        cache_model.additional_cache(items, index, domain)
+    domain, model = post_data.get(
+        'key_name', DEFAULT_KEY_NAME).split(':')
 
-    new_page_hash = hashlib.sha1(
-        ''.join(str(item) for item in feed)).hexdigest()
+    index = GDataIndex.get_or_insert(
+        key_name=key_name,
+        domain=domain,
+        model_class=model,
+    )
 
-    leftover = []
+    model_class = _prepare_domain(domain, model, index)
+    if not model_class:
+        return
 
     full_precache = index.full_precache
 
-    if new_page_hash != index.page_hash or prev_hashes or full_precache:
-        index.page_hash = new_page_hash
-        old_hashes = prev_hashes + index.hashes
-        index.keys, index.hashes = [], []
-
-        items_dict = {}
-        new_hashes = []
-        new_keys = []
-        for i, item in enumerate(items):
-            if isinstance(item._atom, dict):
-                value = _serialize_dict(item._atom)
-            else:
-                value = str(item._atom)
-            hsh = hashlib.sha1(value).hexdigest()
-            new_hashes.append(hsh)
-            items_dict[hsh] = item
-            new_keys.append(item.key())
-
-        updater = _CacheUpdater(items_dict, cache_model, model_class, domain,
-                                index)
-
-        old_s, new_s = set(old_hashes), set(new_hashes)
-        common = old_s.intersection(new_s)
-
-        leftover = []
-
-        if full_precache:
-            _full_precache(updater, old_hashes, new_hashes)
-        elif cursor and common:
-            leftover = _update_middle_page(
-                updater, common, old_hashes, new_hashes)
-        elif not cursor:
-            _update_last_page(
-                updater, new_s - old_s, old_s - new_s, key_name, page)
-        else:
-            leftover = _update_whole_page(updater, old_hashes, new_hashes)
+    etag = not full_precache and index.etag or None
+    try:
+        gen, _, cursor, etag = model_class.all().retrieve_page(cursor, etag)
+    except errors.NotModifiedError:
+        _page_not_modified(post_data, index, page, key_name)
+        return
+
+    # The page may be streamed by the mapper, so it's iterated only once.
+    page_hash = hashlib.sha1()
+    items = []
+    for item in gen:
+        page_hash.update(str(item._atom))
+        items.append(item)
+    new_page_hash = page_hash.hexdigest()
+    changed = new_page_hash != index.page_hash
+    if changed and page:
+        scheduler.mark_changed(base_key_name)
 
-        index.hashes = new_hashes
-        index.keys = new_keys
+    cache_model = model_class._meta.cache_model
+    if changed or full_precache:
+        index.page_hash = new_page_hash
+        _diff_page(index, items, cache_model, domain, full_precache)
 
     if not page:
         index.last_updated = datetime.datetime.now()
+        if changed:
+            index.refresh_changed = True
 
     index.full_precache = False
+    index.etag = etag
+    index.next_cursor = cursor and str(cursor) or None
     index.put()
 
     if cursor:
-        taskqueue.add(url=reverse('precache_domain_item'), params={
-            'key_name': post_data.get('key_name', DEFAULT_KEY_NAME),
-            'page': page + 1,
-            'cursor': cursor,
-            'hashes': ':'.join(leftover),
-        })
+        _precache_next_page(post_data, page, cursor)
+    else:
+        _finish_refresh(domain, model, page)
+        _refresh_finished(base_key_name, False, page + 1)
 
     memcache.delete('lock:' + key_name)
 
 
-def _update_middle_page(updater, common, old_hashes, new_hashes):
-    for item in reversed(new_hashes):
-        if item in common:
-            last_common = item
-            break
-    old_index = old_hashes.index(last_common)
-    new_index = new_hashes.index(last_common)
-
-    old_s = set(old_hashes[:old_index])
-    new_s = set(new_hashes[:new_index])
-
-    updater.add(new_s - old_s)
-    updater.delete(old_s - new_s)
-
-    # Check if any of remaining new hashes is in db
-    # If it is - we may remove all of the remaining old hashes
-    leftover = []
-    new_leftover = new_hashes[new_index:]
-    existing = updater.get(new_leftover)
-    if any(existing):
-        updater.delete(old_hashes[old_index:])
-    else:
-        leftover = old_hashes[old_index:]
+def _refresh_finished(key_name, changed, cost):
+    """Called when all pages of the feed were refreshed. Cache models may
+    define after_refresh(domain) to refresh data depending on the feed.
+
+    """
+    scheduler.refresh_done(key_name, changed, cost)
+    domain, model = key_name.split(':')
+    cache_model = _MODELS_DICT[model]._meta.cache_model
+    if hasattr(cache_model, 'after_refresh'):
+        cache_model.after_refresh(domain)
+
+
+NICKNAME_KEY_NAME = '%s:%s'
+
+
+def refresh_nicknames(post_data):
+    """Refreshes NicknameCache from one page of the nickname feed of the
+    domain, and starts the task for the next page.
 
-    created = []
-    for hsh, obj in zip(new_leftover, existing):
-        if not obj:
-            created.append(updater.create(hsh))
-    db.put(created)
+    The feed is ordered by nickname, so the page covers the range of cache
+    rows from the last nickname of the previous page (after) to its own last
+    nickname. Rows in the range which aren't on the page are deleted.
 
-    return leftover
+    """
+    from crlib.models import NicknameCache
+    domain = post_data['domain']
+    after = post_data.get('after')
+    apps_domain = AppsDomain.get_by_key_name(domain)
+    if not apps_domain or not apps_domain.is_active():
+        return
+    users._set_current_user(apps_domain.admin_email, domain)
 
+    model_class = _MODELS_DICT['GANickname']
+    gen, _, cursor, _ = model_class.all().retrieve_page(
+        post_data.get('cursor'))
+    items = list(gen)
 
-def _update_last_page(updater, added, deleted, key_name, page):
-    updater.add(added)
-    updater.delete(deleted)
+    def key(nickname):
+        return db.Key.from_path(
+            NicknameCache.kind(), NICKNAME_KEY_NAME % (domain, nickname))
 
-    keys = [key_name.replace(str(page), str(x)) for x in (page + 1, page + 2)]
-    indexes = [idx for idx in GDataIndex.get_by_key_name(keys) if idx]
-    if indexes:
-        db.delete(indexes)
+    query = NicknameCache.all().filter('__key__ >', key(after or ''))
+    if cursor and items:
+        query.filter('__key__ <=', key(items[-1].key()))
+    else:
+        query.filter('__key__ <', key(u'\ufffd'))
+    existing = dict((row.key().name(), row) for row in query.fetch(1000))
+
+    to_put = []
+    for item in items:
+        row = existing.pop(NICKNAME_KEY_NAME % (domain, item.key()), None)
+        # Nicknames are immutable, only the owner may change by a rename.
+        if row is None or row.user_name != item.user_name:
+            to_put.append(NicknameCache.from_model(
+                item,
+                key_name=NICKNAME_KEY_NAME % (domain, item.key()),
+                _atom=item._atom,
+                _gdata_key_name=item.key(),
+                _domain=domain,
+            ))
+    db.put(to_put)
+    db.delete(existing.values())
+
+    if cursor and items:
+        taskqueue.add(url=reverse('precache_nicknames'), params={
+            'domain': domain,
+            'cursor': str(cursor),
+            'after': items[-1].key(),
+        })
 
 
-def _update_whole_page(updater, old_hashes, new_hashes):
-    # old_hashes and new_hashes don't have any common elements
+def _precache_next_page(post_data, page, cursor):
+    taskqueue.add(url=reverse('precache_domain_item'), params={
+        'key_name': post_data.get('key_name', DEFAULT_KEY_NAME),
+        'page': page + 1,
+        'cursor': cursor,
+    })
 
-    existing = updater.get(new_hashes)
 
-    leftover = []
-    if any(existing):
-        updater.delete(old_hashes)
+def _page_not_modified(post_data, index, page, key_name):
+    """Called when the page hasn't changed since the last update. Its cache
+    entities are still valid, so we only move on to the next page."""
+    if not page:
+        index.last_updated = datetime.datetime.now()
+        index.put()
+
+    if index.next_cursor:
+        _precache_next_page(post_data, page, index.next_cursor)
     else:
-        leftover = old_hashes[:]
+        _finish_refresh(index.domain, index.model_class, page)
+        _refresh_finished(
+            post_data.get('key_name', DEFAULT_KEY_NAME), False, page + 1)
 
-    created = []
-    for hsh, obj in zip(new_hashes, existing):
-        if not obj:
-            created.append(updater.create(hsh))
-    db.put(created)
+    memcache.delete('lock:' + key_name)
 
-    return leftover
 
+def _create_rows(cache_model, items, domain):
+    """items is list of (item, hash) tuples."""
+    db.put([cache_model.from_model(
+        item,
+        key_name=hsh,
+        _domain=domain,
+        _atom=item._atom,
+        _gdata_key_name=item.key(),
+    ) for item, hsh in items])
+
+
+def _diff_page(index, items, cache_model, domain, full_precache):
+    """Creates cache rows of the new entries of the page and updates keys and
+    hashes of the page.
+
+    Rows are keyed by the hash of the entry, so entries which haven't
+    changed keep their rows, even when they moved from another page. Hashes
+    which left the page are collected in removed_hashes, their rows are
+    deleted by _finish_refresh() unless they show up on another page.
+
+    """
+    old = dict(zip(index.keys, index.hashes))
+    new_keys, new_hashes, items_dict = [], [], {}
+    for item in items:
+        hsh = _item_hash(item)
+        new_keys.append(item.key())
+        new_hashes.append(hsh)
+        items_dict[hsh] = item
+
+    if full_precache:
+        to_create = new_hashes
+    else:
+        to_check = [hsh for key, hsh in zip(new_keys, new_hashes)
+                    if old.get(key) != hsh]
+        existing = to_check and cache_model.get_by_key_name(to_check) or []
+        to_create = [hsh for hsh, row in zip(to_check, existing) if not row]
 
-def _full_precache(updater, old_hashes, new_hashes):
-    updater.delete(new_hashes)
-    updater.delete(old_hashes)
+    _create_rows(cache_model, [(items_dict[hsh], hsh) for hsh in to_create],
+                 domain)
 
-    created = []
+    removed = dict.fromkeys(index.removed_hashes)
+    removed.update(dict.fromkeys(index.hashes))
     for hsh in new_hashes:
-        created.append(updater.create(hsh))
-    db.put(created)
+        removed.pop(hsh, None)
+    index.removed_hashes = removed.keys()
+    index.keys, index.hashes = new_keys, new_hashes
+
+
+def _finish_refresh(domain, model, last_page):
+    """Deletes pages past the last one and cache rows of the entries which
+    are gone from the feed.
+
+    """
+    live, removed = {}, {}
+    to_put, to_delete = [], []
+    for page in _get_pages(domain, model):
+        if _page_number(page) > last_page:
+            to_delete.append(page)
+            removed.update(dict.fromkeys(page.hashes))
+        else:
+            live.update(dict.fromkeys(page.hashes))
+            if page.removed_hashes:
+                to_put.append(page)
+        removed.update(dict.fromkeys(page.removed_hashes))
+        page.removed_hashes = []
+
+    cache_model = _MODELS_DICT[model]._meta.cache_model
+    stale = [hsh for hsh in removed if hsh not in live]
+    for i in xrange(0, len(stale), 100):
+        to_delete.extend([row for row in cache_model.get_by_key_name(
+            stale[i:i + 100]) if row])
+    db.put(to_put)
+    db.delete(to_delete)
+
+
+# Sharded precache
+#
+# plan_precache() splits the feed into shards using the GDataIndex pages of
+# the previous refresh, and starts one precache_shard task per shard. Each
+# shard creates cache rows for entries it hasn't seen before and records keys
+# and hashes of its entries in PrecacheShard entities (one per feed page read).
+# The last finished shard triggers reconcile_precache(), which rebuilds the
+# GDataIndex pages and deletes rows of entries which are gone.
+
+def _page_key_name(key_name, page):
+    if page:
+        return '%s:%d' % (key_name, page)
+    return key_name
+
+
+def _page_number(page):
+    parts = page.key().name().split(':')
+    if len(parts) == 3:
+        return int(parts[2])
+    return 0
+
+
+def _get_pages(domain, model):
+    pages = GDataIndex.all().filter('domain', domain).filter(
+        'model_class', model).fetch(1000)
+    return sorted(pages, key=_page_number)
+
+
+def _plan_by_key(pages, mapper):
+    """Returns list of (cursor, end_key, limit, page) tuples, page being the
+    GDataIndex page the shard is expected to reproduce.
+
+    """
+    pages = [page for page in pages if page.keys]
+    if not pages:
+        return [(None, None, None, None)]
+    starts = [page.keys[0] for page in pages]
+    plan = []
+    for i, page in enumerate(pages):
+        cursor = i and mapper.shard_cursor(starts[i]) or None
+        end_key = i + 1 < len(starts) and starts[i + 1] or None
+        plan.append((cursor, end_key, None, page))
+    return plan
+
+
+def _plan_by_offset(pages, mapper):
+    count = sum([len(page.keys) for page in pages])
+    shards = max(1, (count + mapper.SHARD_SIZE - 1) / mapper.SHARD_SIZE)
+    plan = []
+    for i in xrange(shards):
+        page = i < len(pages) and pages[i] or None
+        if i + 1 < shards:
+            limit = mapper.SHARD_SIZE
+        else:
+            limit = None
+        plan.append((i and str(mapper.shard_cursor(i)) or None, None, limit,
+                     page))
+    return plan
 
+
+def plan_precache(key_name):
+    domain, model = key_name.split(':')
+    if not memcache.add('lock:' + key_name, True, 60):
+        return
+    try:
+        first_page = GDataIndex.get_or_insert(
+            key_name=key_name,
+            domain=domain,
+            model_class=model,
+        )
+        model_class = _prepare_domain(domain, model, first_page)
+        if not model_class:
+            return
+
+        db.delete(PrecacheShard.all(keys_only=True).filter(
+            'base', key_name).fetch(1000))
+
+        pages = _get_pages(domain, model)
+        mapper = model_class._mapper
+        if mapper.SHARDING == 'key':
+            plan = _plan_by_key(pages, mapper)
+        else:
+            plan = _plan_by_offset(pages, mapper)
+
+        run = '%s:%d' % (key_name, time.time() * 1000)
+        now = datetime.datetime.now()
+        full_precache = first_page.full_precache
+        shards = []
+        for i, (cursor, end_key, limit, page) in enumerate(plan):
+            shards.append(PrecacheShard(
+                key_name='%s:%d:0' % (run, i),
+                base=key_name,
+                run=run,
+                number=i,
+                count=len(plan),
+                cursor=cursor,
+                end_key=end_key,
+                limit=limit,
+                page=page and page.key().name() or None,
+                etag=page and not full_precache and page.etag or None,
+                full_precache=full_precache,
+                started=now,
+            ))
+        first_page.last_updated = now
+        db.put(shards + [first_page])
+        for shard in shards:
+            _add_shard_task(shard)
+    finally:
+        memcache.delete('lock:' + key_name)
+
+
+def _add_shard_task(shard):
+    taskqueue.add(url=reverse('precache_shard'), params={
+        'key_name': shard.key().name(),
+    })
+
+
+def update_shard(post_data):
+    shard = PrecacheShard.get_by_key_name(post_data['key_name'])
+    if not shard or shard.done:
+        return
+    domain, model = shard.base.split(':')
+    model_class = _prepare_domain(
+        domain, model, GDataIndex.get_by_key_name(shard.base))
+    if not model_class:
+        return
+    cache_model = model_class._meta.cache_model
+
+    etag = not shard.part and shard.etag or None
+    try:
+        gen, _, cursor, etag = model_class.all().retrieve_page(
+            shard.cursor, etag)
+    except errors.NotModifiedError:
+        # The page the shard reproduced last time ended within this feed
+        # page, see reconcile_precache().
+        page = GDataIndex.get_by_key_name(shard.page)
+        if page:
+            shard.keys, shard.hashes = page.keys, page.hashes
+            shard.ended = shard.done = True
+            shard.put()
+            _add_reconcile_task(shard)
+            return
+        # The page is gone since the run was planned.
+        gen, _, cursor, etag = model_class.all().retrieve_page(shard.cursor)
+
+    items = []
+    for item in gen:
+        if shard.end_key is not None and item.key() >= shard.end_key:
+            shard.ended = True
+            break
+        items.append(item)
+        if shard.limit is not None and len(items) >= shard.limit:
+            shard.ended = True
+            break
+    if not cursor:
+        shard.ended = True
+
+    hashes = [_item_hash(item) for item in items]
+    if shard.full_precache:
+        existing = [None] * len(hashes)
+    else:
+        existing = cache_model.get_by_key_name(hashes)
+    _create_rows(cache_model, [(item, hsh) for item, hsh, row
+                               in zip(items, hashes, existing) if row is None],
+                 domain)
+
+    shard.keys = [item.key() for item in items]
+    shard.hashes = hashes
+    shard.etag = etag
+    shard.done = True
+    to_put = [shard]
+    next_part = None
+    if not shard.ended:
+        if shard.limit is not None:
+            limit = shard.limit - len(items)
+        else:
+            limit = None
+        next_part = PrecacheShard(
+            key_name='%s:%d:%d' % (shard.run, shard.number, shard.part + 1),
+            base=shard.base,
+            run=shard.run,
+            number=shard.number,
+            count=shard.count,
+            part=shard.part + 1,
+            cursor=str(cursor),
+            end_key=shard.end_key,
+            limit=limit,
+            full_precache=shard.full_precache,
+            started=shard.started,
+        )
+        to_put.append(next_part)
+    db.put(to_put)
+    if next_part:
+        _add_shard_task(next_part)
+    else:
+        _add_reconcile_task(shard)
+
+
+def _add_reconcile_task(shard):
+    taskqueue.add(url=reverse('precache_reconcile'), params={
+        'run': shard.run,
+        'count': shard.count,
+    })
+
+
+def _finished_shards(run, count):
+    """Returns all the parts of the shards of the run, or None if some of
+    them aren't done. The parts are read by key, as a query might not see
+    the latest of them.
+
+    """
+    shards = []
+    key_names = ['%s:%d:0' % (run, i) for i in xrange(count)]
+    while key_names:
+        parts = PrecacheShard.get_by_key_name(key_names)
+        key_names = []
+        for part in parts:
+            if not part or not part.done:
+                return None
+            shards.append(part)
+            if not part.ended:
+                key_names.append(
+                    '%s:%d:%d' % (run, part.number, part.part + 1))
+    return shards
+
+
+def reconcile_precache(post_data):
+    run = post_data['run']
+    shards = _finished_shards(run, int(post_data['count']))
+    if not shards:
+        return
+    if not memcache.add('lock:' + run, True, 60):
+        return
+
+    key_name = shards[0].base
+    domain, model = key_name.split(':')
+    model_class = _MODELS_DICT[model]
+    cache_model = model_class._meta.cache_model
+    size = model_class._mapper.SHARD_SIZE
+    shards.sort(key=lambda x: (x.number, x.part))
+
+    # Lay out the entries into pages of SHARD_SIZE entries. ETag of a shard
+    # is kept only if the shard was read from a single feed page and it
+    # makes a page of its own, so that the next run starting at this page
+    # may skip it.
+    layout = []
+    keys, hashes = [], []
+    for shard in shards:
+        single = not shard.part and shard.ended
+        if single and not keys and len(shard.keys) <= size:
+            layout.append((shard.keys, shard.hashes, shard.etag))
+            continue
+        keys.extend(shard.keys)
+        hashes.extend(shard.hashes)
+        while len(keys) >= size:
+            layout.append((keys[:size], hashes[:size], None))
+            keys, hashes = keys[size:], hashes[size:]
+    if keys or not layout:
+        layout.append((keys, hashes, None))
+
+    old_pages = _get_pages(domain, model)
+    old_hashes = set()
+    for page in old_pages:
+        old_hashes.update(page.hashes)
+        old_hashes.update(page.removed_hashes)
+    new_hashes = set()
+    now = datetime.datetime.now()
+    pages = []
+    for i, (keys, hashes, etag) in enumerate(layout):
+        new_hashes.update(hashes)
+        pages.append(GDataIndex(
+            key_name=_page_key_name(key_name, i),
+            domain=domain,
+            model_class=model,
+            keys=keys,
+            hashes=hashes,
+            etag=etag,
+        ))
+    # The first page keeps its scheduling properties.
+    first_page = GDataIndex.get_by_key_name(key_name)
+    if first_page:
+        for name in ('next_update', 'refresh_interval', 'refresh_cost',
+                     'change_rate', 'refresh_changed'):
+            setattr(pages[0], name, getattr(first_page, name))
+    pages[0].last_updated = now
+    db.put(pages)
+    db.delete(old_pages[len(pages):])
+
+    # Rows of entries which are gone. Rows written after the run started
+    # (e.g. by Model.save()) are kept, as the shards might have missed them.
+    started = shards[0].started
+    if shards[0].full_precache:
+        stale = [key.name() for key in cache_model.all(keys_only=True).filter(
+            '_domain', domain) if key.name() not in new_hashes]
+    else:
+        stale = list(old_hashes - new_hashes)
+    for i in xrange(0, len(stale), 100):
+        rows = [row for row in cache_model.get_by_key_name(stale[i:i + 100])
+                if row and row._updated_on < started]
+        db.delete(rows)
+
+    db.delete(shards)
+    old_order = []
+    for page in old_pages:
+        old_order.extend(page.hashes)
+    new_order = []
+    for page in pages:
+        new_order.extend(page.hashes)
+    _refresh_finished(key_name, old_order != new_order, len(shards))
+    memcache.delete('lock:' + run)
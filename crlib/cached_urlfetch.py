@@ -1,72 +1,216 @@
-import pickle
+"""Caching HTTP client for gdata.client.GDClient objects.
+
+Usage:
+
+    client = ContactsClient(domain=domain)
+    cached_urlfetch.run_on_appengine(client, ttls=(
+        (r'/m8/feeds/contacts/', 5 * 60),
+    ))
+
+Successful GET responses are kept in memcache for MAX_AGE seconds. They're
+served without asking the server while they're fresh, i.e. for the TTL of
+the first pattern in ttls matching the URL (DEFAULT_TTL otherwise). Stale
+responses with ETag or Last-Modified header are revalidated with a
+conditional request. Cache-Control headers of the server other than
+no-store are ignored; the TTLs are policy of the application.
+
+Cache keys are scoped by the Authorization header (and the other headers in
+KEY_HEADERS), so responses are never shared between credentials. They also
+include the generation of the URL (without the query string), which
+requests with other methods than GET change, so that the cached responses
+of the URL are dropped for all the credentials. Bodies are compressed and
+split into CHUNK_SIZE memcache entries. Requests with their own conditional
+headers aren't cached.
+
+"""
+import hashlib
+import logging
+import re
+import time
+import zlib
 from google.appengine.api import memcache
-#from lib.gdata import urlfetch as gdata_urlfetch
-from lib.gdata.alt import appengine
+from atom.http_core import HttpClient, HttpResponse, get_headers
+from crlib import memcache_batch
 
 
-__all__ = ['run_on_appengine', 'delete_url_from_cache']
+__all__ = ['CachingHttpClient', 'run_on_appengine']
 
 
 MEMCACHE_KEY = 'http_response:%s'
-
-
-def run_on_appengine(gdata_service):
-    gdata_service.http_client = _CachedHttpClient()
-
-
-def delete_url_from_cache(url):
-    memcache.delete(MEMCACHE_KEY % url)
-
-
-def _http_response_from_cache(value):
-    return gdata_urlfetch.HttpResponse(
-        _UrlfetchResponse(pickle.loads(value)))
-
-
-def _http_response_to_cache(response):
-    to_cache = {
-        'content': response.body.read(),
-        'headers': response.headers,
-        'status_code': response.status,
-    }
-    return pickle.dumps(to_cache, pickle.HIGHEST_PROTOCOL)
-
-
-#class _CachedHttpClient(gdata_urlfetch.AppEngineHttpClient):
-class _CachedHttpClient(object):
-    def __init__(self, headers=None):
-        self.debug = False
-        self.headers = headers or {}
-
-    def request(self, operation, url, data=None, headers=None):
-        # we only cache get requests
-        if operation != 'GET':
-            delete_url_from_cache(url)
-            #super(_CachedHttpClient, self).request(
-            #    operation, url, data, headers)
-            return self.http_client.request(operation, url, data, headers)
-
-        key = MEMCACHE_KEY % url
-
-        cached = memcache.get(key)
-        if cached is not None:
+GENERATION_KEY = 'http_generation:%s'
+DEFAULT_TTL = 60
+MAX_AGE = 24 * 60 * 60
+# memcache values are limited to 1MB
+CHUNK_SIZE = 1000 * 1000
+KEY_HEADERS = ('Authorization', 'GData-Version', 'Accept')
+_CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since', 'If-Match')
+
+
+def run_on_appengine(client, ttls=(), default_ttl=DEFAULT_TTL):
+    client.http_client = CachingHttpClient(
+        client.http_client, ttls, default_ttl)
+    return client
+
+
+class _CachedResponse(HttpResponse):
+    """HttpResponse with case-insensitive header names, like httplib's."""
+
+    def __init__(self, status, reason, headers, body):
+        headers = dict((k.lower(), v) for k, v in headers.iteritems())
+        HttpResponse.__init__(self, status, reason, headers, body)
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+
+class CachingHttpClient(object):
+    """atom.http_core.HttpClient wrapper, see the module docstring."""
+
+    def __init__(self, http_client=None, ttls=(), default_ttl=DEFAULT_TTL):
+        self.http_client = http_client or HttpClient()
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.default_ttl = default_ttl
+
+    def _get_debug(self):
+        return self.http_client.debug
+
+    def _set_debug(self, debug):
+        self.http_client.debug = debug
+
+    debug = property(_get_debug, _set_debug)
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def _generation_key(self, url):
+        resource = url.split('?', 1)[0]
+        return GENERATION_KEY % hashlib.sha1(resource).hexdigest()
+
+    def _generation(self, url):
+        key = self._generation_key(url)
+        generation = memcache_batch.get(key)
+        if generation is None:
+            # Generations start at the current time, so that the responses
+            # cached before the counter was evicted aren't used again.
+            generation = int(time.time() * 1000)
+            if not memcache.add(key, generation):
+                generation = memcache.get(key) or generation
+            memcache_batch.remember(key, generation)
+        return generation
+
+    def _bump_generation(self, url):
+        key = self._generation_key(url)
+        generation = memcache.incr(key)
+        if generation is None:
+            generation = int(time.time() * 1000)
+            memcache.set(key, generation)
+        memcache_batch.remember(key, generation)
+
+    def _key(self, url, headers):
+        parts = [url, str(self._generation(url))]
+        for name in KEY_HEADERS:
+            parts.append(headers.get(name, ''))
+        return MEMCACHE_KEY % hashlib.sha1('\n'.join(parts)).hexdigest()
+
+    def request(self, http_request):
+        url = str(http_request.uri)
+        headers = http_request.headers
+        if http_request.method != 'GET':
             try:
-                return _http_response_from_cache(cached)
-            except Exception:
-                delete_url_from_cache(url)
-
-        #response = super(_CachedHttpClient, self).request(
-        #    operation, url, data, headers)
-        response = self.http_client.request(operation, url, data, headers)
-        memcache.set(key, _http_response_to_cache(response))
-        return response
-gdata_urlfetch.run_on_appengine(_CachedHttpClient)
-
-
-class _UrlfetchResponse(object):
-    def __init__(self, d):
-        self.content = d['content']
-        self.headers = d['headers']
-        self.status_code = d['status_code']
-
-
+                return self.http_client.request(http_request)
+            finally:
+                self._bump_generation(url)
+        key = self._key(url, headers)
+        for name in _CONDITIONAL_HEADERS:
+            if name in headers:
+                return self.http_client.request(http_request)
+
+        entry = memcache_batch.get(key)
+        if entry is not None and not self._vary_matches(entry, headers):
+            entry = None
+        if entry is not None and entry['expires'] > time.time():
+            response = self._response_from_cache(key, entry)
+            if response is not None:
+                return response
+            entry = None
+
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = self.http_client.request(http_request)
+        finally:
+            if entry is not None:
+                for name in _CONDITIONAL_HEADERS:
+                    headers.pop(name, None)
+
+        if entry is not None and response.status == 304:
+            cached = self._response_from_cache(key, entry)
+            if cached is not None:
+                entry['expires'] = time.time() + self.ttl(url)
+                memcache_batch.set(key, entry, MAX_AGE)
+                return cached
+            # Chunks are gone, ask again without the conditional headers.
+            memcache_batch.delete(key)
+            return self.http_client.request(http_request)
+        if response.status != 200:
+            return response
+        return self._store(key, url, headers, response)
+
+    def _vary_matches(self, entry, headers):
+        for name, value in entry['vary'].iteritems():
+            if headers.get(name) != value:
+                return False
+        return True
+
+    def _store(self, key, url, request_headers, response):
+        body = response.read()
+        headers = dict(get_headers(response))
+        lower = dict((k.lower(), v) for k, v in headers.iteritems())
+        cached = _CachedResponse(
+            response.status, response.reason, headers, body)
+        vary = [x.strip() for x in lower.get('vary', '').split(',')
+                if x.strip()]
+        if 'no-store' in lower.get('cache-control', '') or '*' in vary:
+            return cached
+
+        data = zlib.compress(body)
+        version = hashlib.sha1(data).hexdigest()[:8]
+        chunks = {}
+        for i in xrange(0, max(len(data), 1), CHUNK_SIZE):
+            chunks['%s:%s:%d' % (key, version, i / CHUNK_SIZE)] = \
+                data[i:i + CHUNK_SIZE]
+        entry = {
+            'status': response.status,
+            'reason': response.reason,
+            'headers': headers,
+            'etag': lower.get('etag'),
+            'last_modified': lower.get('last-modified'),
+            'vary': dict((x, request_headers.get(x)) for x in vary),
+            'expires': time.time() + self.ttl(url),
+            'version': version,
+            'chunks': len(chunks),
+        }
+        if memcache.set_multi(chunks, time=MAX_AGE):
+            logging.warning('Couldn\'t store response of %s in memcache.' %
+                            url)
+        else:
+            memcache_batch.set(key, entry, MAX_AGE)
+        return cached
+
+    def _response_from_cache(self, key, entry):
+        chunk_keys = ['%s:%s:%d' % (key, entry['version'], i)
+                      for i in xrange(entry['chunks'])]
+        chunks = memcache.get_multi(chunk_keys)
+        if len(chunks) != len(chunk_keys):
+            return None
+        body = zlib.decompress(''.join([chunks[x] for x in chunk_keys]))
+        return _CachedResponse(
+            entry['status'], entry['reason'], entry['headers'], body)
+
+    Request = request
@@ -54,6 +54,29 @@ class NetworkError(GDataError):
     pass
 
 
+class MembershipUpdateError(GDataError):
+    """ Some of the group members or owners couldn't be added or removed.
+
+    `failed` is a list of (email, exception) tuples. `atom`, if given, is the
+    entry with the changes which were made.
+
+    """
+    def __init__(self, failed, atom=None):
+        GDataError.__init__(self, failed)
+        self.failed = failed
+        self.atom = atom
+
+    def emails(self):
+        return [email for email, _ in self.failed]
+
+
+class NotModifiedError(GDataError):
+    """ The requested feed hasn't changed since it was last retrieved, i.e. its
+    ETag is the same as the one sent along with the request.
+
+    """
+
+
 APPS_FOR_YOUR_DOMAIN_ERROR_CODES = {
     1100: EntityDeletedRecentlyError,
     1200: DomainUserLimitExceededError,
@@ -1,25 +1,50 @@
+import bisect
 import datetime
 import hashlib
+import heapq
+import itertools
 import logging
 import operator
 import os
 import pickle
 import re
+import time
 from django.conf import settings
 from google.appengine.ext import db
 from google.appengine.api import memcache
+from google.appengine.runtime import apiproxy_errors
 from atom import AtomBase
 from gdata.data import ExtendedProperty
 from gdata.client import GDClient
 from gdata.service import GDataService
 from crauth import users
 from crlib.signals import class_prepared
-from crlib import cache
-from crlib.models import GDataIndex
+from crlib import cache, memcache_batch
+from crlib.models import GDataIndex, decode_model, decode_atom
 
 
 BadValueError = db.BadValueError
 
+#: Value of properties which haven't been read from the Atom object yet.
+NOT_RESOLVED = 'NOT_RESOLVED'
+
+#: Plans of GDataQuery, see GDataQuery.plan().
+PLAN_CACHE = 'cache-index'
+PLAN_MAPPER = 'mapper'
+PLAN_CACHE_SCAN = 'cache-scan'
+PLAN_FULL_SCAN = 'full-scan'
+
+
+class _OrderKey(object):
+    """Wraps items so that they compare by the orders of the query."""
+
+    def __init__(self, query, item):
+        self.query = query
+        self.item = item
+
+    def __cmp__(self, other):
+        return self.query._cmp_items(self.item, other.item)
+
 
 class GDataQuery(object):
     """db.Query equivalent."""
@@ -42,6 +67,7 @@ class GDataQuery(object):
         self._cached = cached
         self._query = None
         self._cursor = None
+        self._prefetch = ()
         if self._cached:
             cache.ensure_has_cache(
                 users.get_current_user().domain_name, model_class.__name__)
@@ -60,6 +86,14 @@ class GDataQuery(object):
         self._filters.append((match.groups()[0], operator, value))
         return self
 
+    def prefetch(self, *properties):
+        """Resolves given ReferenceProperty/ListProperty properties of all
+        fetched items at once, see prefetch().
+
+        """
+        self._prefetch += properties
+        return self
+
     def get(self):
         results = self.fetch(1)
         if results:
@@ -77,86 +111,158 @@ class GDataQuery(object):
             return value.key()
         return value
 
-    def _retrieve_ordered(self, limit=1000, offset=0):
-        can_retrieve_subset = not self._filters and \
-                hasattr(self._model._mapper, 'retrieve_subset')
-        if self._filters and \
-           hasattr(self._model._mapper, 'filter_by_%s' % self._filters[0][0]):
-            retriever = getattr(
-                self._model._mapper, 'filter_by_%s' % self._filters[0][0])
-            retriever = retriever(
-                self._normalize_parameter(self._filters[0][2]))
-        elif can_retrieve_subset:
-            retriever = self._model._mapper.retrieve_subset(limit, offset)
-        else:
-            retriever = self._model._cache['retrieve_all']
-            if retriever is None:
-                retriever = self._model._mapper.retrieve_all()
-                self._model._cache['retrieve_all'] = retriever
-        gen = (self._model._from_atom(item) for item in retriever)
-        if not self._orders:
-            return gen
-        items = sorted(gen, cmp=self._cmp_items)
-        if not can_retrieve_subset:
-            items = items[offset:offset+limit]
-        return items
+    def _compile_filters(self, filters):
+        """Returns a function checking the given filters on an item. The
+        operators and values are prepared once, not for every item.
 
-    def _matches_filter(self, item):
-        for i, (property, operator, value) in enumerate(self._filters):
-            # Skip the check if the mapper has filter_by_property method
-            if i == 0 and \
-               hasattr(self._model._mapper, 'filter_by_%s' % property):
-                continue
-            item_value = getattr(item, property)
-            item_value = self._normalize_parameter(item_value)
-            if hasattr(item_value, '__iter__') and operator in ('=', 'in'):
-                return value in item_value
-            if not self._FUNCS[operator](item_value, value):
-                return False
-        else:
+        """
+        normalize = self._normalize_parameter
+        checks = []
+        for property, operator, value in filters:
+            value = normalize(value)
+            if operator == 'in':
+                test = lambda x, value=value: x in value
+            elif operator == '=':
+                def test(x, value=value):
+                    if hasattr(x, '__iter__'):
+                        return value in x
+                    return x == value
+            else:
+                test = lambda x, func=self._FUNCS[operator], value=value: \
+                        func(x, value)
+            checks.append((property, test))
+
+        def matches(item):
+            for property, test in checks:
+                if not test(normalize(getattr(item, property))):
+                    return False
             return True
+        return matches
 
-    def _retrieve_cached(self, limit=1000, offset=0):
+    def plan(self):
+        """Returns (plan, residual filters) tuple. Filters and orders are
+        pushed down to the first of:
+
+        * PLAN_CACHE - datastore query of the cache model, used if all the
+          filtered and ordered properties are cached.
+        * PLAN_CACHE_SCAN - datastore query of the cache model with the
+          filters on cached properties, if there are any.
+        * PLAN_MAPPER - filter_by_<property>() of the mapper, which filters
+          the feed on the server.
+        * PLAN_CACHE_SCAN again, with no filters pushed down (all cache rows
+          of the domain), if the model has a cache.
+        * PLAN_FULL_SCAN - the whole feed (retrieve_all() of the mapper).
+
+        Residual filters are checked in memory. Results are ordered in
+        memory unless all the orders could be pushed down too.
+
+        """
+        residual = self._filters
+        use_cache = self._cached and \
+                hasattr(self._model._meta, 'cache_model')
+        if use_cache:
+            cached = self._model._meta.cache_model.properties()
+            residual = [f for f in self._filters if f[0] not in cached]
+            if not residual and \
+               not [p for p, _ in self._orders if p not in cached]:
+                return (PLAN_CACHE, [])
+            if len(residual) < len(self._filters):
+                return (PLAN_CACHE_SCAN, residual)
+        for f in residual:
+            if hasattr(self._model._mapper, 'filter_by_%s' % f[0]):
+                return (PLAN_MAPPER, [x for x in self._filters if x != f])
+        if use_cache:
+            return (PLAN_CACHE_SCAN, residual)
+        return (PLAN_FULL_SCAN, residual)
+
+    def _cache_query(self, filters, orders):
         cache_model = self._model._meta.cache_model
         domain = users.get_current_domain().domain
-        self._query = query = cache_model.all().filter('_domain', domain)
-        if self._cursor:
-            self._query.with_cursor(self._cursor)
-
-        for prop, operator, value in self._filters:
+        query = cache_model.all().filter('_domain', domain)
+        for prop, operator, value in filters:
             if isinstance(value, Model):
                 value = value.key()
             query.filter('%s %s' % (prop, operator), value)
-        for prop, asc in self._orders:
+        for prop, asc in orders:
             if not asc:
                 prop = '-' + prop
             query.order(prop)
+        return query
 
-        return query.fetch(limit, offset)
+    def _retrieve_cached(self, limit=1000, offset=0):
+        self._query = query = self._cache_query(self._filters, self._orders)
+        if self._cursor:
+            self._query.with_cursor(self._cursor)
+        for item in query.fetch(limit, offset):
+            yield self._model._from_cached(item)
+
+    def _scan_cache(self, residual):
+        """Returns (items, True if they are ordered) tuple."""
+        cached = self._model._meta.cache_model.properties()
+        pushed = [f for f in self._filters if f not in residual]
+        ordered = not [p for p, _ in self._orders if p not in cached]
+        query = self._cache_query(pushed, ordered and self._orders or [])
+        for prop, _, _ in residual:
+            logging.info('%s.%s isn\'t cached, the cache is scanned.' % (
+                self._model._meta.cache_model.__name__, prop))
+        items = (self._model._from_cached(item) for item in query)
+        return (items, ordered)
+
+    def _scan_feed(self):
+        retriever = self._model._cache['retrieve_all']
+        if retriever is None:
+            retriever = self._model._mapper.retrieve_all()
+            self._model._cache['retrieve_all'] = retriever
+        return self._model._from_atoms(retriever)
+
+    def _top(self, items, limit, offset, ordered):
+        """Returns iterator of items[offset:offset + limit], ordered by the
+        orders of the query unless the items already are.
+
+        """
+        if ordered or not self._orders:
+            return itertools.islice(items, offset, offset + limit)
+        # Only the first offset + limit items are sorted.
+        items = heapq.nsmallest(
+            offset + limit, (_OrderKey(self, item) for item in items))
+        return (key.item for key in items[offset:])
 
     def _retrieve_filtered(self, limit=1000, offset=0):
-        use_cache = self._cached and hasattr(self._model._meta, 'cache_model')
-        if use_cache:
-            for prop, _, _ in self._filters:
-                if not hasattr(self._model._meta.cache_model, prop):
-                    use_cache = False
-                    break
-        if use_cache:
-            for item in self._retrieve_cached(limit, offset):
-                yield self._model._from_cached(item)
+        plan, residual = self.plan()
+        logging.debug('%s query: %s plan, residual filters: %s' % (
+            self._model.__name__, plan, [f[0] for f in residual]))
+        if plan == PLAN_CACHE:
+            return self._retrieve_cached(limit, offset)
+
+        self._query = None
+        ordered = False
+        if plan == PLAN_CACHE_SCAN:
+            items, ordered = self._scan_cache(residual)
+        elif plan == PLAN_MAPPER:
+            property, _, value = [f for f in self._filters
+                                  if f not in residual][0]
+            retriever = getattr(self._model._mapper, 'filter_by_%s' % property)
+            items = self._model._from_atoms(
+                retriever(self._normalize_parameter(value)))
         else:
-            for item in self._retrieve_ordered(limit, offset):
-                if self._matches_filter(item):
-                    yield item
+            items = self._scan_feed()
+        if residual:
+            items = itertools.ifilter(self._compile_filters(residual), items)
+        return self._top(items, limit, offset, ordered)
 
-    __iter__ = _retrieve_filtered
+    def __iter__(self):
+        if self._prefetch:
+            return iter(self.fetch(1000))
+        return self._retrieve_filtered()
 
     def fetch(self, limit, offset=0):
         """Fetch given number of elements from a feed provided by
         AtomMapper.retrieve_all().
 
         """
-        return list(self._retrieve_filtered(limit, offset))
+        items = list(self._retrieve_filtered(limit, offset))
+        prefetch(items, *self._prefetch)
+        return items
 
     def cursor(self):
         if self._query:
@@ -166,10 +272,32 @@ class GDataQuery(object):
         self._cursor = cursor
         return self
 
-    def retrieve_page(self, cursor=None):
-        page, cursor = self._model._mapper.retrieve_page(cursor)
-        gen = (self._model._from_atom(item) for item in page)
-        return (gen, page, cursor)
+    def retrieve_page(self, cursor=None, etag=None):
+        page, cursor, etag = self._model._mapper.retrieve_page(cursor, etag)
+        gen = self._model._from_atoms(page)
+        return (gen, page, cursor, etag)
+
+
+def _path_getter(attrs):
+    """Returns a function reading the attribute at the given path (list of
+    attribute names) from an Atom object, or None if any part of the path is
+    missing.
+
+    """
+    if len(attrs) == 1:
+        attr, = attrs
+        def getter(atom):
+            return getattr(atom, attr, None)
+    elif len(attrs) == 2:
+        first, second = attrs
+        def getter(atom):
+            return getattr(getattr(atom, first, None), second, None)
+    else:
+        def getter(atom):
+            for attr in attrs:
+                atom = getattr(atom, attr, None)
+            return atom
+    return getter
 
 
 class StringProperty(db.Property):
@@ -193,26 +321,36 @@ class StringProperty(db.Property):
 
     user_entry.login.user_name
 
+    Values of the properties with flat_value set to True are stored in the
+    cache rows alongside the Atom object, so that they may be read without
+    parsing it.
+
     """
+    flat_value = True
 
     def __init__(self, attr, *args, **kwargs):
         self.attrs = attr.split('.')
+        self._get_from_atom = _path_getter(self.attrs)
         self.read_only = kwargs.pop('read_only', False)
         choices = kwargs.pop('choices', None)
         if choices is not None:
             kwargs['choices'] = [x[0] for x in choices]
         super(StringProperty, self).__init__(*args, **kwargs)
 
+    def __get__(self, model_instance, model_class):
+        if model_instance is None:
+            return self
+        value = getattr(model_instance, self._attr_name(), None)
+        if value is NOT_RESOLVED:
+            value = self.make_value_from_atom(model_instance._atom)
+            setattr(model_instance, self._attr_name(), value)
+        return value
+
     def make_value_from_atom(self, atom):
         """Given a subclass of atom.AtomBase return corresponding value for this
         property.
         """
-        for attr in self.attrs:
-            if hasattr(atom, attr):
-                atom = getattr(atom, attr)
-            else:
-                return None
-        return atom
+        return self._get_from_atom(atom)
 
     def set_value_on_atom(self, atom, value):
         """Set the property value at the given place within the atom object.
@@ -323,7 +461,8 @@ class ReferenceProperty(StringProperty):
         else:
             reference_id = None
         if reference_id is not None:
-            resolved = getattr(model_instance, self.__resolved_attr_name())
+            resolved = getattr(
+                model_instance, self.__resolved_attr_name(), None)
             if resolved is not None:
                 return resolved
             else:
@@ -335,6 +474,20 @@ class ReferenceProperty(StringProperty):
         else:
             return None
 
+    def prefetch(self, model_instances):
+        """Resolves references of all given instances with a single
+        get_by_key_names() call.
+
+        """
+        pending = [x for x in model_instances
+                   if getattr(x, self.__id_attr_name(), None) is not None and
+                   getattr(x, self.__resolved_attr_name(), None) is None]
+        references = self.reference_class.get_by_key_names(
+            [getattr(x, self.__id_attr_name()) for x in pending])
+        for model_instance, reference in zip(pending, references):
+            if reference is not None:
+                setattr(model_instance, self.__resolved_attr_name(), reference)
+
     def __set__(self, model_instance, value):
         """Set reference."""
         value = self.validate(value)
@@ -369,6 +522,23 @@ class ReferenceProperty(StringProperty):
         return '_RESOLVED' + self._attr_name()
 
 
+def prefetch(model_instances, *properties):
+    """Resolves given properties of all model_instances (which have to be of
+    the same class) in bulk, e.g.:
+
+        prefetch(nicknames, 'user')
+
+    resolves the user of each nickname with a constant number of datastore
+    calls instead of one get_by_key_name() per nickname.
+
+    """
+    if not model_instances:
+        return
+    model_class = model_instances[0].__class__
+    for name in properties:
+        model_class._properties[name].prefetch(model_instances)
+
+
 class _ReverseReferenceProperty(db._ReverseReferenceProperty):
     def __get__(self, model_instance, model_class):
         """Fetches collection of model instances of this collection property."""
@@ -383,6 +553,8 @@ class _ReverseReferenceProperty(db._ReverseReferenceProperty):
 
 
 class EmbeddedModelProperty(StringProperty):
+    flat_value = False
+
     def __init__(self, reference_class, *args, **kwargs):
         self.reference_class = reference_class
         args = args or ('',)
@@ -399,6 +571,8 @@ class EmbeddedModelProperty(StringProperty):
 
 
 class ListProperty(StringProperty):
+    flat_value = False
+
     def __init__(self, item_type, attr, *args, **kwargs):
         self.item_type = item_type
         kwargs.setdefault('default', [])
@@ -406,15 +580,19 @@ class ListProperty(StringProperty):
 
     def __get__(self, model_instance, model_class):
         values = getattr(model_instance, self._attr_name())
-        if values == 'NOT_RESOLVED':
+        if values is NOT_RESOLVED:
             values = super(ListProperty, self).make_value_from_atom(
                 model_instance._atom) or []
-            values = [self.item_type._from_atom(x) for x in values]
+            values = list(self.item_type._from_atoms(values))
             setattr(model_instance, self._attr_name(), values)
         return values
 
     def make_value_from_atom(self, atom):
-        return 'NOT_RESOLVED'
+        return NOT_RESOLVED
+
+    def prefetch(self, model_instances):
+        for model_instance in model_instances:
+            self.__get__(model_instance, None)
 
     def set_value_on_atom(self, atom, value):
         """Set the property value at the given place within the atom object.
@@ -449,26 +627,251 @@ class ExtendedPropertyMapping(StringProperty):
         super(ExtendedPropertyMapping, self).set_value_on_atom(atom, values)
 
 
+class _LocalCache(object):
+    """Size-bounded LRU dictionary whose items expire after given time."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = {}
+        self._tick = 0
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        tick, expires, value = item
+        if expires and expires < time.time():
+            del self._items[key]
+            return None
+        self._tick += 1
+        self._items[key] = (self._tick, expires, value)
+        return value
+
+    def set(self, key, value, ttl=0):
+        self._tick += 1
+        self._items[key] = (self._tick, ttl and time.time() + ttl, value)
+        if len(self._items) > self.max_size:
+            oldest = min(self._items.iteritems(), key=lambda x: x[1][0])
+            del self._items[oldest[0]]
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+
 class _MemcacheDict(object):
+    """Dictionary of per-domain values kept in memcache, with a bounded
+    in-process LRU tier (shared by all the models) in front of it.
+
+    Keys include generation number of the domain, kept in memcache as well.
+    invalidate() increments it, which makes all values of the domain stale
+    on all instances at once. The generation is read once per request, see
+    clear_request_caches(); generations of all the models are fetched with
+    a single memcache_batch RPC.
+
+    Values returned from the local tier are shared between requests, so they
+    must not be modified.
+
+    """
+    LOCAL_SIZE = 64
+
+    _local = _LocalCache(LOCAL_SIZE)
+    _namespaces = []
+    # (namespace, domain) -> generation number read in the current request
+    _generations = {}
+
     def __init__(self, namespace, time=0):
         self.namespace = namespace
         self.time = time
+        self._namespaces.append(namespace)
+
+    @classmethod
+    def clear_request_state(cls):
+        cls._generations.clear()
+
+    @classmethod
+    def _generation_keys(cls):
+        domain = users.get_current_domain_name()
+        if domain is None:
+            return []
+        return ['%s:%s:generation' % (x, domain) for x in cls._namespaces]
+
+    def _generation(self, domain):
+        generation = self._generations.get((self.namespace, domain))
+        if generation is None:
+            key = '%s:%s:generation' % (self.namespace, domain)
+            generation = memcache_batch.get(key)
+            if generation is None:
+                generation = self._new_generation(key)
+            self._generations[(self.namespace, domain)] = generation
+        return generation
+
+    def _new_generation(self, key):
+        # Start from the current time rather than 0, so that values stored
+        # before the generation got evicted don't come back.
+        initial = int(time.time() * 1000)
+        memcache.add(key, initial)
+        return memcache.get(key) or initial
 
     def _key(self, key):
-        domain = users.get_current_user().domain_name
-        return '%s:%s' % (domain, key)
+        domain = users.get_current_domain_name()
+        return '%s:%s:%d:%s' % (
+            self.namespace, domain, self._generation(domain), key)
 
     def __getitem__(self, key):
-        return memcache.get(self._key(key), namespace=self.namespace)
+        key = self._key(key)
+        value = self._local.get(key)
+        if value is None:
+            value = memcache_batch.get(key)
+            if value is not None:
+                self._local.set(key, value, self.time)
+        return value
 
     def __setitem__(self, key, value):
-        try:
-            memcache.set(self._key(key), value, namespace=self.namespace, time=self.time)
-        except TypeError:
-            logging.warning('Couldn\'t store a value in memcache.')
+        key = self._key(key)
+        self._local.set(key, value, self.time)
+        memcache_batch.set(key, value, self.time)
 
     def __delitem__(self, key):
-        memcache.delete(self._key(key), namespace=self.namespace)
+        key = self._key(key)
+        self._local.delete(key)
+        memcache_batch.delete(key)
+
+    def invalidate(self):
+        """Makes all values of the current domain stale."""
+        domain = users.get_current_domain_name()
+        key = '%s:%s:generation' % (self.namespace, domain)
+        generation = memcache.incr(key)
+        if generation is None:
+            generation = self._new_generation(key)
+        self._generations[(self.namespace, domain)] = generation
+
+
+memcache_batch.register_prefetch(_MemcacheDict._generation_keys)
+
+
+class _IdentityMap(object):
+    """Model instances retrieved by key during the current request, keyed by
+    (domain, kind, key_name), so that e.g. resolving members of a group
+    which refer to the same user doesn't query the cache again.
+
+    None is stored for key names which don't exist. The map is cleared at the
+    beginning and at the end of each request, see clear_request_caches().
+
+    """
+    def __init__(self):
+        self._instances = {}
+
+    def _key(self, model_class, key_name):
+        return (users.get_current_domain_name(), model_class.kind(), key_name)
+
+    def lookup(self, model_class, key_name):
+        """Returns (found, instance) tuple."""
+        key = self._key(model_class, key_name)
+        if key in self._instances:
+            return True, self._instances[key]
+        return False, None
+
+    def add(self, model_class, key_name, instance):
+        self._instances[self._key(model_class, key_name)] = instance
+
+    def discard(self, model_class, key_name):
+        self._instances.pop(self._key(model_class, key_name), None)
+
+    def clear(self):
+        self._instances.clear()
+
+
+identity_map = _IdentityMap()
+
+
+def _apply_index_changes(index_key, changes):
+    index = GDataIndex.get(index_key)
+    if not index:
+        return
+    for key, hsh in changes:
+        if key is None:
+            continue
+        try:
+            i = index.keys.index(key)
+        except ValueError:
+            i = None
+        if hsh is None:
+            if i is not None:
+                del index.keys[i]
+                del index.hashes[i]
+        elif i is not None:
+            index.hashes[i] = hsh
+        else:
+            i = bisect.bisect(index.keys, key)
+            index.keys.insert(i, key)
+            index.hashes.insert(i, hsh)
+    # The page no longer matches the feed, so the next refresh mustn't skip
+    # it.
+    index.page_hash = '!'
+    index.etag = None
+    index.put()
+
+
+class _IndexWriteBuffer(object):
+    """Changes of GDataIndex pages made by saving and deleting models during
+    the current request. They're written by flush() at the end of the
+    request, with one transaction per page which applies the changes to the
+    current version of the page, so that concurrent changes aren't lost.
+
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # index key -> list of (key, hash) tuples, hash is None for removed
+        # keys and key is None when the page only has to be refreshed
+        self._changes = {}
+        # (domain, kind, key) -> index key for keys added by this request
+        self._added = {}
+
+    def add(self, index_key, domain, model_class, key, hsh):
+        self._changes.setdefault(index_key, []).append((key, hsh))
+        self._added[(domain, model_class.kind(), key)] = index_key
+
+    def remove(self, index_key, domain, model_class, key):
+        self._changes.setdefault(index_key, []).append((key, None))
+        self._added.pop((domain, model_class.kind(), key), None)
+
+    def touch(self, index_key):
+        self._changes.setdefault(index_key, []).append((None, None))
+
+    def locate(self, domain, model_class, key):
+        """Returns key of the page the key was added to by this request."""
+        return self._added.get((domain, model_class.kind(), key))
+
+    def flush(self):
+        changes = self._changes
+        self.clear()
+        for index_key, index_changes in changes.iteritems():
+            try:
+                db.run_in_transaction(
+                    _apply_index_changes, index_key, index_changes)
+            except (db.Error, apiproxy_errors.CapabilityDisabledError):
+                # The GData changes are already made, the next precache of
+                # the page brings it up to date.
+                logging.exception('Couldn\'t update %s index page.' %
+                                  index_key.name())
+
+
+index_writes = _IndexWriteBuffer()
+
+
+def clear_request_caches():
+    """Forgets what's been cached for the current request only. Called by
+    crlib.middleware.RequestCacheMiddleware.
+
+    """
+    identity_map.clear()
+    index_writes.clear()
+    _MemcacheDict.clear_request_state()
 
 
 class _GDataModelMetaclass(db.PropertiedClass):
@@ -492,6 +895,19 @@ class _GDataModelMetaclass(db.PropertiedClass):
 
         return new_cls
 
+    def __init__(cls, name, bases, attrs):
+        super(_GDataModelMetaclass, cls).__init__(name, bases, attrs)
+        # Row decoders used by _from_atoms() and crlib.models.encode_model().
+        # They call make_value_from_atom() bound methods directly, skipping
+        # Property.__set__() and validation, as the values come from GData.
+        # cls._properties are set up by PropertiedClass.__init__().
+        props = cls._properties.values()
+        cls._row_decoder = tuple(
+            (prop._attr_name(), prop.make_value_from_atom) for prop in props)
+        cls._flat_decoder = tuple(
+            (prop.name, prop.make_value_from_atom)
+            for prop in props if prop.flat_value)
+
 
 class Model(object):
     """db.BaseModel (and usual Django model) replacement.
@@ -519,6 +935,11 @@ class Model(object):
 
     __metaclass__ = _GDataModelMetaclass
 
+    _atom_value = None
+    # Atom object of instances created from cache rows is decoded lazily, see
+    # _from_cached().
+    _encoded_atom = None
+
     def __init__(self, **kwargs):
         self._atom = kwargs.pop('_atom', None)
         self._cached = kwargs.pop('_cached', None)
@@ -530,6 +951,18 @@ class Model(object):
                 value = prop.default_value()
             prop.__set__(self, value)
 
+    def _get_atom(self):
+        if self._encoded_atom is not None:
+            self._atom_value = decode_atom(self._encoded_atom, self._mapper)
+            self._encoded_atom = None
+        return self._atom_value
+
+    def _set_atom(self, atom):
+        self._atom_value = atom
+        self._encoded_atom = None
+
+    _atom = property(_get_atom, _set_atom)
+
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.key())
 
@@ -540,6 +973,8 @@ class Model(object):
         return kinds == 0 and cmp(self.key(), other.key()) or kinds
 
     def key(self):
+        if self._encoded_atom is not None and self._cached:
+            return self._cached._gdata_key_name
         return self._mapper.key(self._atom)
 
     @classmethod
@@ -574,11 +1009,18 @@ class Model(object):
         if settings.READ_ONLY:
             return self
 
+        old_key = self.is_saved() and self.key()
         atom = self._get_updated_atom()
 
         if self.is_saved():
             if hasattr(self._mapper, 'update'):
-                self._atom = self._mapper.update(atom, self._atom)
+                from crlib import errors
+                try:
+                    self._atom = self._mapper.update(atom, self._atom)
+                except errors.MembershipUpdateError, e:
+                    if e.atom is not None:
+                        self._save_partial_update(e.atom, old_key)
+                    raise
             else:
                 self._atom = atom
             self._update_cache()
@@ -589,8 +1031,10 @@ class Model(object):
                 self._atom = atom
             self._create_cache()
 
-        del self._cache['item:%s' % self.key()]
-        del self._cache['retrieve_all']
+        if old_key:
+            identity_map.discard(self.__class__, old_key)
+        identity_map.add(self.__class__, self.key(), self)
+        self._cache.invalidate()
         return self
     put = save
 
@@ -615,69 +1059,91 @@ class Model(object):
                 except errors.EntityDoesNotExistError:
                     pass
             self._delete_cache()
-            del self._cache['item:%s' % self.key()]
-            del self._cache['retrieve_all']
+            identity_map.add(self.__class__, self.key(), None)
+            self._cache.invalidate()
             del self
 
     def is_saved(self):
         return self._atom is not None
 
+    def _get_cache_index(self, key):
+        """Returns key of the GDataIndex page listing the key. Rows created
+        by the precache don't reference their page, so it's looked up.
+
+        """
+        domain = self._cached._domain
+        index_key = index_writes.locate(domain, self.__class__, key)
+        if index_key:
+            return index_key
+        return GDataIndex.all(keys_only=True).filter('domain', domain).filter(
+            'model_class', self.__class__.__name__).filter(
+                'keys', key).get()
+
+    def _save_partial_update(self, atom, old_key):
+        """Caches atom with the changes which were made before the update
+        failed. The instance keeps the requested values, so saving it again
+        retries the rest of the changes.
+
+        """
+        self._atom = atom
+        applied = self._from_atom(atom)
+        applied._cached = self._cached
+        applied._update_cache()
+        identity_map.discard(self.__class__, old_key)
+        self._cache.invalidate()
+
     def _update_cache(self):
         if self._cached:
+            index_key = self._get_cache_index(self._cached._gdata_key_name)
             self._cached.update(self)
-            if self._cached._index:
-                self._cached._index.page_hash = '!'
-                db.put([self._cached, self._cached._index])
-            else:
-                self._cached.put()
+            self._cached.put()
+            if index_key:
+                index_writes.touch(index_key)
 
     def _get_index_for_new_cache(self, domain):
         model_class = self.__class__.__name__
-        index = GDataIndex.all().filter('domain', domain).filter(
-            'model_class', model_class).filter(
+        index_key = GDataIndex.all(keys_only=True).filter(
+            'domain', domain).filter('model_class', model_class).filter(
                 'keys >', self.key()).order('keys').get()
-        if not index:
-            index = GDataIndex.all().filter('domain', domain).filter(
-                'model_class', model_class).get()
-        return index
+        if not index_key:
+            index_key = GDataIndex.all(keys_only=True).filter(
+                'domain', domain).filter('model_class', model_class).get()
+        return index_key
 
     def _create_cache(self):
         if hasattr(self._meta, 'cache_model'):
-            new_key = self.key()
-            hsh = hashlib.sha1(str(self._atom)).hexdigest()
-            domain = users.get_current_domain().domain
-            index = self._get_index_for_new_cache(domain)
-            cached = self._meta.cache_model.from_model(
-                self,
-                key_name=hsh,
+            return self._create_caches([self])[0]
+
+    @classmethod
+    def _create_caches(cls, instances):
+        """Writes cache rows of the given saved instances with a single put.
+        Returns the rows.
+
+        """
+        domain = users.get_current_domain().domain
+        rows, index_keys = [], []
+        for instance in instances:
+            rows.append(cls._meta.cache_model.from_model(
+                instance,
+                key_name=hashlib.sha1(str(instance._atom)).hexdigest(),
                 _domain=domain,
-                _atom=self._atom,
-                _index=index,
-                _gdata_key_name=new_key,
-            )
-            if index:
-                for i, key in enumerate(index.keys):
-                    if key > new_key:
-                        break
-                else:
-                    i = 0
-                index.keys.insert(i, new_key)
-                index.hashes.insert(i, hsh)
-                index.page_has = '!'
-                db.put([cached, index])
-            else:
-                cached.put()
-            return cached
+                _atom=instance._atom,
+                _gdata_key_name=instance.key(),
+            ))
+            index_keys.append(instance._get_index_for_new_cache(domain))
+        db.put(rows)
+        for instance, row, index_key in zip(instances, rows, index_keys):
+            if index_key:
+                index_writes.add(index_key, domain, cls, instance.key(),
+                                 row.key().name())
+        return rows
 
     def _delete_cache(self):
         if self._cached:
-            index = self._cached._index
-            if index:
-                index.page_hash = '!'
-                idx = index.keys.index(self.key())
-                del index.keys[idx]
-                del index.hashes[idx]
-                index.put()
+            index_key = self._get_cache_index(self.key())
+            if index_key:
+                index_writes.remove(index_key, self._cached._domain,
+                                    self.__class__, self.key())
             self._cached.delete()
 
     @classmethod
@@ -686,27 +1152,96 @@ class Model(object):
 
     @classmethod
     def get_by_key_name(cls, key_name, cached=True):
+        """Returns the instance with given key name or None.
+
+        Instances are remembered in identity_map for the rest of the request.
+        With cached=False, GData API is always asked and the map is
+        refreshed with the result.
+
+        """
+        if cached:
+            found, instance = identity_map.lookup(cls, key_name)
+            if found:
+                return instance
         if cached and hasattr(cls._meta, 'cache_model'):
             domain = users.get_current_domain().domain
             cached = cls._meta.cache_model.all().filter(
                 '_domain', domain).filter(
                     '_gdata_key_name', key_name).get()
-            return cls._from_cached(cached)
+            instance = cls._from_cached(cached)
         else:
             try:
                 atom = cls._mapper.retrieve(key_name)
-                return atom and cls._from_atom(atom) or None
+                instance = atom and cls._from_atom(atom) or None
             except Exception:
                 return None
+        identity_map.add(cls, key_name, instance)
+        return instance
+
+    @classmethod
+    def get_by_key_names(cls, key_names):
+        """Returns a list of instances (or Nones) with given key names.
+
+        For models with a cache, the rows are found through GDataIndex pages
+        and fetched with a single batch get instead of a query per key name
+        (only the key names missing from the pages are queried).
+
+        """
+        instances = {}
+        missing = []
+        for key_name in key_names:
+            found, instance = identity_map.lookup(cls, key_name)
+            if found:
+                instances[key_name] = instance
+            elif key_name not in instances:
+                instances[key_name] = None
+                missing.append(key_name)
+        if missing and hasattr(cls._meta, 'cache_model'):
+            retrieved = cls._get_cached_by_key_names(missing)
+            for key_name in missing:
+                instance = retrieved.get(key_name)
+                instances[key_name] = instance
+                identity_map.add(cls, key_name, instance)
+        else:
+            for key_name in missing:
+                instances[key_name] = cls.get_by_key_name(key_name)
+        return [instances[key_name] for key_name in key_names]
+
+    @classmethod
+    def _get_cached_by_key_names(cls, key_names):
+        domain = users.get_current_domain().domain
+        indexes = GDataIndex.all().filter('domain', domain).filter(
+            'model_class', cls.__name__).filter(
+                'keys >=', min(key_names)).filter(
+                    'keys <=', max(key_names)).order('keys')
+        hashes = {}
+        for index in indexes:
+            hashes.update(zip(index.keys, index.hashes))
+        rows = cls._meta.cache_model.get_by_key_name(
+            [hashes[x] for x in key_names if x in hashes])
+        instances = dict((row._gdata_key_name, cls._from_cached(row))
+                         for row in rows if row)
+        # Rows which aren't on any page (yet, e.g. created in this request,
+        # see index_writes) are looked up like in get_by_key_name.
+        for key_name in key_names:
+            if key_name not in instances:
+                row = cls._meta.cache_model.all().filter(
+                    '_domain', domain).filter(
+                        '_gdata_key_name', key_name).get()
+                if row:
+                    instances[key_name] = cls._from_cached(row)
+        return instances
 
     @classmethod
     def get_by_key_name_and_check(cls, key_name):
         from crlib import errors
         obj = cls.get_by_key_name(key_name, cached=False)
         if not obj:
+            identity_map.discard(cls, key_name)
             cached = cls.get_by_key_name(key_name)
             if cached:
                 cached._delete_cache()
+            identity_map.add(cls, key_name, None)
             raise errors.EntityDoesNotExistError()
         return obj
 
@@ -726,16 +1261,48 @@ class Model(object):
     @classmethod
     def _from_atom(cls, atom):
         """Creates new Model instance from given AtomBase object."""
-        props = {'_atom' : atom}
-        props.update(cls._atom_to_kwargs(atom))
-        return cls(**props)
+        return cls._from_atoms((atom,)).next()
+
+    @classmethod
+    def _from_atoms(cls, atoms):
+        """Yields new Model instances created from given AtomBase objects.
+
+        atoms may be a stream (e.g. mappers._FeedStream); it's consumed
+        lazily. Property values are set as read from the atoms, without
+        validation.
+
+        """
+        new = cls.__new__
+        row_decoder = cls._row_decoder
+        for atom in atoms:
+            instance = new(cls)
+            attrs = instance.__dict__
+            attrs['_atom_value'] = atom
+            attrs['_cached'] = None
+            for attr_name, make_value in row_decoder:
+                attrs[attr_name] = make_value(atom)
+            yield instance
 
     @classmethod
     def _from_cached(cls, cached):
-        import pickle
+        """Creates new Model instance from the _CacheBase row.
+
+        Property values are taken from the row as they are, without
+        validation. The Atom object and values of properties which aren't
+        stored in the row (e.g. ListProperty) are read only when accessed.
+
+        """
         if not cached:
             return None
-        instance = cls._from_atom(pickle.loads(cached._atom))
+        values, atom_data = decode_model(cached._atom)
+        if values is None:
+            instance = cls._from_atom(atom_data)
+        else:
+            instance = cls.__new__(cls)
+            instance._encoded_atom = atom_data
+            for prop in cls._properties.itervalues():
+                setattr(instance, prop._attr_name(),
+                        values.get(prop.name, NOT_RESOLVED))
         instance._cached = cached
         return instance
 
@@ -755,9 +1322,28 @@ class AtomMapper(object):
     retrieve_all() -> returns all instances of the given Atom object, used by
         GDataQuery.fetch();
     retrieve() -> used to retrieve Model instance by its key_name, i.e. it's
-        called by Model.get_by_key_name().
+        called by Model.get_by_key_name();
+    retrieve_page() -> returns (entries, cursor, etag) tuple for a single page
+        of the feed, used by cache.update_cache(). If etag parameter is given
+        and the page hasn't changed errors.NotModifiedError is raised.
+
+    Mappers of feeds which may be read starting at any entry set SHARDING and
+    provide shard_cursor(), so that cache.plan_precache() can read parts of
+    the feed concurrently:
+
+    SHARDING = 'key' -> the feed is sorted by key and shard_cursor(key)
+        returns cursor of the page starting at the given key. SHARD_SIZE
+        should be smaller than size of the feed page;
+    SHARDING = 'offset' -> shard_cursor(n) returns cursor of n-th page of
+        SHARD_SIZE entries.
 
     """
+    SHARDING = None
+    #: Prefix of ETags computed from the response body for feeds which don't
+    #: support them natively.
+    BODY_ETAG_PREFIX = 'W/"sha1:'
+    #: Redirects followed by _get_feed(), as many as GDataService.Get() does.
+    MAX_REDIRECTS = 4
     @property
     def service(self):
         if not hasattr(self, 'create_service'):
@@ -767,18 +1353,78 @@ class AtomMapper(object):
         if not user:
             raise users.LoginRequiredError()
 
-        domain = user.domain_name
-        service = self.create_service(domain)
-        if isinstance(service, GDataService):
-            from gdata.alt.appengine import AppEngineHttpClient
-            service.http_client = AppEngineHttpClient(deadline=10)
         auth_method = getattr(self, 'auth_method', 'client_login')
-        if auth_method == 'oauth':
-            user.oauth_login(service)
-        else:
-            user.client_login(service)
 
-        return service
+        def create():
+            service = self.create_service(user.domain_name)
+            if isinstance(service, GDataService):
+                from gdata.alt.appengine import AppEngineHttpClient
+                service.http_client = AppEngineHttpClient(deadline=10)
+            if auth_method == 'oauth':
+                user.oauth_login(service)
+            else:
+                user.client_login(service)
+            return service
+
+        # Services are shared by the mappers of the same class for the rest
+        # of the request, see crauth.users.context.
+        return users.context.service(
+            user, (self.__class__.__name__, auth_method), create)
+
+    def _get_feed(self, service, uri, converter, etag=None, **kwargs):
+        """Conditionally retrieves the feed at the given uri.
+
+        Returns (feed, etag) tuple where feed is converter(response_body).
+        If the server doesn't send ETag header, SHA-1 of the response body is
+        used instead, so unchanged pages are detected before they're parsed
+        either way.
+
+        """
+        from atom.http_core import HttpRequest
+        from gdata.client import NotModified
+        from gdata.service import RequestError
+        from crlib.errors import NotModifiedError
+
+        headers = {}
+        if etag and not etag.startswith(self.BODY_ETAG_PREFIX):
+            headers['If-None-Match'] = etag
+        if isinstance(service, GDClient):
+            try:
+                response = service.request(
+                    'GET', uri, http_request=HttpRequest(headers=headers),
+                    **kwargs)
+            except NotModified:
+                raise NotModifiedError()
+        else:
+            redirects = self.MAX_REDIRECTS
+            response = service.request('GET', uri, headers=headers)
+            while response.status == 302:
+                location = response.getheader('Location') or \
+                        response.getheader('location')
+                if location is None:
+                    raise RequestError, {'status': response.status,
+                        'reason': '302 received without Location header',
+                        'body': response.read()}
+                if redirects <= 0:
+                    raise RequestError, {'status': response.status,
+                        'reason': 'Too many redirects',
+                        'body': response.read()}
+                response.read()
+                redirects -= 1
+                response = service.request('GET', location, headers=headers)
+            if response.status == 304:
+                raise NotModifiedError()
+            elif response.status != 200:
+                raise RequestError, {'status': response.status,
+                    'reason': response.reason, 'body': response.read()}
+        body = response.read()
+        new_etag = response.getheader('ETag') or response.getheader('etag')
+        if not new_etag:
+            new_etag = '%s%s"' % (
+                self.BODY_ETAG_PREFIX, hashlib.sha1(body).hexdigest())
+        if new_etag == etag:
+            raise NotModifiedError()
+        return (converter(body), new_etag)
 
     def clone_atom(self, atom):
         """Make a copy of atom object."""
@@ -79,7 +79,65 @@ GROUP_EMAIL_PERMISSIONS = (
 
 # Mappers
 
+class _FeedStream(object):
+    """Iterates over entries of an Atom feed without building the whole feed
+    tree.
+
+    The feed is parsed with iterparse() and each entry is converted to
+    entry_class right after its closing tag is read. Element subtree of the
+    entry is thrown away afterwards, so memory use doesn't depend on the
+    number of entries in the feed. The header of the feed (which precedes the
+    entries) is parsed up front, so next_link is available before iteration.
+
+    The stream may be iterated only once.
+
+    """
+
+    ENTRY_TAG = '{http://www.w3.org/2005/Atom}entry'
+    LINK_TAG = '{http://www.w3.org/2005/Atom}link'
+
+    def __init__(self, body, entry_class):
+        from cStringIO import StringIO
+        from atom import ElementTree
+        self._entry_class = entry_class
+        self._events = ElementTree.iterparse(StringIO(body), ('start', 'end'))
+        self._root = None
+        self._depth = 0
+        self.next_link = None
+        self._read_header()
+
+    def _read_header(self):
+        for event, elem in self._events:
+            if event == 'start':
+                self._depth += 1
+                if self._depth == 1:
+                    self._root = elem
+                elif self._depth == 2 and elem.tag == self.ENTRY_TAG:
+                    return
+            else:
+                if self._depth == 2 and elem.tag == self.LINK_TAG and \
+                   elem.get('rel') == 'next':
+                    self.next_link = elem.get('href')
+                self._depth -= 1
+
+    def __iter__(self):
+        from atom import _CreateClassFromElementTree
+        for event, elem in self._events:
+            if event == 'start':
+                self._depth += 1
+                continue
+            if self._depth == 2 and elem.tag == self.ENTRY_TAG:
+                yield _CreateClassFromElementTree(self._entry_class, elem)
+                self._root.clear()
+            self._depth -= 1
+
+
 class UserEntryMapper(AtomMapper):
+    SHARDING = 'key'
+    # Feed pages have 100 users. A shard smaller than that usually ends
+    # within the first page, so its ETag is enough to tell it hasn't changed.
+    SHARD_SIZE = 90
+
     @classmethod
     def create_service(cls, domain):
         from gdata.apps import service
@@ -122,15 +180,21 @@ class UserEntryMapper(AtomMapper):
                                 new_name=atom.login.user_name)
         return new_atom
 
-    def retrieve_page(self, cursor=None):
-        if cursor:
-            from gdata.apps import UserFeedFromString
-            feed = self.service.Get(cursor, converter=UserFeedFromString)
-        else:
-            feed = self.service.RetrievePageOfUsers()
-        cursor = feed.GetNextLink()
-        cursor = cursor and cursor.href
-        return (feed.entry, cursor)
+    def retrieve_page(self, cursor=None, etag=None):
+        from gdata.apps import UserEntry
+        from gdata.apps.service import API_VER
+        service = self.service
+        uri = cursor or '%s/user/%s' % (service._baseURL(), API_VER)
+        feed, etag = self._get_feed(
+            service, uri, lambda body: _FeedStream(body, UserEntry), etag)
+        return (feed, feed.next_link, etag)
+
+    def shard_cursor(self, user_name):
+        import urllib
+        from gdata.apps.service import API_VER
+        return '%s/user/%s?%s' % (
+            self.service._baseURL(), API_VER,
+            urllib.urlencode({'startUsername': user_name}))
 
     def retrieve(self, user_name):
         return self.service.RetrieveUser(user_name)
@@ -265,37 +329,80 @@ class GroupEntryMapper(AtomMapper):
             except AppsForYourDomainException:
                 raise NetworkError
 
-    def _update_members(self, atom, old_atom):
+    def _update_members(self, atom, old_atom, requests):
         old_members = set(old_atom.members)
         new_members = set(atom.members)
 
         for member in old_members - new_members:
-            self.service.RemoveMemberFromGroup(member.memberId, atom.groupId)
+            requests.add(member.memberId, 'RemoveMemberFromGroup',
+                         member.memberId, atom.groupId)
 
         for member in new_members - old_members:
-            self.service.AddMemberToGroup(member.memberId, atom.groupId)
+            requests.add(member.memberId, 'AddMemberToGroup',
+                         member.memberId, atom.groupId)
 
-    def _update_owners(self, atom, old_atom):
+    def _update_owners(self, atom, old_atom, requests):
         old_owners = set(old_atom.owners)
         new_owners = set(atom.owners)
 
         for owner in old_owners - new_owners:
-            self.service.RemoveOwnerFromGroup(owner.email, atom.groupId)
+            requests.add(owner.email, 'RemoveOwnerFromGroup',
+                         owner.email, atom.groupId)
 
         for owner in new_owners - old_owners:
-            self.service.AddOwnerToGroup(owner.email, atom.groupId)
+            requests.add(owner.email, 'AddOwnerToGroup',
+                         owner.email, atom.groupId)
 
     def update(self, atom, old_atom):
-        self._update_members(atom, old_atom)
-        self._update_owners(atom, old_atom)
-
+        from crlib.errors import MembershipUpdateError
+        from crlib.parallel_urlfetch import ParallelRequests
+        service = self.service
+        requests = ParallelRequests(service)
+        self._update_members(atom, old_atom, requests)
+        self._update_owners(atom, old_atom, requests)
+        failed = requests.run()
+
+        updated = atom
         if atom != old_atom:
-            updated_group = self.service.UpdateGroup(
+            updated = GroupEntry(self, service.UpdateGroup(
                 atom.groupId, atom.groupName, atom.description,
-                atom.emailPermission)
-            return GroupEntry(self, updated_group)
-        else:
-            return atom
+                atom.emailPermission))
+        if failed:
+            raise MembershipUpdateError(
+                failed, self._applied(atom, old_atom, updated, failed))
+        return updated
+
+    def _applied(self, atom, old_atom, updated, failed):
+        """Returns copy of updated with the members and owners of atom,
+        except the failed changes which are left as in old_atom.
+
+        """
+        failed = dict(failed)
+        applied = GroupEntry(self, updated)
+        for name, key in (('members', 'memberId'), ('owners', 'email')):
+            old = set(getattr(old_atom, name))
+            new = set(getattr(atom, name))
+            applied[name] = [
+                x for x in getattr(atom, name)
+                if x in old or x[key] not in failed] + [
+                x for x in getattr(old_atom, name)
+                if x not in new and x[key] in failed]
+        return applied
+
+    def add_member_to_groups(self, member_id, group_ids):
+        """Adds member to all of the given groups concurrently. Groups the
+        member already belongs to are skipped.
+
+        """
+        from crlib.errors import EntityExistsError, MembershipUpdateError
+        from crlib.parallel_urlfetch import ParallelRequests
+        requests = ParallelRequests(self.service)
+        for group_id in group_ids:
+            requests.add(group_id, 'AddMemberToGroup', member_id, group_id)
+        failed = [(group_id, error) for group_id, error in requests.run()
+                  if not isinstance(error, EntityExistsError)]
+        if failed:
+            raise MembershipUpdateError(failed)
 
     @apps_for_your_domain_exception_wrapper
     def delete(self, atom):
@@ -309,18 +416,15 @@ class GroupEntryMapper(AtomMapper):
                 self.service._PropertyEntry2Dict(property_entry))
         return [GroupEntry(self, entry) for entry in properties_list]
 
-    def retrieve_page(self, cursor=None):
-        if cursor:
-            from gdata.apps import PropertyFeedFromString
-            feed = self.service.Get(cursor, converter=PropertyFeedFromString)
-        else:
-            uri = self.service._ServiceUrl('group', True, '', '', '')
-            feed = self.service._GetPropertyFeed(uri)
-        cursor = feed.GetNextLink()
-        cursor = cursor and cursor.href
-        feed = [GroupEntry(self, self.service._PropertyEntry2Dict(entry))
-                for entry in feed.entry]
-        return (feed, cursor)
+    def retrieve_page(self, cursor=None, etag=None):
+        from gdata.apps import PropertyEntry
+        service = self.service
+        uri = cursor or service._ServiceUrl('group', True, '', '', '')
+        feed, etag = self._get_feed(
+            service, uri, lambda body: _FeedStream(body, PropertyEntry), etag)
+        entries = (GroupEntry(self, service._PropertyEntry2Dict(entry))
+                   for entry in feed)
+        return (entries, feed.next_link, etag)
 
     def retrieve(self, group_id):
         return GroupEntry(self, self.service.RetrieveGroup(group_id))
@@ -345,15 +449,14 @@ class NicknameEntryMapper(AtomMapper):
         return self.service.CreateNickname(
             atom.login.user_name, atom.nickname.name)
 
-    def retrieve_page(self, cursor=None):
-        if cursor:
-            from gdata.apps import NicknameFeedFromString
-            feed = self.service.Get(cursor, converter=NicknameFeedFromString)
-        else:
-            feed = self.service.RetrievePageOfNicknames()
-        cursor = feed.GetNextLink()
-        cursor = cursor and cursor.href
-        return (feed.entry, cursor)
+    def retrieve_page(self, cursor=None, etag=None):
+        from gdata.apps import NicknameEntry
+        from gdata.apps.service import API_VER
+        service = self.service
+        uri = cursor or '%s/nickname/%s' % (service._baseURL(), API_VER)
+        feed, etag = self._get_feed(
+            service, uri, lambda body: _FeedStream(body, NicknameEntry), etag)
+        return (feed, feed.next_link, etag)
 
     def retrieve(self, nickname):
         return self.service.RetrieveNickname(nickname)
@@ -425,6 +528,8 @@ class SharedContactEntryMapper(AtomMapper):
         r'(?:[^/]+)/full/(?P<id>[a-f0-9]+)$')
     SELF_LINK = 'http://www.google.com/m8/feeds/contacts/%s/full/%s'
     ITEMS_PER_PAGE = 100
+    SHARDING = 'offset'
+    SHARD_SIZE = ITEMS_PER_PAGE
 
     @classmethod
     def create_service(cls, domain):
@@ -468,19 +573,31 @@ class SharedContactEntryMapper(AtomMapper):
         return self.service.get_entry(
             link, desired_class=contacts.data.ContactEntry)
 
-    def retrieve_page(self, cursor=None):
-        if cursor:
-            feed = self._retrieve_subset(
-                limit=self.ITEMS_PER_PAGE, offset=cursor)
-        else:
-            feed = self._retrieve_subset(limit=self.ITEMS_PER_PAGE)
+    def retrieve_page(self, cursor=None, etag=None):
+        from atom.core import parse
+        from gdata.client import get_xml_version
+        from gdata.contacts.client import ContactsQuery
+        service = self.service
+        query = ContactsQuery()
+        query.max_results = self.ITEMS_PER_PAGE
+        query.start_index = int(cursor or 1)
+
+        def converter(body):
+            return parse(body, contacts.data.ContactsFeed,
+                         version=get_xml_version(service.api_version))
+
+        feed, etag = self._get_feed(
+            service, service.GetFeedUri(), converter, etag, query=query)
         total_results = int(feed.total_results.text)
         start_index = int(feed.start_index.text)
         if start_index - 1 + len(feed.entry) < total_results:
             cursor = start_index + self.ITEMS_PER_PAGE
         else:
             cursor = None
-        return (feed.entry, cursor)
+        return (feed.entry, cursor, etag)
+
+    def shard_cursor(self, number):
+        return number * self.SHARD_SIZE + 1
 
     def _retrieve_subset(self, limit=1000, offset=1):
         from gdata.contacts.client import ContactsQuery
@@ -651,6 +768,10 @@ class CalendarResourceEntryMapper(AtomMapper):
                 logging.exception('CalendarResourceEntryMapper.resource')
             return None
 
+    def retrieve_page(self, cursor=None, etag=None):
+        feed = self.service.get_resource_feed(uri=cursor)
+        return (feed.entry, feed.find_next_link(), None)
+
     def retrieve_all(self):
         return self.service.get_resource_feed().entry
 
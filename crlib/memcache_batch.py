@@ -0,0 +1,127 @@
+"""Request-level batching of memcache calls.
+
+The first get() of a namespace in a request fetches the key with a single
+get_multi() together with all the keys announced by want() and by the
+functions registered with register_prefetch(). Fetched values (and misses)
+are remembered until the end of the request.
+
+set() updates the remembered value right away, but the values are written
+to memcache by flush() with one set_multi() per (namespace, time). flush()
+is called by crlib.middleware.RequestCacheMiddleware at the end of each
+request. Values which other requests need right away (locks, progress
+counters) should still be set with memcache directly, and remember()ed.
+
+"""
+import logging
+from google.appengine.api import memcache
+
+
+__all__ = ['want', 'get', 'set', 'remember', 'delete', 'flush', 'reset',
+           'register_prefetch', 'stats']
+
+
+_prefetchers = []
+
+
+def register_prefetch(func):
+    """func() should return list of keys (in the default namespace) which
+    are likely to be read in the current request.
+
+    """
+    _prefetchers.append(func)
+
+
+class _Batch(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # (namespace, key) -> value, None for misses
+        self._values = {}
+        # namespace -> {key: True} for keys to be fetched with the next
+        # get_multi() (the module's set() shadows the builtin)
+        self._wanted = {}
+        # (namespace, time) -> {key: value}
+        self._pending = {}
+        self._prefetched = False
+        self.hits = self.misses = self.rpcs = 0
+
+    def want(self, keys, namespace=None):
+        wanted = self._wanted.setdefault(namespace, {})
+        for key in keys:
+            if (namespace, key) not in self._values:
+                wanted[key] = True
+
+    def get(self, key, namespace=None):
+        if not self._prefetched:
+            self._prefetched = True
+            for func in _prefetchers:
+                self.want(func())
+        if (namespace, key) not in self._values:
+            keys = self._wanted.pop(namespace, {})
+            keys[key] = True
+            values = memcache.get_multi(keys.keys(), namespace=namespace)
+            self.rpcs += 1
+            for k in keys:
+                self._values[(namespace, k)] = values.get(k)
+        value = self._values[(namespace, key)]
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, time=0, namespace=None):
+        self._values[(namespace, key)] = value
+        self._pending.setdefault((namespace, time), {})[key] = value
+
+    def remember(self, key, value, namespace=None):
+        """Updates the remembered value only, e.g. after the value was set
+        with memcache directly.
+
+        """
+        self._values[(namespace, key)] = value
+
+    def delete(self, key, namespace=None):
+        self._values[(namespace, key)] = None
+        for (pending_namespace, _), mapping in self._pending.iteritems():
+            if pending_namespace == namespace:
+                mapping.pop(key, None)
+        memcache.delete(key, namespace=namespace)
+        self.rpcs += 1
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        for (namespace, time), mapping in pending.iteritems():
+            if not mapping:
+                continue
+            self.rpcs += 1
+            try:
+                memcache.set_multi(mapping, time=time, namespace=namespace)
+            except TypeError:
+                # Some value couldn't be pickled, store the others one by one.
+                for key, value in mapping.iteritems():
+                    try:
+                        memcache.set(key, value, time=time,
+                                     namespace=namespace)
+                    except TypeError:
+                        logging.warning(
+                            'Couldn\'t store a value in memcache: %s' % key)
+        if self.rpcs:
+            logging.debug('memcache: %d hits, %d misses, %d RPCs' % (
+                self.hits, self.misses, self.rpcs))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'rpcs': self.rpcs}
+
+
+_batch = _Batch()
+
+want = _batch.want
+get = _batch.get
+set = _batch.set
+remember = _batch.remember
+delete = _batch.delete
+flush = _batch.flush
+reset = _batch.reset
+stats = _batch.stats
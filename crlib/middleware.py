@@ -2,6 +2,9 @@ from django.utils.cache import patch_vary_headers
 from django.utils import translation
 from django.http import HttpResponseRedirect
 from crgappspanel.models import Preferences
+from crlib.gdata_wrapper import clear_request_caches, index_writes
+from crlib import memcache_batch, scheduler
+from crauth import users
 
 
 class LocaleMiddleware(object):
@@ -28,3 +31,31 @@ class LocaleMiddleware(object):
             response['Content-Language'] = translation.get_language()
         translation.deactivate()
         return response
+
+
+class RequestCacheMiddleware(object):
+    """Makes request-level caches of crlib.gdata_wrapper (e.g. identity_map),
+    crlib.memcache_batch and crauth.users.context live for a single request.
+    Deferred GDataIndex and memcache writes are sent when the response is
+    ready.
+
+    """
+    def process_request(self, request):
+        memcache_batch.flush()
+        memcache_batch.reset()
+        clear_request_caches()
+        users.context.reset()
+
+    def process_response(self, request, response):
+        domain = users.get_current_domain_name()
+        if domain and not ('HTTP_X_APPENGINE_TASKNAME' in request.META or
+                           'HTTP_X_APPENGINE_CRON' in request.META):
+            scheduler.mark_active(domain)
+        try:
+            index_writes.flush()
+        finally:
+            memcache_batch.flush()
+            memcache_batch.reset()
+            clear_request_caches()
+            users.context.reset()
+        return response
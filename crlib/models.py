@@ -1,9 +1,11 @@
 import logging
 import pickle
 import re
+import zlib
 from appengine_django.models import BaseModel
 from google.appengine.ext import db
 from google.appengine.api import memcache
+from crlib import search
 
 
 RE_SPLIT = re.compile(r'[^\w\d]+', re.UNICODE)
@@ -21,6 +23,74 @@ def _model_kwargs(model_instance, fields):
     return kwargs
 
 
+# Format of _CacheBase._atom values. Rows written before the format was
+# versioned hold the pickled Atom object (which starts with '\x80').
+CACHE_FORMAT_VERSION = 1
+
+
+def encode_model(model_instance):
+    """Returns compact representation of the given gdata_wrapper.Model instance
+    to be stored in _CacheBase._atom.
+
+    It consists of values of the properties which may be read without parsing
+    the Atom object (see StringProperty.flat_value) and the serialized Atom
+    object itself: XML for AtomBase/XmlElement entries, dictionary of plain
+    values for _DictAtom ones.
+
+    """
+    from atom.core import XmlElement
+    atom = model_instance._atom
+    values = {}
+    for name, make_value in model_instance._flat_decoder:
+        values[name] = make_value(atom)
+    if isinstance(atom, dict):
+        kind, class_path = 'dict', None
+        payload = dict((key, value) for key, value in atom.iteritems()
+                       if value is None or isinstance(value, basestring))
+    else:
+        class_path = '%s.%s' % (atom.__class__.__module__,
+                                atom.__class__.__name__)
+        if isinstance(atom, XmlElement):
+            kind, payload = 'xml', atom.to_string()
+        else:
+            kind, payload = 'atom', str(atom)
+    data = pickle.dumps((values, kind, class_path, payload),
+                        pickle.HIGHEST_PROTOCOL)
+    return chr(CACHE_FORMAT_VERSION) + zlib.compress(data)
+
+
+def decode_model(value):
+    """Returns (values, atom_data) tuple from the value created by
+    encode_model(). atom_data should be passed to decode_atom() when the Atom
+    object is actually needed.
+
+    For rows in the legacy format values is None and atom_data is the Atom
+    object itself.
+
+    """
+    if value[0] == '\x80':
+        return (None, pickle.loads(value))
+    if ord(value[0]) != CACHE_FORMAT_VERSION:
+        raise ValueError('Unknown cache format: %d' % ord(value[0]))
+    values, kind, class_path, payload = pickle.loads(
+        zlib.decompress(value[1:]))
+    return (values, (kind, class_path, payload))
+
+
+def decode_atom(atom_data, mapper):
+    """Recreates Atom object from atom_data returned by decode_model()."""
+    kind, class_path, payload = atom_data
+    if kind == 'dict':
+        return mapper.clone_atom(payload)
+    module, _, name = class_path.rpartition('.')
+    atom_class = getattr(__import__(module, {}, {}, [name]), name)
+    if kind == 'xml':
+        from atom.core import parse
+        return parse(payload, atom_class)
+    from atom import CreateClassFromXMLString
+    return CreateClassFromXMLString(atom_class, payload)
+
+
 class LastCacheUpdate(BaseModel):
     last_updated = db.DateTimeProperty(auto_now=True)
 
@@ -29,13 +99,59 @@ class GDataIndex(BaseModel):
     # key_name consists of: domain_name:mapper_class[:page]
     # where page part is to be omitted for the first page
     page_hash = db.StringProperty(indexed=False)
+    # ETag of the page as returned by AtomMapper.retrieve_page() and the
+    # cursor pointing to the next page, so that unchanged pages may be skipped
+    # without parsing them.
     etag = db.StringProperty(indexed=False)
+    next_cursor = db.StringProperty(indexed=False)
     hashes = db.StringListProperty(indexed=False)
     keys = db.StringListProperty()
+    # Hashes which left the page during the running refresh, see
+    # crlib.cache._diff_page().
+    removed_hashes = db.StringListProperty(indexed=False)
     last_updated = db.DateTimeProperty()
     domain = db.StringProperty()
     model_class = db.StringProperty()
     full_precache = db.BooleanProperty(default=False)
+    # Scheduling of the refreshes, set on the first page only. See
+    # crlib.scheduler.
+    next_update = db.DateTimeProperty()
+    refresh_interval = db.IntegerProperty(indexed=False)
+    refresh_cost = db.IntegerProperty(indexed=False)
+    change_rate = db.FloatProperty(indexed=False)
+    refresh_changed = db.BooleanProperty(default=False, indexed=False)
+
+
+class PrecacheShard(BaseModel):
+    """One step of a sharded cache refresh, see crlib.cache.plan_precache().
+
+    Each step reads a single feed page starting at cursor, and stores keys and
+    hashes of the entries which belong to the shard. The entries of shard
+    number N are those before end_key (the first entry of shard N + 1), or at
+    most limit entries for feeds sharded by offset.
+
+    """
+    # domain_name:mapper_class of the first GDataIndex page
+    base = db.StringProperty()
+    run = db.StringProperty()
+    number = db.IntegerProperty()
+    # number of shards of the run
+    count = db.IntegerProperty(indexed=False)
+    part = db.IntegerProperty(default=0)
+    cursor = db.StringProperty(indexed=False)
+    end_key = db.StringProperty(indexed=False)
+    limit = db.IntegerProperty(indexed=False)
+    # key name and ETag of the GDataIndex page the shard is expected to
+    # reproduce
+    page = db.StringProperty(indexed=False)
+    etag = db.StringProperty(indexed=False)
+    full_precache = db.BooleanProperty(default=False, indexed=False)
+    keys = db.StringListProperty(indexed=False)
+    hashes = db.StringListProperty(indexed=False)
+    # True if the shard ended within this part's feed page
+    ended = db.BooleanProperty(default=False, indexed=False)
+    done = db.BooleanProperty(default=False)
+    started = db.DateTimeProperty(indexed=False)
 
 
 # Cache models
@@ -65,8 +181,7 @@ class _CacheBase(BaseModel):
     def from_model(cls, model_instance, **kwargs):
         kwargs = cls.model_to_kwargs(model_instance, **kwargs)
         if kwargs.has_key('_atom'):
-            kwargs['_atom'] = pickle.dumps(
-                kwargs['_atom'], pickle.HIGHEST_PROTOCOL)
+            kwargs['_atom'] = encode_model(model_instance)
         return cls(**kwargs)
 
     def update(self, model_instance):
@@ -74,12 +189,10 @@ class _CacheBase(BaseModel):
         for key, value in kwargs.iteritems():
             setattr(self, key, value)
         self._gdata_key_name = model_instance.key()
-        self._atom = pickle.dumps(model_instance._atom, pickle.HIGHEST_PROTOCOL)
+        self._atom = encode_model(model_instance)
 
 
 class UserCache(_CacheBase):
-    USERS_PER_JOB = 5
-
     id = db.StringProperty()
     user_name = db.StringProperty(required=True)
     given_name = db.StringProperty(required=True)
@@ -91,38 +204,22 @@ class UserCache(_CacheBase):
     change_password = db.BooleanProperty(default=False)
     search_index = db.StringListProperty()
 
+    search_fields = (('user_name', 3), ('given_name', 2), ('family_name', 2))
+
+    # nicknames are refreshed at most once per NICKNAME_REFRESH_INTERVAL
+    NICKNAME_REFRESH_INTERVAL = 58 * 60
+
     @classmethod
-    def additional_cache(cls, items, index, domain):
-        import math
+    def after_refresh(cls, domain):
         from django.core.urlresolvers import reverse
         from google.appengine.api.labs import taskqueue
-        from crlib import cache
 
-        if memcache.get('nickname_lock:' + index.key().name()):
+        if not memcache.add('nickname_lock:' + domain, True,
+                            cls.NICKNAME_REFRESH_INTERVAL):
             return
-
-        memcache.set('nickname_lock:' + index.key().name(), True, 58 * 60)
-
-        jobs = int(math.ceil(float(len(items)) / cls.USERS_PER_JOB))
-        key_parts = index.key().name().split(':')
-        key_name = '%s:GANickname' % domain
-        if len(key_parts) == 3:
-            key_name += ':' + key_parts[-1]
-        nick_index = GDataIndex.get_or_insert(
-            key_name=key_name,
-            domain=domain,
-            model_class='GANickname',
-            last_updated=cache.MIN_DATETIME,
-        )
-        for i in range(jobs):
-            users = items[i * cls.USERS_PER_JOB:i * cls.USERS_PER_JOB +
-                          cls.USERS_PER_JOB]
-            if users:
-                taskqueue.add(url=reverse('precache_nicknames'), params={
-                    'users': ':'.join([user.user_name for user in users]),
-                    'domain': domain,
-                    'index': key_name,
-                })
+        taskqueue.add(url=reverse('precache_nicknames'), params={
+            'domain': domain,
+        })
 
     @classmethod
     def model_to_kwargs(cls, model_instance, **kwargs):
@@ -132,11 +229,9 @@ class UserCache(_CacheBase):
         props.remove('search_index')
         kwargs.update(_model_kwargs(model_instance, props))
 
-        index = set()
-        index.add(model_instance.user_name.lower())
-        index.add(model_instance.given_name.lower())
-        index.add(model_instance.family_name.lower())
-        kwargs['search_index'] = [item.decode('utf8') for item in index]
+        kwargs['search_index'] = search.index_entries([
+            model_instance.user_name, model_instance.given_name,
+            model_instance.family_name])
 
         return kwargs
 
@@ -171,10 +266,14 @@ class SharedContactCache(_CacheBase):
     phone_numbers = db.StringListProperty()
     postal_addresses = db.StringListProperty()
     organization = db.StringProperty()
+    role = db.StringProperty()
     notes = db.StringListProperty()
     search_index = db.StringListProperty()
     name_index = db.StringListProperty()
 
+    search_fields = (('name', 3), ('title', 3), ('emails', 2),
+                     ('organization', 1), ('role', 1), ('phone_numbers', 1))
+
     @classmethod
     def model_to_kwargs(cls, model_instance, **kwargs):
         kwargs = dict(kwargs)
@@ -193,9 +292,11 @@ class SharedContactCache(_CacheBase):
                      for address in model_instance.postal_addresses]
         if model_instance.organization:
             organization = model_instance.organization.name
+            role = model_instance.organization.title
         else:
-            organization = None
+            organization = role = None
         organization = organization and organization.lower() or ''
+        role = role and role[:500].lower() or ''
 
         def _filter(l):
             return [item[:500].lower() for item in l if item]
@@ -203,15 +304,10 @@ class SharedContactCache(_CacheBase):
         notes = RE_SPLIT.split(model_instance.notes or '')
         notes = list(set(_filter(notes)))
 
-        index = name_index[:]
-        index += RE_SPLIT.split(model_instance.name.full_name or '')
-        index += emails
-        index += phone_numbers
-        index += addresses
-        index += RE_SPLIT.split(organization or '')
-        if model_instance.title:
-            index.append(model_instance.title.lower())
-        index = list(set(_filter(index)))
+        index = search.index_entries(
+            name_index + [model_instance.name.full_name, organization, role,
+                          model_instance.title] +
+            emails + phone_numbers + addresses)
 
         kwargs.update({
             'name': name,
@@ -220,6 +316,7 @@ class SharedContactCache(_CacheBase):
             'phone_numbers': phone_numbers,
             'addresses': addresses,
             'organization': organization,
+            'role': role,
             'notes': notes,
             'search_index': index,
         })
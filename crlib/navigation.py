@@ -6,6 +6,49 @@ from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse, get_callable, resolve, Resolver404
 from django.shortcuts import render_to_response
 from crauth import users
+from crauth.models import permissions_version
+
+
+# The dictionaries below live as long as the process, they're cleared when
+# they reach this size.
+MAX_CACHED = 1000
+
+# perm_list of the views by URL, see Section.__init__
+_url_perm_lists = {}
+# Sections returned by the cached_navigation functions by (function, key)
+_skeletons = {}
+# has_perms() verdicts by (email, admin status, version of the permissions
+# of the domain, perm_list)
+_verdicts = {}
+
+
+def _remember(cache, key, value):
+    if len(cache) >= MAX_CACHED:
+        cache.clear()
+    cache[key] = value
+    return value
+
+
+def cached_navigation(key_fun):
+    """Marks a settings.NAVIGATION function whose sections depend only on
+    key_fun(request), so that they're built once per process for each key.
+    """
+    def decorator(fun):
+        fun.navigation_key = key_fun
+        return fun
+    return decorator
+
+
+def _view_perm_list(url):
+    perm_list = _url_perm_lists.get(url)
+    if perm_list is None:
+        try:
+            view, args, kwargs = resolve(url)
+            perm_list = getattr(view, 'perm_list', [])
+        except Resolver404:
+            perm_list = []
+        _remember(_url_perm_lists, url, perm_list)
+    return perm_list
 
 
 class Section(object):
@@ -18,12 +61,7 @@ class Section(object):
         if not self.perm_list and url and not url.startswith('http'):
             # @has_perm and @has_perms decorators adnotate views with perm_list
             # parameter and we simply reuse this parameter here.
-            try:
-                view, args, kwargs = resolve(url)
-                if hasattr(view, 'perm_list'):
-                    self.perm_list = view.perm_list
-            except Resolver404:
-                pass
+            self.perm_list = _view_perm_list(url)
         self.children = children or []
         self.parent = parent
         self.selected = False
@@ -35,7 +73,7 @@ class Section(object):
         children = [child.clone() for child in self.children]
         return Section(
             self.name, self.verbose_name,
-            self.url, children, self.parent)
+            self.url, children, self.parent, self.perm_list)
 
 
 def _get_section(path, sections):
@@ -53,13 +91,24 @@ def _clone(sections):
     return [section.clone() for section in sections]
 
 
+def _has_perms(user, perm_list):
+    if not user:
+        return False
+    key = (user.email(), user.is_admin(),
+           permissions_version(user.domain_name), tuple(perm_list))
+    verdict = _verdicts.get(key)
+    if verdict is None:
+        verdict = _remember(_verdicts, key, user.has_perms(perm_list))
+    return verdict
+
+
 def _mark_sections(path, sections, parents=[], user=None, has_in_section=False):
     sections = list(sections)
     for section in sections[:]:
         if section.perm_list:
             if not user:
                 user = users.get_current_user()
-            if not user or not user.has_perms(section.perm_list):
+            if not _has_perms(user, section.perm_list):
                 sections.remove(section)
                 continue
         if section.url == path:
@@ -74,7 +123,7 @@ def _mark_sections(path, sections, parents=[], user=None, has_in_section=False):
             if section.children:
                 child = section.children[0]
                 section.url = child.url
-                section.perm_list = child.url
+                section.perm_list = child.perm_list
             else:
                 sections.remove(section)
     return sections
@@ -86,14 +135,27 @@ def _get_selected(sections):
             return section
 
 
-def render_with_nav(request, template, ctx={}, extra_nav=None,
-                    in_section=None, help_url=None):
+def _base_sections(request):
+    """Returns copy of the sections of settings.NAVIGATION functions."""
     sections = []
     for fun in settings.NAVIGATION:
-        fun = get_callable(fun)
-        more = fun(request)
-        if more:
-            sections.extend(more)
+        builder = get_callable(fun)
+        key_fun = getattr(builder, 'navigation_key', None)
+        if key_fun is None:
+            sections.extend(builder(request) or [])
+            continue
+        key = (fun, key_fun(request))
+        skeleton = _skeletons.get(key)
+        if skeleton is None:
+            skeleton = _remember(_skeletons, key,
+                                 list(builder(request) or []))
+        sections.extend(_clone(skeleton))
+    return sections
+
+
+def render_with_nav(request, template, ctx={}, extra_nav=None,
+                    in_section=None, help_url=None):
+    sections = _base_sections(request)
     if extra_nav:
         for section in extra_nav:
             if section.parent:
@@ -0,0 +1,134 @@
+"""Sends requests of gdata.service.GDataService objects concurrently.
+
+GDataService methods perform the HTTP request and read the response right
+away, so they can't be used with asynchronous urlfetch RPCs directly.
+ParallelRequests calls them with an HTTP client which only records the
+request that would have been made (authorization headers included) and then
+sends the recorded requests with at most max_concurrent RPCs in flight.
+
+Responses of the recorded requests aren't parsed, so only methods whose
+result is not needed (e.g. AddMemberToGroup, RemoveMemberFromGroup) should be
+used this way.
+
+"""
+from google.appengine.api import urlfetch
+from gdata.alt.appengine import AppEngineHttpClient, _convert_data_part
+from gdata.apps.service import AppsForYourDomainException
+from crlib import errors
+
+
+__all__ = ['ParallelRequests']
+
+
+class _RecordedResponse(object):
+    status = 200
+    reason = 'OK'
+
+    def read(self):
+        return '<entry xmlns="http://www.w3.org/2005/Atom"/>'
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class _RecordingHttpClient(AppEngineHttpClient):
+    def __init__(self):
+        AppEngineHttpClient.__init__(self)
+        self.recorded = []
+
+    def request(self, operation, url, data=None, headers=None):
+        all_headers = self.headers.copy()
+        if headers:
+            all_headers.update(headers)
+        if isinstance(data, list):
+            data = ''.join([_convert_data_part(x) for x in data])
+        else:
+            data = _convert_data_part(data)
+        if data and 'Content-Length' not in all_headers:
+            all_headers['Content-Length'] = str(len(data))
+        if 'Content-Type' not in all_headers:
+            all_headers['Content-Type'] = 'application/atom+xml'
+        self.recorded.append((operation, str(url), data, all_headers))
+        return _RecordedResponse()
+
+
+class ParallelRequests(object):
+    """Usage:
+
+        requests = ParallelRequests(service)
+        for member_id in member_ids:
+            requests.add(member_id, 'AddMemberToGroup', member_id, group_id)
+        failed = requests.run()
+
+    """
+    MAX_CONCURRENT = 10
+    DEADLINE = 10
+
+    def __init__(self, service, max_concurrent=MAX_CONCURRENT):
+        self.service = service
+        self.max_concurrent = max_concurrent
+        self._requests = []
+
+    def __len__(self):
+        return len(self._requests)
+
+    def add(self, key, method_name, *args, **kwargs):
+        """Records request(s) made by service.method_name(*args, **kwargs).
+        key is used to report the errors by run().
+
+        """
+        http_client = self.service.http_client
+        recorder = self.service.http_client = _RecordingHttpClient()
+        try:
+            getattr(self.service, method_name)(*args, **kwargs)
+        finally:
+            self.service.http_client = http_client
+        for request in recorder.recorded:
+            self._requests.append((key, request))
+
+    def run(self):
+        """Sends all the recorded requests.
+
+        Returns list of (key, exception) tuples for requests which failed.
+        Exceptions are translated to crlib.errors exceptions where possible.
+
+        """
+        pending, self._requests = self._requests, []
+        pending.reverse()
+        in_flight = []
+        failed = []
+        while pending or in_flight:
+            while pending and len(in_flight) < self.max_concurrent:
+                key, request = pending.pop()
+                in_flight.append((key, self._fetch(request)))
+            key, rpc = in_flight.pop(0)
+            error = self._get_error(rpc)
+            if error is not None:
+                failed.append((key, error))
+        return failed
+
+    def _fetch(self, request):
+        operation, url, payload, headers = request
+        rpc = urlfetch.create_rpc(deadline=self.DEADLINE)
+        urlfetch.make_fetch_call(
+            rpc, url, payload=payload, method=getattr(urlfetch, operation),
+            headers=headers, follow_redirects=False)
+        return rpc
+
+    def _get_error(self, rpc):
+        try:
+            response = rpc.get_result()
+        except urlfetch.DownloadError:
+            return errors.NetworkError()
+        if response.status_code in (200, 201):
+            return None
+        exception = AppsForYourDomainException({
+            'status': response.status_code,
+            'reason': '',
+            'body': response.content,
+        })
+        error_class = errors.APPS_FOR_YOUR_DOMAIN_ERROR_CODES.get(
+            exception.error_code)
+        if error_class:
+            return error_class()
+        return exception
@@ -0,0 +1,162 @@
+"""Scheduling of the cache refreshes done by crlib.cache.
+
+Each feed (the first GDataIndex page of it) has its own refresh interval.
+It's halved after a refresh which found changes and doubled after one which
+didn't, within CACHE_MIN_UPDATE_INTERVAL and CACHE_MAX_UPDATE_INTERVAL.
+Feeds of domains whose users are active don't back off beyond
+CACHE_UPDATE_INTERVAL.
+
+schedule() is run by the precache_everything cron job. It starts refreshes
+of the due feeds by priority (how late they are, how often they change and
+whether the domain is active) until PRECACHE_URLFETCH_BUDGET is used up.
+Cost of a refresh is the number of feed pages it read the last time.
+
+"""
+import datetime
+import random
+from google.appengine.ext import db
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from crlib.models import GDataIndex
+from crlib import memcache_batch
+
+
+__all__ = ['mark_active', 'mark_changed', 'refresh_done', 'next_interval',
+           'schedule']
+
+
+ACTIVE_KEY = 'domain_active:%s'
+# weight of the last refresh in GDataIndex.change_rate
+CHANGE_RATE_WEIGHT = 0.3
+ACTIVE_PRIORITY = 2.0
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def mark_active(domain):
+    """Called at the end of requests of users of the domain."""
+    key = ACTIVE_KEY % domain
+    if not memcache_batch.get(key):
+        memcache_batch.set(key, True, _setting('DOMAIN_ACTIVE_TIME', 30 * 60))
+
+
+def _active_domains(domains):
+    keys = dict((ACTIVE_KEY % domain, domain) for domain in domains)
+    found = memcache.get_multi(keys.keys())
+    return dict((keys[key], True) for key in found)
+
+
+def mark_changed(key_name):
+    """Called when a page other than the first one of the feed changed."""
+    def txn():
+        index = GDataIndex.get_by_key_name(key_name)
+        if index and not index.refresh_changed:
+            index.refresh_changed = True
+            index.put()
+    db.run_in_transaction(txn)
+
+
+def next_interval(interval, changed, active):
+    base = settings.CACHE_UPDATE_INTERVAL
+    interval = interval or base
+    if changed:
+        interval /= 2
+    else:
+        interval *= 2
+    if active:
+        interval = min(interval, base)
+    interval = min(interval, _setting('CACHE_MAX_UPDATE_INTERVAL',
+                                      24 * 60 * 60))
+    return max(interval, _setting('CACHE_MIN_UPDATE_INTERVAL', 5 * 60))
+
+
+def refresh_done(key_name, changed, cost):
+    """Called when the refresh of the feed is finished. cost is the number
+    of feed pages read.
+
+    """
+    active = bool(_active_domains([key_name.split(':')[0]]))
+
+    def txn():
+        index = GDataIndex.get_by_key_name(key_name)
+        if not index:
+            return
+        was_changed = changed or index.refresh_changed
+        rate = index.change_rate or 0.0
+        index.change_rate = (rate * (1 - CHANGE_RATE_WEIGHT) +
+                             was_changed * CHANGE_RATE_WEIGHT)
+        index.refresh_interval = next_interval(
+            index.refresh_interval, was_changed, active)
+        index.refresh_changed = False
+        index.refresh_cost = cost
+        index.next_update = datetime.datetime.now() + datetime.timedelta(
+            seconds=index.refresh_interval)
+        index.put()
+    db.run_in_transaction(txn)
+
+
+def _priority(index, now, active):
+    interval = index.refresh_interval or settings.CACHE_UPDATE_INTERVAL
+    due = index.next_update or index.last_updated + datetime.timedelta(
+        seconds=interval)
+    late = now - due
+    late = late.days * 24 * 60 * 60 + late.seconds
+    priority = float(max(late, 0) + interval) / interval
+    priority *= 1 + (index.change_rate or 0.0)
+    if active:
+        priority *= ACTIVE_PRIORITY
+    return priority
+
+
+def _due_indexes(now):
+    due = GDataIndex.all().filter('next_update <=', now).order(
+        'next_update').fetch(100)
+    # Feeds not refreshed since the scheduler was introduced
+    treshold = now - datetime.timedelta(
+        seconds=settings.CACHE_UPDATE_INTERVAL)
+    due += GDataIndex.all().filter('next_update', None).filter(
+        'last_updated <', treshold).filter('last_updated !=', None).order(
+            'last_updated').fetch(100)
+    result = []
+    for index in due:
+        key_parts = index.key().name().split(':')
+        if len(key_parts) == 3 or key_parts[1] == 'GANickname':
+            continue
+        result.append(index)
+    return result
+
+
+def schedule(now=None):
+    """Starts refreshes of the due feeds. Returns their number."""
+    now = now or datetime.datetime.now()
+    due = _due_indexes(now)
+    active = _active_domains(dict.fromkeys([x.domain for x in due]).keys())
+    due.sort(key=lambda x: _priority(x, now, x.domain in active),
+             reverse=True)
+
+    budget = _setting('PRECACHE_URLFETCH_BUDGET', 300)
+    spent = 0
+    scheduled = []
+    for index in due:
+        cost = index.refresh_cost or 1
+        # The most important feed is refreshed even if it alone is over
+        # the budget, so that big feeds aren't starved.
+        if scheduled and spent + cost > budget:
+            continue
+        spent += cost
+        # Postponed until refresh_done() sets the real next update, so the
+        # feed isn't scheduled again while being refreshed.
+        interval = index.refresh_interval or settings.CACHE_UPDATE_INTERVAL
+        index.next_update = now + datetime.timedelta(seconds=interval)
+        scheduled.append(index)
+    db.put(scheduled)
+
+    for index in scheduled:
+        taskqueue.add(url=reverse('precache_domain_item'), params={
+            'key_name': index.key().name(),
+        }, countdown=random.randint(1, 10))
+    return len(scheduled)
@@ -0,0 +1,219 @@
+"""Full-text search in the cache models.
+
+Cache models store search_index, a list of index_entries() of their texts:
+the normalized words (lowercase, without diacritics) and all their prefixes.
+A word of the query therefore matches an entity with a single equality
+filter, and the datastore intersects the filters of multi-word queries
+(merge join, no composite indexes are needed). Each query word matches the
+beginning of any word of the entity.
+
+Matches are ranked by search_fields of the cache model, (property, weight)
+pairs: each query word scores the weight of the best field it's found in,
+doubled if it matches a whole word, or INDEX_SCORE if it's only found in
+search_index (e.g. a word of an address). Ranked keys are kept in the _cache
+of the model (invalidated by changes made in the application) for
+RESULTS_CACHE_TIME (for changes made by the precache), so the following
+pages of results are read by key.
+
+SearchQuery may also be given a row filter, e.g.
+crgappspanel.helpers.filters.SharedContactAdvancedFilter. Its terms() are
+added to the datastore query like the words of the query, and the fetched
+rows are checked by its match_row(). The rows are read in batches until
+MAX_RESULTS of them match; if MAX_SCANNED rows are read first, the results
+are marked as truncated.
+
+"""
+import hashlib
+import re
+import time
+import unicodedata
+from crauth import users
+
+
+__all__ = ['normalize', 'tokenize', 'index_entries', 'query_terms',
+           'field_tokens', 'rank', 'SearchQuery']
+
+
+# longer words are indexed (and searched for) by this many characters only
+MAX_TOKEN_LENGTH = 30
+# datastore limits number of index rows of an entity
+MAX_ENTRIES = 1000
+# words of the query over this number are checked by rank() only
+MAX_FILTER_TERMS = 5
+MAX_RESULTS = 1000
+# score of a query word found in search_index but in none of search_fields
+INDEX_SCORE = 0.5
+# rows checked by the row filter are read this many at a time, at most
+# MAX_SCANNED of them (e.g. when searching by notes only, which aren't in
+# search_index)
+SCAN_BATCH_SIZE = 500
+MAX_SCANNED = 20000
+RESULTS_CACHE_TIME = 5 * 60
+
+RE_SPLIT = re.compile(r'[^\w\d]+', re.UNICODE)
+
+
+def normalize(text):
+    if isinstance(text, str):
+        text = text.decode('utf8')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join([c for c in text if not unicodedata.combining(c)])
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return [token[:MAX_TOKEN_LENGTH]
+            for token in RE_SPLIT.split(normalize(text)) if token]
+
+
+def index_entries(texts):
+    """Returns search_index value for the given texts."""
+    tokens = []
+    for text in texts:
+        tokens += tokenize(text)
+    words = dict.fromkeys(tokens)
+    prefixes = {}
+    for token in tokens:
+        for i in xrange(1, len(token)):
+            if token[:i] not in words:
+                prefixes[token[:i]] = True
+    # Whole words first, so that they're kept if the limit is reached.
+    prefixes = sorted(prefixes.keys(), key=lambda x: -len(x))
+    return (sorted(words.keys()) + prefixes)[:MAX_ENTRIES]
+
+
+def query_terms(query):
+    terms = []
+    for token in tokenize(query):
+        if token not in terms:
+            terms.append(token)
+    return terms
+
+
+def field_tokens(row, prop):
+    value = getattr(row, prop, None)
+    if not value:
+        return []
+    if isinstance(value, list):
+        value = u' '.join([x for x in value if x])
+    return tokenize(value)
+
+
+def rank(rows, terms, fields):
+    """Returns the rows matching all the terms, best matches first."""
+    scored = []
+    for i, row in enumerate(rows):
+        tokens = [(field_tokens(row, prop), weight)
+                  for prop, weight in fields]
+        index = dict.fromkeys(getattr(row, 'search_index', None) or [])
+        score = 0
+        for term in terms:
+            best = 0
+            for tokens_, weight in tokens:
+                for token in tokens_:
+                    if token == term:
+                        best = max(best, weight * 2)
+                    elif token.startswith(term):
+                        best = max(best, weight)
+            if not best and term in index:
+                best = INDEX_SCORE
+            if not best:
+                break
+            score += best
+        else:
+            scored.append((-score, i, row))
+    scored.sort()
+    return [row for _, _, row in scored]
+
+
+class SearchQuery(object):
+    """Results of the search for query in model_class' cache. Implements the
+    part of GDataQuery used by crgappspanel.helpers.paginator.Paginator,
+    cursors being offsets in the ranked results. Results of searches with
+    row_filter only are ordered by order_by (property of the cache model).
+
+    """
+    def __init__(self, model_class, query='', row_filter=None,
+                 order_by=None):
+        self._model = model_class
+        self._cache_model = model_class._meta.cache_model
+        self._terms = query_terms(query)
+        self._filter = row_filter
+        self._order_by = order_by
+        self._offset = 0
+        # crlib.cache imports the cache models, which use this module.
+        from crlib import cache
+        cache.ensure_has_cache(
+            users.get_current_user().domain_name, model_class.__name__)
+
+    def _scan(self, query):
+        """Returns (rows matching the row filter, True if not all the rows of
+        the query were checked) tuple.
+
+        """
+        rows, scanned = [], 0
+        while True:
+            batch = query.fetch(SCAN_BATCH_SIZE)
+            scanned += len(batch)
+            rows += [row for row in batch if self._filter.match_row(row)]
+            if len(batch) < SCAN_BATCH_SIZE:
+                return rows, False
+            if len(rows) >= MAX_RESULTS or scanned >= MAX_SCANNED:
+                return rows[:MAX_RESULTS], True
+            query.with_cursor(query.cursor())
+
+    def _search(self):
+        """Returns (ranked keys, True if the results are truncated) tuple."""
+        terms = self._terms[:]
+        if self._filter:
+            terms += [x for x in self._filter.terms() if x not in terms]
+        domain = users.get_current_domain().domain
+        query = self._cache_model.all().filter('_domain', domain)
+        for term in terms[:MAX_FILTER_TERMS]:
+            query.filter('search_index', term)
+        if self._filter:
+            rows, truncated = self._scan(query)
+        else:
+            rows = query.fetch(MAX_RESULTS)
+            truncated = len(rows) == MAX_RESULTS
+        if self._terms:
+            rows = rank(rows, self._terms, self._cache_model.search_fields)
+        elif self._order_by:
+            rows.sort(key=lambda x: getattr(x, self._order_by))
+        return [str(row.key()) for row in rows], truncated
+
+    def _results(self):
+        if not self._terms and not self._filter:
+            return [], False
+        key = u' '.join(self._terms)
+        if self._filter:
+            key += u'|' + self._filter.key()
+        cache_key = 'search:' + hashlib.sha1(key.encode('utf8')).hexdigest()
+        cached = self._model._cache[cache_key]
+        if cached is None or cached[0] < time.time() - RESULTS_CACHE_TIME:
+            cached = (time.time(), self._search())
+            self._model._cache[cache_key] = cached
+        return cached[1]
+
+    def truncated(self):
+        """Tells if only a part of the matching objects is in the results."""
+        return self._results()[1]
+
+    def with_cursor(self, cursor):
+        self._offset = int(cursor or 0)
+        return self
+
+    def cursor(self):
+        return str(self._offset)
+
+    def fetch(self, limit):
+        keys = self._results()[0][self._offset:self._offset + limit]
+        self._offset += len(keys)
+        rows = self._cache_model.get(keys)
+        return [self._model._from_cached(row) for row in rows if row]
+
+    def get(self):
+        results = self.fetch(1)
+        if results:
+            return results[0]
@@ -1,7 +1,8 @@
 # -*- coding: UTF-8 -*-
 import logging
+import pickle
 import unittest
-from crlib import regexps
+from crlib import regexps, models
 
 
 class RegexpsTestCase(unittest.TestCase):
@@ -70,3 +71,315 @@ class RegexpsTestCase(unittest.TestCase):
             self.assertEqual(regexps.RE_FIRST_LAST_NAME.match(name), None)
 
 
+def _user():
+    from gdata import apps
+    from crgappspanel.models import GAUser
+    atom = apps.UserEntry(
+        login=apps.Login(user_name='test', suspended='false'),
+        name=apps.Name(given_name='Test', family_name='User'),
+        quota=apps.Quota(limit='1024'),
+    )
+    return GAUser._from_atom(atom)
+
+
+class CacheFormatTestCase(unittest.TestCase):
+    def testRoundTrip(self):
+        user = _user()
+        values, atom_data = models.decode_model(models.encode_model(user))
+        self.assertEqual(values['user_name'], 'test')
+        self.assertEqual(values['quota'], 1024)
+        self.assertEqual(values['suspended'], False)
+        atom = models.decode_atom(atom_data, user._mapper)
+        self.assertEqual(str(atom), str(user._atom))
+
+    def testLegacyFormat(self):
+        user = _user()
+        values, atom = models.decode_model(
+            pickle.dumps(user._atom, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(values, None)
+        self.assertEqual(str(atom), str(user._atom))
+
+    def testIsSmallerThanPickle(self):
+        user = _user()
+        self.assertTrue(len(models.encode_model(user)) < len(
+            pickle.dumps(user._atom, pickle.HIGHEST_PROTOCOL)))
+
+
+class IdentityMapTestCase(unittest.TestCase):
+    def setUp(self):
+        from crauth import users
+        from crlib.gdata_wrapper import identity_map
+        users._set_current_user('admin@example.com', 'example.com')
+        self.identity_map = identity_map
+        self.identity_map.clear()
+
+    def tearDown(self):
+        self.identity_map.clear()
+
+    def testKeyedByDomain(self):
+        from crauth import users
+        from crgappspanel.models import GAUser
+        self.identity_map.add(GAUser, 'test', None)
+        self.assertEqual(
+            self.identity_map.lookup(GAUser, 'test'), (True, None))
+        users._set_current_user('admin@example.org', 'example.org')
+        self.assertEqual(
+            self.identity_map.lookup(GAUser, 'test'), (False, None))
+
+    def testGetByKeyNameUsesMap(self):
+        from crgappspanel.models import GAUser
+        user = _user()
+        self.identity_map.add(GAUser, 'test', user)
+        self.assertTrue(GAUser.get_by_key_name('test') is user)
+        self.identity_map.clear()
+        self.assertEqual(
+            self.identity_map.lookup(GAUser, 'test'), (False, None))
+
+    def testPrefetchReference(self):
+        from crlib.gdata_wrapper import prefetch
+        from crgappspanel.models import GAUser, GANickname
+        user = _user()
+        self.identity_map.add(GAUser, 'test', user)
+        nicknames = [GANickname(nickname=x, user='test') for x in 'ab']
+        prefetch(nicknames, 'user')
+        for nickname in nicknames:
+            self.assertTrue(nickname._RESOLVED_user is user)
+
+
+class RowDecoderTestCase(unittest.TestCase):
+    def testFromAtomsMatchesConstructor(self):
+        from crgappspanel.models import GAUser
+        atom = _user()._atom
+        expected = GAUser(_atom=atom, **GAUser._atom_to_kwargs(atom))
+        for user in GAUser._from_atoms([atom, atom]):
+            self.assertTrue(user._atom is atom)
+            for name in GAUser._properties:
+                self.assertEqual(getattr(user, name), getattr(expected, name))
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    def testEvictsLeastRecentlyUsed(self):
+        from crlib.gdata_wrapper import _LocalCache
+        local = _LocalCache(2)
+        local.set('a', 1)
+        local.set('b', 2)
+        local.get('a')
+        local.set('c', 3)
+        self.assertEqual(local.get('a'), 1)
+        self.assertEqual(local.get('b'), None)
+        self.assertEqual(local.get('c'), 3)
+
+    def testExpires(self):
+        from crlib.gdata_wrapper import _LocalCache
+        local = _LocalCache(2)
+        local.set('a', 1, -1)
+        self.assertEqual(local.get('a'), None)
+
+
+class MemcacheBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        from google.appengine.api import memcache
+        from crlib import memcache_batch
+        self.memcache = memcache
+        self.batch = memcache_batch
+        self.batch.reset()
+        memcache.set_multi({'batch:a': 1, 'batch:b': 2})
+
+    def tearDown(self):
+        self.batch.reset()
+
+    def testGetFetchesWantedKeysAtOnce(self):
+        self.batch.want(['batch:b', 'batch:c'])
+        self.assertEqual(self.batch.get('batch:a'), 1)
+        self.assertEqual(self.batch.get('batch:b'), 2)
+        self.assertEqual(self.batch.get('batch:c'), None)
+        stats = self.batch.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertEqual(stats['rpcs'], 1)
+
+    def testSetIsDeferred(self):
+        self.batch.set('batch:a', 10)
+        self.assertEqual(self.batch.get('batch:a'), 10)
+        self.assertEqual(self.memcache.get('batch:a'), 1)
+        self.batch.flush()
+        self.assertEqual(self.memcache.get('batch:a'), 10)
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        from django.conf import settings
+        from crlib import scheduler
+        self.base = settings.CACHE_UPDATE_INTERVAL
+        self.next_interval = scheduler.next_interval
+
+    def testBacksOffWhenUnchanged(self):
+        interval = self.next_interval(None, False, False)
+        self.assertEqual(interval, self.base * 2)
+        self.assertEqual(self.next_interval(interval, False, False),
+                         self.base * 4)
+        self.assertEqual(self.next_interval(interval, True, False), self.base)
+
+    def testActiveDomainDoesntBackOff(self):
+        self.assertEqual(self.next_interval(self.base * 8, False, True),
+                         self.base)
+
+
+class IndexWriteBufferTestCase(unittest.TestCase):
+    def setUp(self):
+        from crlib.gdata_wrapper import _IndexWriteBuffer
+        from crgappspanel.models import GAUser
+        self.buffer = _IndexWriteBuffer()
+        self.model_class = GAUser
+        self.index = models.GDataIndex(
+            key_name='buffer.example.com:GAUser', domain='buffer.example.com',
+            model_class='GAUser', keys=['a', 'c'], hashes=['1', '3'],
+            page_hash='x')
+        self.index.put()
+
+    def tearDown(self):
+        self.index.delete()
+
+    def testMergesIntoCurrentPage(self):
+        key = self.index.key()
+        domain = self.index.domain
+        self.buffer.add(key, domain, self.model_class, 'b', '2')
+        self.buffer.remove(key, domain, self.model_class, 'c')
+        self.assertEqual(self.buffer.locate(domain, self.model_class, 'b'),
+                         key)
+        # concurrent change of the page
+        index = models.GDataIndex.get(key)
+        index.keys.append('d')
+        index.hashes.append('4')
+        index.put()
+
+        self.buffer.flush()
+        index = models.GDataIndex.get(key)
+        self.assertEqual(index.keys, ['a', 'b', 'd'])
+        self.assertEqual(index.hashes, ['1', '2', '4'])
+        self.assertEqual(index.page_hash, '!')
+
+
+class SearchTestCase(unittest.TestCase):
+    class Row(object):
+        def __init__(self, name, title=None):
+            self.name = name
+            self.title = title
+
+    def testIndexEntries(self):
+        from crlib import search
+        entries = search.index_entries([u'Zo\xeb', 'van-Dyke'])
+        for entry in (u'zoe', u'zo', u'z', u'van', u'dyke', u'dy'):
+            self.assertTrue(entry in entries)
+        self.assertFalse(u'van-dyke' in entries)
+
+    def testQueryTerms(self):
+        from crlib import search
+        self.assertEqual(search.query_terms(u'  John  SMITH john'),
+                         [u'john', u'smith'])
+
+    def testRank(self):
+        from crlib import search
+        rows = [self.Row(u'johnson smith'), self.Row(u'anna', u'john'),
+                self.Row(u'john smith'), self.Row(u'mark')]
+        fields = (('name', 3), ('title', 1))
+        ranked = search.rank(rows, [u'john'], fields)
+        self.assertEqual(ranked, [rows[2], rows[0], rows[1]])
+        self.assertEqual(search.rank(rows, [u'john', u'sm'], fields),
+                         [rows[2], rows[0]])
+        # words found only in search_index, e.g. of an address, still match
+        rows[3].search_index = search.index_entries([u'mark', u'Baker St'])
+        self.assertEqual(search.rank(rows, [u'baker'], fields), [rows[3]])
+        self.assertEqual(search.rank(rows, [u'mark', u'bak'], fields),
+                         [rows[3]])
+
+    def testScan(self):
+        from crlib import search
+
+        class Query(object):
+            def __init__(self, rows):
+                self.rows, self.offset = rows, 0
+
+            def fetch(self, limit):
+                batch = self.rows[self.offset:self.offset + limit]
+                self.offset += len(batch)
+                return batch
+
+            def cursor(self):
+                return self.offset
+
+            def with_cursor(self, cursor):
+                self.offset = cursor
+
+        class Filter(object):
+            def match_row(self, row):
+                return row.name.endswith('7')
+
+        rows = [self.Row(str(i)) for i in xrange(2 * search.SCAN_BATCH_SIZE)]
+        query = search.SearchQuery.__new__(search.SearchQuery)
+        query._filter = Filter()
+        found, truncated = query._scan(Query(rows))
+        self.assertEqual(len(found), 2 * search.SCAN_BATCH_SIZE / 10)
+        self.assertFalse(truncated)
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    class Item(object):
+        def __init__(self, a, b):
+            self.a, self.b = a, b
+
+    def testPlans(self):
+        from crlib.gdata_wrapper import GDataQuery, PLAN_MAPPER, \
+                PLAN_FULL_SCAN
+        from crgappspanel.models import GAGroup
+        query = GDataQuery(GAGroup, cached=False).filter(
+            'members', 'x').filter('name', 'y')
+        self.assertEqual(query.plan(), (PLAN_MAPPER, [('name', '=', 'y')]))
+        query = GDataQuery(GAGroup, cached=False).filter('name', 'y')
+        self.assertEqual(query.plan(),
+                         (PLAN_FULL_SCAN, [('name', '=', 'y')]))
+
+    def testTopK(self):
+        from crlib.gdata_wrapper import GDataQuery
+        from crgappspanel.models import GAGroup
+        query = GDataQuery(GAGroup, cached=False).order('a').order('-b')
+        items = [self.Item(a, b) for a, b in
+                 ((2, 1), (1, 1), (3, 0), (1, 2), (2, 2))]
+        top = query._top(iter(items), 2, 1, False)
+        self.assertEqual([(x.a, x.b) for x in top], [(1, 1), (2, 2)])
+
+    def testCompiledFilters(self):
+        from crlib.gdata_wrapper import GDataQuery
+        from crgappspanel.models import GAGroup
+        query = GDataQuery(GAGroup, cached=False)
+        matches = query._compile_filters(
+            [('a', '>=', 2), ('b', '=', 'x'), ('a', 'in', (2, 3))])
+        items = [self.Item(a, b) for a, b in
+                 ((1, ['x']), (2, ['x', 'y']), (3, ['y']), (4, ['x']))]
+        self.assertEqual([x.a for x in items if matches(x)], [2])
+
+
+class GroupEntryMapperTestCase(unittest.TestCase):
+    def testAppliedKeepsFailedChangesUndone(self):
+        from crlib.mappers import GroupEntryMapper, GroupEntry, \
+                MemberEntry, OwnerEntry
+        mapper = GroupEntryMapper()
+        old = GroupEntry(mapper, groupId='g', owners=[OwnerEntry(email='a')],
+                         members=[MemberEntry(memberId=x) for x in 'ab'])
+        new = GroupEntry(mapper, groupId='g', owners=[],
+                         members=[MemberEntry(memberId=x) for x in 'acd'])
+        applied = mapper._applied(new, old, new, [('b', None), ('d', None)])
+        self.assertEqual([x.memberId for x in applied.members],
+                         ['a', 'c', 'b'])
+        self.assertEqual(applied.owners, [])
+
+
+class NavigationTestCase(unittest.TestCase):
+    def testCloneKeepsPermList(self):
+        from crlib.navigation import Section
+        section = Section('users', 'Users', children=[
+            Section('roles', 'Roles', 'http://example.com/',
+                    perm_list=['read_role'])])
+        clone = section.clone()
+        self.assertEqual(clone.children[0].perm_list, ['read_role'])
+        clone.children[0].selected = True
+        self.assertFalse(section.children[0].selected)
@@ -14,6 +14,9 @@ urlpatterns = patterns(
         name='precache_everything'),
     url(r'^__precache_domain_item/$', 'precache_domain_item',
         name='precache_domain_item'),
+    url(r'^__precache_shard/$', 'precache_shard', name='precache_shard'),
+    url(r'^__precache_reconcile/$', 'precache_reconcile',
+        name='precache_reconcile'),
     url(r'^__prepare_indexes/$', 'prepare_indexes'),
     url(r'^__precache_nicknames/$', 'precache_nicknames',
         name='precache_nicknames'),
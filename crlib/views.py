@@ -1,6 +1,4 @@
-import datetime
 import logging
-import random
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.core.urlresolvers import reverse
 from django.conf import settings
@@ -12,7 +10,7 @@ from crauth.models import AppsDomain
 from crgappspanel import models
 from crlib.models import GDataIndex
 from crlib.navigation import render_with_nav
-from crlib import cache
+from crlib import cache, scheduler
 
 
 def cache_not_ready(request, template='cache_not_ready.html'):
@@ -46,27 +44,13 @@ def full_precache(request):
 
 
 def precache_everything(request):
-    treshold = datetime.datetime.now() - datetime.timedelta(
-        seconds=settings.CACHE_UPDATE_INTERVAL)
-    to_update = GDataIndex.all().filter(
-        'last_updated <', treshold).filter('last_updated !=', None).order(
-            'last_updated').fetch(100)
-    counter = 0
-    for item in to_update:
-        key_parts = item.key().name().split(':')
-        if len(key_parts) == 3 or key_parts[1] == 'GANickname':
-            continue
-        counter += 1
-        taskqueue.add(url=reverse('precache_domain_item'), params={
-            'key_name': ':'.join(key_parts[:2]),
-        }, countdown=random.randint(1, 10))
-    return HttpResponse(str(counter))
+    return HttpResponse(str(scheduler.schedule()))
 
 
-def precache_domain_item(request):
+def _retry_on_download_error(request, func):
     from google.appengine.api.urlfetch_errors import DownloadError
     try:
-        cache.update_cache(request.POST)
+        func(request.POST)
     except DownloadError:
         retry_count = int(request.META.get(
             'HTTP_X_APPENGINE_TASKRETRYCOUNT', 0))
@@ -75,47 +59,23 @@ def precache_domain_item(request):
     return HttpResponse('ok')
 
 
-def precache_nicknames(request):
-    from crlib.models import GDataIndex, NicknameCache
-    domain = request.POST['domain']
-    index = GDataIndex.get_by_key_name(request.POST['index'])
+def precache_domain_item(request):
+    return _retry_on_download_error(request, cache.precache)
 
-    apps_domain = AppsDomain.get_by_key_name(domain)
-    users._set_current_user(apps_domain.admin_email, domain)
 
-    all_nicknames = []
-    for user in request.POST['users'].split(':'):
-        existing = NicknameCache.all().filter('user_name', user).fetch(100)
-        existing_names = [nick.nickname for nick in existing]
-        nicknames = models.GANickname.all(cached=False).filter(
-            'user_name', user).fetch(100)
-        names = [nick.nickname for nick in nicknames]
-
-        # Delete unneeded nicknames
-        to_delete_names = set(existing_names) - set(names)
-        to_delete = []
-        for name in to_delete_names:
-            to_delete.append(existing[existing_names.index(name)])
-        db.delete(to_delete)
-
-        # Nicknames are immutable, so we only have to create the new ones
-        to_create_names = set(names) - set(existing_names)
-        to_create = []
-        for name in to_create_names:
-            to_create.append(nicknames[names.index(name)])
-
-        for nickname in to_create:
-            all_nicknames.append(NicknameCache.from_model(
-                nickname,
-                key_name='%s:%s' % (domain, nickname.key()),
-                _atom=nickname._atom,
-                _gdata_key_name=nickname.key(),
-                _domain=domain,
-            ))
-    db.put(all_nicknames)
+def precache_shard(request):
+    return _retry_on_download_error(request, cache.update_shard)
+
+
+def precache_reconcile(request):
+    cache.reconcile_precache(request.POST)
     return HttpResponse('ok')
 
 
+def precache_nicknames(request):
+    return _retry_on_download_error(request, cache.refresh_nicknames)
+
+
 def prepare_indexes(request):
     count = 0
     for domain in AppsDomain.all():
@@ -28,6 +28,13 @@ SESSION_LOGIN_INFO_KEY = '_client_login_info'
 LOGIN_REDIRECT_URL = '/'
 CLIENT_LOGIN_SOURCE = 'cloudreach-powerpanel-v1'
 CACHE_UPDATE_INTERVAL = 20 * 60 # in seconds
+# bounds of the adaptive refresh interval, see crlib.scheduler
+CACHE_MIN_UPDATE_INTERVAL = 5 * 60
+CACHE_MAX_UPDATE_INTERVAL = 24 * 60 * 60
+# feed pages fetched per run of the precache_everything cron job
+PRECACHE_URLFETCH_BUDGET = 300
+# how long a domain counts as active after a request of its user
+DOMAIN_ACTIVE_TIME = 30 * 60
 READ_ONLY = False
 TRIAL_PERIOD = 14 # in days
 
@@ -123,6 +130,7 @@ TEMPLATE_LOADERS = (
 
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
+    'crlib.middleware.RequestCacheMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'crauth.users.UsersMiddleware',
     'crlib.middleware.LocaleMiddleware',
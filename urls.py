@@ -37,6 +37,11 @@ urlpatterns += patterns('crgappspanel.views.general',
 urlpatterns += patterns('crgappspanel.views.users',
     url(r'^users/list/$', 'users', name='users'),
     url(r'^users/create/$', 'user_create', name='user-create'),
+    url(r'^users/import/$', 'users_import', name='users-import'),
+    url(r'^users/import/(?P<id>\d+)/$',
+        'users_import_status', name='users-import-status'),
+    url(r'^__users_import_worker/$', 'users_import_worker',
+        name='users-import-worker'),
     url(r'^users/details/(?P<name>[^/]+)/$',
         'user_details', name='user-details'),
     url(r'^users/roles/(?P<name>[^/]+)/$', 'user_roles', name='user-roles'),
@@ -108,6 +113,16 @@ urlpatterns += patterns('crgappspanel.views.calendar_resources',
 )
 
 
+urlpatterns += patterns('crgappspanel.views.export',
+    url(r'^export/(?P<kind>[a-z-]+)/$', 'export', name='export'),
+    url(r'^export/status/(?P<id>\d+)/$', 'export_status',
+        name='export-status'),
+    url(r'^export/download/(?P<id>\d+)/$', 'export_download',
+        name='export-download'),
+    url(r'^__export_worker/$', 'export_worker', name='export-worker'),
+)
+
+
 urlpatterns += patterns('',
     url(r'^openid/', include('crauth.urls')),
     url(r'^appadmin/', include('crappadmin.urls')),